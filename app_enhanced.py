@@ -5,6 +5,7 @@ import io
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from sap_integration import SAPIntegration, SAP_CONFIG
+from tax_engine import calculate_tax
 import os
 from datetime import datetime
 import logging
@@ -286,46 +287,6 @@ def parse_group(form, prefix):
         i += 1
     return result
 
-def calculate_tax(income, settings):
-    """Calculate tax using SARS brackets"""
-    try:
-        tax_brackets = json.loads(settings.get('tax_brackets', '[]'))
-        
-        if tax_brackets:
-            tax = 0
-            previous_threshold = 0
-            
-            for bracket in tax_brackets:
-                threshold = bracket['threshold']
-                rate = bracket['rate'] / 100
-                
-                if income > previous_threshold:
-                    taxable_in_bracket = min(income - previous_threshold, threshold - previous_threshold)
-                    tax += taxable_in_bracket * rate
-                
-                if income <= threshold:
-                    break
-                previous_threshold = threshold
-            
-            return tax
-    except:
-        pass
-    
-    # Fallback to default SARS brackets
-    brackets = [
-        (0, 237100, 0.18, 0),
-        (237101, 370500, 0.26, 42678),
-        (370501, 512800, 0.31, 77362),
-        (512801, 673000, 0.36, 121475),
-        (673001, 857900, 0.39, 179147),
-        (857901, 1817000, 0.41, 251258),
-        (1817001, float('inf'), 0.45, 644489),
-    ]
-    for lower, upper, rate, base in brackets:
-        if income <= upper:
-            return base + (income - lower) * rate
-    return 0
-
 def save_completed_package(employee_id, package_data):
     """Save completed package to local storage"""
     try:
@@ -0,0 +1,304 @@
+"""
+Segmented JSONL package audit log
+Audit entries are appended, one JSON line each, to the newest segment in
+package_audit_log/. A sidecar index per segment records each line's employee
+and byte range, so one employee's history is read with a pread per entry
+rather than by loading the whole trail.
+
+Once a segment passes SEGMENT_BYTES it is closed and gzip-compressed in the
+background. The compressed file is a series of independent gzip members of
+about BLOCK_BYTES each (still a valid .gz), and its index is rewritten to
+point at (member, offset within member), so compressed history stays
+randomly readable.
+
+Index lines are JSON arrays: [employee_id, offset, length] for a live
+segment and [employee_id, member_offset, member_length, offset, length]
+for a compressed one. Appends take an flock on the log directory, so every
+gunicorn worker can write to the same segment.
+"""
+
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from array import array
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are serialised within the process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_AUDIT_LOG_DIR = 'package_audit_log'
+
+# Close the live segment once it reaches this size
+SEGMENT_BYTES = 8 * 1024 * 1024
+# Uncompressed size of each gzip member in a compressed segment
+BLOCK_BYTES = 64 * 1024
+
+SEGMENT_PATTERN = re.compile(r'^audit-(\d{6})\.jsonl(\.gz)?$')
+
+
+class AuditSegmentLog:
+    """Append-only audit log in rolling, compressible JSONL segments"""
+
+    def __init__(self, directory: str = PACKAGE_AUDIT_LOG_DIR, segment_bytes: int = SEGMENT_BYTES,
+                 fsync: bool = True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        # segment number -> {'ino', 'pos', 'compressed', 'employees': {employee_id: array of locations}}
+        self._indexes: Dict[int, Dict] = {}
+        self._seeded = False
+
+    # Paths
+    def _data_path(self, number: int, compressed: bool = False) -> str:
+        return os.path.join(self.directory, f'audit-{number:06d}.jsonl{".gz" if compressed else ""}')
+
+    def _index_path(self, number: int) -> str:
+        return os.path.join(self.directory, f'audit-{number:06d}.idx')
+
+    def segments(self) -> Dict[int, bool]:
+        """Segment number -> whether it is compressed, oldest first"""
+        found = {}
+        if not os.path.isdir(self.directory):
+            return found
+        for name in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                number = int(match.group(1))
+                # Both files exist briefly while a segment is compressed
+                found[number] = found.get(number, False) or bool(match.group(2))
+        return dict(sorted(found.items()))
+
+    @contextmanager
+    def _append_lock(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Writing
+    def append(self, employee_id: str, entries: List[Dict]):
+        """Append one employee's audit entries to the live segment"""
+        self.append_batch({str(employee_id): entries})
+
+    def append_batch(self, entries_by_employee: Dict[str, List[Dict]]):
+        """Append several employees' entries in one write"""
+        if not any(entries_by_employee.values()):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._append_lock():
+            closed = self._write(entries_by_employee)
+        if closed:
+            threading.Thread(target=self.compress_closed, daemon=True).start()
+
+    def _write(self, entries_by_employee: Dict[str, List[Dict]]) -> bool:
+        """Write entries under the append lock; True when this closed the previous segment"""
+        owners, lines = [], []
+        for employee_id, entries in entries_by_employee.items():
+            for entry in entries:
+                owners.append(str(employee_id))
+                lines.append(json.dumps(dict(entry, employee_id=str(employee_id)), separators=(',', ':'),
+                                        default=str).encode('utf-8') + b'\n')
+        segments = self.segments()
+        live = max((number for number, compressed in segments.items() if not compressed), default=None)
+        closed = False
+        if live is None or live < max(segments, default=0):
+            live = max(segments, default=0) + 1
+        elif os.path.getsize(self._data_path(live)) >= self.segment_bytes:
+            closed, live = True, live + 1
+
+        with open(self._data_path(live), 'ab') as f:
+            offset = f.tell()
+            f.write(b''.join(lines))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        index_lines = []
+        for employee_id, line in zip(owners, lines):
+            index_lines.append(json.dumps([employee_id, offset, len(line)], separators=(',', ':')) + '\n')
+            offset += len(line)
+        with open(self._index_path(live), 'a', encoding='utf-8') as f:
+            f.write(''.join(index_lines))
+        return closed
+
+    def compress_closed(self) -> int:
+        """Compress every closed segment that is still plain JSONL; returns how many were compressed"""
+        live = max(self.segments(), default=None)
+        done = 0
+        for number in self.segments():
+            if number == live:
+                continue
+            # A plain file left beside a .gz means an interrupted compression; redo it
+            with self._append_lock():
+                if not os.path.exists(self._data_path(number)):
+                    continue
+                try:
+                    self._compress(number)
+                    done += 1
+                except OSError as e:
+                    logger.error(f"Could not compress audit segment {number}: {str(e)}")
+        return done
+
+    def _compress(self, number: int):
+        source = self._data_path(number)
+        target = self._data_path(number, compressed=True)
+        with open(source, 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        if lines and not lines[-1].endswith(b'\n'):
+            lines.pop()  # torn final write
+
+        index_lines, block = [], []
+        with open(f'{target}.tmp', 'wb') as out:
+            def flush_block():
+                if not block:
+                    return
+                data = gzip.compress(b''.join(line for _, line in block))
+                member_offset = out.tell()
+                out.write(data)
+                position = 0
+                for employee_id, line in block:
+                    index_lines.append(json.dumps([employee_id, member_offset, len(data), position, len(line)],
+                                                  separators=(',', ':')) + '\n')
+                    position += len(line)
+                block.clear()
+
+            size = 0
+            for line in lines:
+                try:
+                    employee_id = str(json.loads(line)['employee_id'])
+                except (ValueError, KeyError):
+                    logger.warning(f"Dropping unreadable line from audit segment {number}")
+                    continue
+                if block and size + len(line) > BLOCK_BYTES:
+                    flush_block()
+                    size = 0
+                block.append((employee_id, line))
+                size += len(line)
+            flush_block()
+            out.flush()
+            os.fsync(out.fileno())
+
+        index_path = self._index_path(number)
+        with open(f'{index_path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(''.join(index_lines))
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers still holding the plain index retry once the plain segment is gone
+        os.replace(f'{target}.tmp', target)
+        os.replace(f'{index_path}.tmp', index_path)
+        os.remove(source)
+        logger.info(f"Compressed audit segment {number}: {len(index_lines)} entries")
+
+    # Reading
+    def _refresh_index(self, number: int) -> Dict:
+        """The segment's index, reading only lines appended since the last call"""
+        path = self._index_path(number)
+        cached = self._indexes.get(number)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._indexes.pop(number, None)
+            return {'compressed': False, 'employees': {}}
+        if cached is None or cached['ino'] != st.st_ino or st.st_size < cached['pos']:
+            cached = {'ino': st.st_ino, 'pos': 0, 'compressed': False, 'employees': {}}
+            self._indexes[number] = cached
+        if st.st_size == cached['pos']:
+            return cached
+
+        with open(path, 'rb') as f:
+            f.seek(cached['pos'])
+            data = f.read()
+        complete = data[:data.rfind(b'\n') + 1]  # leave a partly written line for next time
+        for line in complete.splitlines():
+            try:
+                location = json.loads(line)
+            except ValueError:
+                continue
+            cached['compressed'] = len(location) == 5
+            cached['employees'].setdefault(location[0], array('q')).extend(location[1:])
+        cached['pos'] += len(complete)
+        return cached
+
+    def read_employee(self, employee_id: str) -> List[Dict]:
+        """Every audit entry for one employee, oldest first"""
+        employee_id = str(employee_id)
+        entries = []
+        with self._lock:
+            for number in self.segments():
+                for attempt in range(2):
+                    index = self._refresh_index(number)
+                    try:
+                        entries.extend(self._read_locations(number, index, index['employees'].get(employee_id)))
+                        break
+                    except FileNotFoundError:
+                        # Compressed since the index was read; reload it
+                        self._indexes.pop(number, None)
+        return entries
+
+    def _read_locations(self, number: int, index: Dict, locations: Optional[array]) -> List[Dict]:
+        if not locations:
+            return []
+        entries = []
+        if not index['compressed']:
+            fd = os.open(self._data_path(number), os.O_RDONLY)
+            try:
+                for i in range(0, len(locations), 2):
+                    entries.append(json.loads(os.pread(fd, locations[i + 1], locations[i])))
+            finally:
+                os.close(fd)
+            return entries
+
+        fd = os.open(self._data_path(number, compressed=True), os.O_RDONLY)
+        try:
+            member, member_at = b'', None
+            for i in range(0, len(locations), 4):
+                member_offset, member_length, offset, length = locations[i:i + 4]
+                if member_at != member_offset:
+                    member = zlib.decompress(os.pread(fd, member_length, member_offset), 16 + zlib.MAX_WBITS)
+                    member_at = member_offset
+                entries.append(json.loads(member[offset:offset + length]))
+        finally:
+            os.close(fd)
+        return entries
+
+    def import_json(self, path: str) -> int:
+        """Seed an empty log from a {employee_id: [entries]} audit file; returns the entries imported"""
+        if self._seeded or self.segments() or not os.path.exists(path):
+            self._seeded = True
+            return 0
+        try:
+            with open(path, 'r') as f:
+                audits = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not import audit file {path}: {str(e)}")
+            return 0
+
+        imported = 0
+        os.makedirs(self.directory, exist_ok=True)
+        with self._append_lock():
+            # Another worker may have seeded the log meanwhile
+            if not self.segments() and isinstance(audits, dict):
+                audits = {employee_id: entries for employee_id, entries in audits.items()
+                          if isinstance(entries, list) and entries}
+                if audits:
+                    self._write(audits)
+                    imported = sum(len(entries) for entries in audits.values())
+        self._seeded = True
+        if imported:
+            logger.info(f"Imported {imported} audit entries from {path} into {self.directory}")
+        return imported
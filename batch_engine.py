@@ -0,0 +1,284 @@
+"""
+Vectorised net pay engine for Rand Water SAP uploads
+Computes PAYE, UIF, contributions, medical credits and take-home for a whole
+upload in one NumPy pass, following the same rules as the employee payslip
+"""
+
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from money import from_cents, from_cents_array, round_money_array, to_cents_array
+from tax_engine import get_tax_table, rebate_array
+
+logger = logging.getLogger(__name__)
+
+# Result field -> SAP column (monthly Rand values unless noted)
+SAP_COLUMNS = {
+    'tpe': 'TPE',
+    'cash': 'CASH',
+    'car': 'CAR',
+    'housing': 'HOUSING',
+    'cellphone': 'CELLPHONEALLOWANCE',
+    'data_service': 'DATASERVICEALLOWANCE',
+    'bonus': 'BONUSPROVISION',
+    'pension_employee': 'PENSIONEECONTRIBUTION',
+    'pension_employer': 'PENSIONERCONTRIBUTION',
+    'medical_employee': 'MEDICALEECONTRIBUTION',
+    'medical_employer': 'MEDICALERCONTRIBUTION',
+    'group_life_employee': 'GROUPLIFEEECONTRIBUTION',
+    'group_life_employer': 'GROUPLIFEERCONTRIBUTION',
+    'sap_uif': 'UIF',
+    'age': 'AGE',
+}
+
+# Medical scheme member counts, with the payslip defaults when SAP omits them
+MEDICAL_MEMBER_COLUMNS = {
+    'main_members': ('MEDICALMAINMEMBER', 1.0),
+    'first_dependants': ('MEDICALFIRSTDEPENDENT', 0.0),
+    'additional_dependants': ('MEDICALADDITIONAL', 0.0),
+}
+
+# Dependants as the SAP upload template carries them: SPOUSE is Yes/No, CHILDREN and ADULTS are counts
+DEPENDANT_COLUMNS = {
+    'spouses': 'SPOUSE',
+    'children': 'CHILDREN',
+    'adult_dependants': 'ADULTS',
+}
+
+UIF_RATE = 0.01
+TRAVEL_TAXABLE_PORTION = 0.8
+BONUS_TAX_RATE = 0.18
+
+OUTPUT_FIELDS = [
+    'total_earnings', 'taxable_income_annual', 'pension_employee', 'pension_employer',
+    'group_life_employee', 'group_life_employer', 'medical_employee', 'medical_credit_monthly',
+    'uif_employee', 'tax', 'bonus_tax_provision', 'total_tax', 'total_deductions', 'net_pay',
+]
+
+
+def _to_float(value, default: float) -> float:
+    """Convert a SAP cell to float, treating blanks and Yes/No flags as missing"""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        value = value.strip()
+        if value.upper() in ('YES', 'NO', 'N/A', ''):
+            return default
+    try:
+        result = float(value)
+    except (TypeError, ValueError):
+        return default
+    return default if result != result else result
+
+
+def sap_column(employee_data, key: str, default: float = 0.0) -> np.ndarray:
+    """Extract one numeric column from a list of SAP rows or a DataFrame"""
+    if hasattr(employee_data, 'columns'):
+        if key not in employee_data.columns:
+            return np.full(len(employee_data), default, dtype=np.float64)
+        values = employee_data[key].tolist()
+    else:
+        values = [row.get(key) for row in employee_data]
+    return np.fromiter((_to_float(v, default) for v in values), dtype=np.float64, count=len(values))
+
+
+def sap_flag(employee_data, key: str) -> np.ndarray:
+    """1.0 where a SAP column says Yes (or holds a positive count), else 0.0"""
+    if hasattr(employee_data, 'columns'):
+        values = employee_data[key].tolist() if key in employee_data.columns else [None] * len(employee_data)
+    else:
+        values = [row.get(key) for row in employee_data]
+    return np.fromiter((1.0 if str(v).strip().upper() in ('YES', 'Y', 'TRUE') or _to_float(v, 0.0) > 0 else 0.0
+                        for v in values), dtype=np.float64, count=len(values))
+
+
+def medical_dependants(columns: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Adult and child dependants to price scheme rates on: the SPOUSE, ADULTS
+    and CHILDREN columns, or the member counts for rows without them.
+    """
+    adults = columns['spouses'] + columns['adult_dependants']
+    listed = adults + columns['children'] > 0
+    return (np.where(listed, adults, columns['first_dependants']),
+            np.where(listed, columns['children'], columns['additional_dependants']))
+
+
+def _employee_ids(employee_data) -> List[str]:
+    """Employee codes in row order"""
+    if hasattr(employee_data, 'columns'):
+        if 'EMPLOYEECODE' not in employee_data.columns:
+            return [''] * len(employee_data)
+        codes = employee_data['EMPLOYEECODE'].tolist()
+    else:
+        codes = [row.get('EMPLOYEECODE') for row in employee_data]
+    return [str(code) if code is not None else '' for code in codes]
+
+
+def load_columns(employee_data) -> Dict[str, np.ndarray]:
+    """Build the input column arrays used by calculate_batch"""
+    columns = {field: sap_column(employee_data, key) for field, key in SAP_COLUMNS.items()}
+    for field, (key, default) in MEDICAL_MEMBER_COLUMNS.items():
+        columns[field] = sap_column(employee_data, key, default)
+    # Only for pricing scheme options; the tax credit keeps the payslip's member counts
+    columns['spouses'] = sap_flag(employee_data, DEPENDANT_COLUMNS['spouses'])
+    for field in ('children', 'adult_dependants'):
+        columns[field] = np.maximum(sap_column(employee_data, DEPENDANT_COLUMNS[field]), 0)
+    return columns
+
+
+def load_package_columns(packages: List) -> Tuple[List[str], Dict[str, np.ndarray], Dict[int, str]]:
+    """
+    Build input columns from API package rows, validating each row.
+
+    Rows may use the engine field names (cash, car, housing, ...) or SAP
+    column names. Returns (employee_ids, columns, errors) where errors maps a
+    row index to its message; failed rows are left as zeros in the columns.
+    """
+    fields = dict(SAP_COLUMNS)
+    fields.update({field: key for field, (key, _) in MEDICAL_MEMBER_COLUMNS.items()})
+    defaults = {field: default for field, (_, default) in MEDICAL_MEMBER_COLUMNS.items()}
+
+    count = len(packages)
+    columns = {field: np.full(count, defaults.get(field, 0.0), dtype=np.float64) for field in fields}
+    employee_ids = []
+    errors = {}
+
+    for i, package in enumerate(packages):
+        if not isinstance(package, dict):
+            employee_ids.append('')
+            errors[i] = 'Package must be a JSON object'
+            continue
+        employee_ids.append(str(package.get('employee_id', package.get('EMPLOYEECODE', ''))))
+        values = {}
+        for field, key in fields.items():
+            value = package.get(field, package.get(key))
+            if value is None or value == '':
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                errors[i] = f"{field} must be a number"
+                break
+            if not 0 <= value < float('inf'):
+                errors[i] = f"{field} must be a non-negative number"
+                break
+            values[field] = value
+        else:
+            for field, value in values.items():
+                columns[field][i] = value
+
+    return employee_ids, columns, errors
+
+
+class BatchResult:
+    """Column-oriented batch output; arrays are aligned with employee_ids"""
+
+    def __init__(self, employee_ids: List[str], columns: Dict[str, np.ndarray]):
+        self.employee_ids = employee_ids
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.employee_ids)
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self.columns[field]
+
+    def to_records(self) -> List[Dict]:
+        """One dict per employee, rounded to cents for JSON responses"""
+        rounded = {field: round_money_array(self.columns[field]).tolist() for field in OUTPUT_FIELDS}
+        return [
+            dict({'employee_id': employee_id}, **{field: rounded[field][i] for field in OUTPUT_FIELDS})
+            for i, employee_id in enumerate(self.employee_ids)
+        ]
+
+    def totals(self) -> Dict[str, float]:
+        """Monthly totals across the batch"""
+        return {field: from_cents(to_cents_array(self.columns[field]).sum()) for field in OUTPUT_FIELDS}
+
+
+def calculate_columns(columns: Dict[str, np.ndarray], settings: Optional[Dict] = None) -> Dict[str, np.ndarray]:
+    """Run the payslip calculation over pre-built column arrays"""
+    settings = settings or {}
+    table = get_tax_table(settings)
+
+    # Monetary inputs as int64 cents so every sum below is exact
+    cash = to_cents_array(columns['cash'])
+    car = to_cents_array(columns['car'])
+    housing = to_cents_array(columns['housing'])
+    cellphone = to_cents_array(columns['cellphone'])
+    data_service = to_cents_array(columns['data_service'])
+    pension_ee = to_cents_array(columns['pension_employee'], 'pension')
+    pension_er = to_cents_array(columns['pension_employer'], 'pension')
+    medical_ee = to_cents_array(columns['medical_employee'], 'medical')
+    group_life_ee = to_cents_array(columns['group_life_employee'], 'group_life')
+
+    # Earnings exclude TPE, which only drives pension
+    total_earnings = cash + car + housing + cellphone + data_service
+
+    # SAP UIF wins when supplied, otherwise 1% capped at the monthly ceiling
+    uif_ceiling = float(settings.get('uif_ceiling', 177.12))
+    calculated_uif = to_cents_array(np.minimum(from_cents_array(total_earnings) * UIF_RATE, uif_ceiling), 'uif')
+    uif = np.where(columns['sap_uif'] > 0, to_cents_array(columns['sap_uif'], 'uif'), calculated_uif)
+
+    # Taxable income after the pension (EE + ER) deduction
+    taxable_monthly = from_cents_array(cash + housing + cellphone + data_service - pension_ee - pension_er)
+    taxable_annual = (taxable_monthly + from_cents_array(car) * TRAVEL_TAXABLE_PORTION) * 12
+    gross_tax = table.tax_array(taxable_annual)
+
+    rebate = rebate_array(columns['age'], settings)
+
+    first_two = np.minimum(columns['main_members'] + columns['first_dependants'], 2)
+    medical_credit = (first_two * settings.get('medical_main', 364)
+                      + columns['additional_dependants'] * settings.get('medical_additional', 246))
+    medical_credit = np.where(medical_ee > 0, medical_credit, 0.0)
+
+    annual_tax = np.maximum(gross_tax - rebate - medical_credit * 12, 0)
+    monthly_tax = to_cents_array(annual_tax / 12, 'paye')
+    bonus_tax = to_cents_array(columns['bonus'] * BONUS_TAX_RATE / 12, 'bonus_tax')
+    total_tax = monthly_tax + bonus_tax
+
+    total_deductions = pension_ee + medical_ee + group_life_ee + uif + total_tax
+
+    return {
+        'total_earnings': from_cents_array(total_earnings),
+        'taxable_income_annual': taxable_annual,
+        'pension_employee': from_cents_array(pension_ee),
+        'pension_employer': from_cents_array(pension_er),
+        'group_life_employee': from_cents_array(group_life_ee),
+        'group_life_employer': round_money_array(columns['group_life_employer'], 'group_life'),
+        'medical_employee': from_cents_array(medical_ee),
+        'medical_credit_monthly': medical_credit,
+        'uif_employee': from_cents_array(uif),
+        'tax': from_cents_array(monthly_tax),
+        'bonus_tax_provision': from_cents_array(bonus_tax),
+        'total_tax': from_cents_array(total_tax),
+        'total_deductions': from_cents_array(total_deductions),
+        'net_pay': from_cents_array(total_earnings - total_deductions),
+    }
+
+
+def calculate_batch(employee_data, settings: Optional[Dict] = None) -> BatchResult:
+    """
+    Calculate monthly net pay for every employee in a SAP upload.
+
+    employee_data is the 'employee_data' list stored on a PackageManager
+    upload or a DataFrame read from the SAP spreadsheet.
+    """
+    employee_ids = _employee_ids(employee_data)
+    if not employee_ids:
+        return BatchResult([], {field: np.zeros(0) for field in OUTPUT_FIELDS})
+
+    columns = calculate_columns(load_columns(employee_data), settings)
+    logger.info(f"Batch net pay calculated for {len(employee_ids)} employees")
+    return BatchResult(employee_ids, columns)
+
+
+def calculate_package_batch(packages: List, settings: Optional[Dict] = None) -> Tuple[BatchResult, Dict[int, str]]:
+    """Calculate net pay for API package rows, returning (result, row errors)"""
+    employee_ids, columns, errors = load_package_columns(packages)
+    result = BatchResult(employee_ids, calculate_columns(columns, settings))
+    if errors:
+        logger.warning(f"Batch net pay rejected {len(errors)} of {len(packages)} packages")
+    return result, errors
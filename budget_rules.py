@@ -0,0 +1,262 @@
+"""
+Declarative budget rules for Rand Water packages
+The band rules from PACKAGE_MANAGEMENT_FUNCTIONAL_RULES.md are kept as data
+(budget_rules.json overrides the defaults below) and compiled into numpy
+predicates, so the same rules check one package being edited or every draft
+and submitted package in a single pass.
+
+Each rule is:
+
+    {"id": "tpe_range", "metric": "tpe_percent", "min": 50, "max": 70,
+     "bands": ["O", "P", "Q"], "skip_zero": false, "severity": "warning", "label": "TPE"}
+
+Packages whose band is unknown are checked against every rule, since only
+O-Q employees are given access to the package tools.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from batch_engine import sap_column
+
+logger = logging.getLogger(__name__)
+
+BUDGET_RULES_FILE = 'budget_rules.json'
+
+# Metric -> unit used in messages
+METRICS = {
+    'tpe_percent': 'percent',
+    'car_percent': 'percent',
+    'bonus_percent': 'percent',
+    'remaining_budget': 'rand',
+}
+SEVERITIES = ('warning', 'error')
+
+# Built-in error for packages with no CTC, whose metrics cannot be measured
+MISSING_CTC_RULE = 'ctc_missing'
+
+DEFAULT_BUDGET_RULES = [
+    {'id': 'tpe_range', 'metric': 'tpe_percent', 'min': 50, 'max': 70, 'bands': ['O', 'P', 'Q'],
+     'severity': 'warning', 'label': 'TPE'},
+    {'id': 'car_minimum', 'metric': 'car_percent', 'min': 30, 'skip_zero': True, 'bands': ['O', 'P', 'Q'],
+     'severity': 'warning', 'label': 'Car Allowance'},
+    {'id': 'bonus_range', 'metric': 'bonus_percent', 'min': 10, 'max': 70, 'skip_zero': True,
+     'bands': ['O', 'P', 'Q'], 'severity': 'warning', 'label': 'Bonus'},
+    {'id': 'within_ctc', 'metric': 'remaining_budget', 'min': 0, 'severity': 'error', 'label': 'Remaining budget'},
+]
+
+
+class BudgetRuleError(ValueError):
+    """Raised when a rule definition is invalid"""
+
+
+class CompiledRule:
+    """One rule turned into a vectorised predicate over metric columns"""
+
+    def __init__(self, rule: Dict):
+        self.id = str(rule.get('id') or '')
+        self.metric = rule.get('metric')
+        if not self.id:
+            raise BudgetRuleError("Every budget rule needs an id")
+        if self.metric not in METRICS:
+            raise BudgetRuleError(f"Rule {self.id}: unknown metric {self.metric}")
+        self.severity = rule.get('severity', 'warning')
+        if self.severity not in SEVERITIES:
+            raise BudgetRuleError(f"Rule {self.id}: severity must be one of {', '.join(SEVERITIES)}")
+        try:
+            self.min = float(rule['min']) if rule.get('min') is not None else None
+            self.max = float(rule['max']) if rule.get('max') is not None else None
+        except (TypeError, ValueError):
+            raise BudgetRuleError(f"Rule {self.id}: min and max must be numbers")
+        if self.min is None and self.max is None:
+            raise BudgetRuleError(f"Rule {self.id}: needs a min or a max")
+        self.bands = [str(band).upper() for band in rule['bands']] if rule.get('bands') else None
+        self.skip_zero = bool(rule.get('skip_zero', False))
+        self.label = rule.get('label') or self.id
+
+    def to_dict(self) -> Dict:
+        return {'id': self.id, 'metric': self.metric, 'min': self.min, 'max': self.max, 'bands': self.bands,
+                'skip_zero': self.skip_zero, 'severity': self.severity, 'label': self.label}
+
+    def evaluate(self, metrics: Dict[str, np.ndarray], bands: np.ndarray) -> Dict[str, np.ndarray]:
+        """Boolean masks of rows below the minimum and above the maximum"""
+        values = metrics[self.metric]
+        # NaN (no CTC to measure against) fails every comparison; evaluate reports those rows itself
+        applies = np.ones(len(values), dtype=bool)
+        if self.bands:
+            applies &= np.isin(bands, self.bands) | (bands == '')
+        if self.skip_zero:
+            applies &= values != 0
+        below = applies & (values < self.min) if self.min is not None else np.zeros(len(values), dtype=bool)
+        above = applies & (values > self.max) if self.max is not None else np.zeros(len(values), dtype=bool)
+        return {'below': below, 'above': above}
+
+    def message(self, value: float, side: str) -> str:
+        limit = self.min if side == 'below' else self.max
+        bound = 'minimum' if side == 'below' else 'maximum'
+        if METRICS[self.metric] == 'percent':
+            return f"{self.label} is {value:.1f}% of CTC ({side} {limit:g}% {bound})"
+        return f"{self.label} is R{value:,.2f} ({side} R{limit:,.2f} {bound})"
+
+
+def compile_rules(rules: List[Dict]) -> List[CompiledRule]:
+    if not isinstance(rules, list):
+        raise BudgetRuleError("Budget rules must be a list")
+    compiled = [CompiledRule(rule) for rule in rules]
+    ids = [rule.id for rule in compiled]
+    if len(set(ids)) != len(ids):
+        raise BudgetRuleError("Budget rule ids must be unique")
+    return compiled
+
+
+_cache = {'key': None, 'rules': None}
+_cache_lock = threading.Lock()
+
+
+def load_budget_rules(path: str = BUDGET_RULES_FILE) -> List[CompiledRule]:
+    """Compiled rules from the rules file (defaults when missing), recompiled only when it changes"""
+    try:
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = (path, None, None)
+
+    with _cache_lock:
+        if _cache['key'] == key:
+            return _cache['rules']
+        rules = None
+        if key[1] is not None:
+            try:
+                with open(path, 'r') as f:
+                    raw = json.load(f)
+                rules = compile_rules(raw.get('rules', []) if isinstance(raw, dict) else raw)
+                logger.info(f"Loaded {len(rules)} budget rule(s) from {path}")
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not load budget rules from {path}, using defaults: {str(e)}")
+        if rules is None:
+            rules = compile_rules(DEFAULT_BUDGET_RULES)
+        _cache.update(key=key, rules=rules)
+        return rules
+
+
+def package_metrics(ctc, tpe, car, bonus_annual, tctc) -> Dict[str, np.ndarray]:
+    """Rule metrics from component columns (scalars or arrays); metrics are NaN without a CTC"""
+    ctc = np.atleast_1d(np.asarray(ctc, dtype=np.float64))
+    has_ctc = ctc > 0
+
+    def percent(amount):
+        amount = np.atleast_1d(np.asarray(amount, dtype=np.float64))
+        return np.divide(amount * 100, ctc, out=np.full(len(ctc), np.nan), where=has_ctc)
+
+    remaining = ctc - np.atleast_1d(np.asarray(tctc, dtype=np.float64))
+    return {
+        'tpe_percent': percent(tpe),
+        'car_percent': percent(car),
+        'bonus_percent': percent(bonus_annual),
+        'remaining_budget': np.where(has_ctc, np.round(remaining, 2), np.nan),
+        'ctc': ctc,
+    }
+
+
+def evaluate(metrics: Dict[str, np.ndarray], bands, rules: Optional[List[CompiledRule]] = None) -> List[Dict]:
+    """
+    Every violation across the rows, in row then rule order.
+
+    Each entry is {row, rule, severity, value, message}. A row without a
+    CTC fails no rule, so it is reported as a MISSING_CTC_RULE error.
+    """
+    rules = load_budget_rules() if rules is None else rules
+    bands = np.asarray([str(band or '').upper().strip() for band in bands], dtype=str)
+    found = []
+    if 'ctc' in metrics:
+        for row in np.flatnonzero(~(metrics['ctc'] > 0)):
+            found.append({'row': int(row), 'order': -1, 'rule': MISSING_CTC_RULE, 'severity': 'error',
+                          'value': 0.0, 'message': "CTC is missing or zero, so the budget cannot be checked"})
+    for order, rule in enumerate(rules):
+        masks = rule.evaluate(metrics, bands)
+        for side in ('below', 'above'):
+            for row in np.flatnonzero(masks[side]):
+                value = float(metrics[rule.metric][row])
+                found.append({'row': int(row), 'order': order, 'rule': rule.id, 'severity': rule.severity,
+                              'value': round(value, 2), 'message': rule.message(value, side)})
+    found.sort(key=lambda item: (item['row'], item['order']))
+    for item in found:
+        del item['order']
+    return found
+
+
+def check_package(ctc: float, tpe: float, car: float, bonus_annual: float, tctc: float, band: str = '',
+                  rules: Optional[List[CompiledRule]] = None) -> Dict[str, List[str]]:
+    """Rule messages for one package, split into blocking errors and warnings"""
+    violations = evaluate(package_metrics(ctc, tpe, car, bonus_annual, tctc), [band], rules)
+    return {
+        'errors': [v['message'] for v in violations if v['severity'] == 'error'],
+        'warnings': [v['message'] for v in violations if v['severity'] == 'warning'],
+    }
+
+
+def stored_package_metrics(packages: List[Dict], sap_rows: Dict[str, Dict]) -> Dict[str, np.ndarray]:
+    """Rule metrics for stored packages, measured against each employee's SAP CTC"""
+    rows = [sap_rows.get(package['employee_id']) or {} for package in packages]
+    ctc = sap_column(rows, 'CTC')
+    ctc = np.where(ctc > 0, ctc, sap_column(rows, 'TCTC'))
+
+    components = [package.get('package_components') or {} for package in packages]
+    columns = {key: sap_column(components, key) for key in (
+        'tpe', 'cash_component', 'car_allowance', 'housing_allowance', 'cellphone_allowance',
+        'data_service_allowance', 'bonus', 'pension_er', 'medical_er', 'group_life_er')}
+    tctc = (columns['cash_component'] + columns['car_allowance'] + columns['housing_allowance']
+            + columns['cellphone_allowance'] + columns['data_service_allowance'] + columns['pension_er']
+            + columns['medical_er'] + columns['group_life_er'] + columns['bonus'] / 12)
+    return package_metrics(ctc, columns['tpe'], columns['car_allowance'], columns['bonus'], tctc)
+
+
+def violations_report(packages: List[Dict], sap_rows: Dict[str, Dict],
+                      rules: Optional[List[CompiledRule]] = None) -> Dict:
+    """
+    Check every stored package in one pass and summarise violations.
+
+    packages are impact_engine.stored_packages() entries; band and
+    department come from the employee's SAP row.
+    """
+    rules = load_budget_rules() if rules is None else rules
+    rows = [sap_rows.get(package['employee_id']) or {} for package in packages]
+    bands = [str(row.get('BAND') or '').upper().strip() for row in rows]
+    departments = [str(row.get('DEPARTMENT') or 'Unknown') for row in rows]
+
+    violations = evaluate(stored_package_metrics(packages, sap_rows), bands, rules) if packages else []
+
+    by_band, by_department, by_rule = {}, {}, {}
+    details = []
+    for violation in violations:
+        package = packages[violation['row']]
+        band = bands[violation['row']] or 'UNKNOWN'
+        department = departments[violation['row']]
+        for summary, key in ((by_band, band), (by_department, department)):
+            counts = summary.setdefault(key, {})
+            counts[violation['rule']] = counts.get(violation['rule'], 0) + 1
+        by_rule[violation['rule']] = by_rule.get(violation['rule'], 0) + 1
+        details.append({
+            'employee_id': package['employee_id'],
+            'source': package.get('source'),
+            'band': band,
+            'department': department,
+            'rule': violation['rule'],
+            'severity': violation['severity'],
+            'value': violation['value'],
+            'message': violation['message']
+        })
+
+    return {
+        'checked': len(packages),
+        'violating': len({(v['employee_id'], v['source']) for v in details}),
+        'by_rule': by_rule,
+        'by_band': by_band,
+        'by_department': by_department,
+        'violations': details
+    }
@@ -0,0 +1,158 @@
+"""
+Incremental package calculation graph
+Models one package as memoised nodes (components -> TPE -> pension / group
+life -> cash and TCTC -> taxable income -> PAYE -> net pay). An edit marks the
+changed inputs dirty and recomputes only their dependants, stopping wherever
+a node's value comes out unchanged, so a per-keystroke update touches a
+handful of nodes and returns only the outputs that moved.
+"""
+
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from batch_engine import BONUS_TAX_RATE, TRAVEL_TAXABLE_PORTION, UIF_RATE
+from money import round_money, sum_money
+from tax_engine import calculate_rebate, get_tax_table
+
+logger = logging.getLogger(__name__)
+
+# Editable inputs and their defaults (monthly Rand unless noted)
+INPUTS = {
+    'ctc': 0.0,
+    'tpe': 0.0,
+    'car_allowance': 0.0,
+    'housing_allowance': 0.0,
+    'cellphone_allowance': 0.0,
+    'data_service_allowance': 0.0,
+    'bonus': 0.0,                  # annual
+    'pension_option': 'B',
+    'group_life_option': 'standard',
+    'medical_ee': 0.0,
+    'medical_er': 0.0,
+    'age': 0.0,
+    'main_members': 1.0,
+    'first_dependants': 0.0,
+    'additional_dependants': 0.0,
+}
+TEXT_INPUTS = ('pension_option', 'group_life_option')
+
+
+def _percent(part, whole):
+    return round(part / whole * 100, 2) if whole > 0 else 0.0
+
+
+# node -> (dependencies, function(graph, *dependency values)), in dependency order
+NODES: Dict[str, Tuple[Tuple[str, ...], Callable]] = {
+    'pension_rates': (('pension_option',), lambda g, option: g.pension_rates(option)),
+    'group_life_rates': (('group_life_option',), lambda g, option: g.group_life_rates(option)),
+    'pension_ee': (('tpe', 'pension_rates'), lambda g, tpe, rates: round_money(tpe * rates[0] / 100, 'pension')),
+    'pension_er': (('tpe', 'pension_rates'), lambda g, tpe, rates: round_money(tpe * rates[1] / 100, 'pension')),
+    'group_life_ee': (('tpe', 'group_life_rates'),
+                      lambda g, tpe, rates: round_money(tpe * rates['employee'] / 100, 'group_life')),
+    'group_life_er': (('tpe', 'group_life_rates'),
+                      lambda g, tpe, rates: round_money(tpe * rates['employer'] / 100, 'group_life')),
+    'bonus_provision': (('bonus',), lambda g, bonus: round_money(bonus / 12)),
+    'total_er_contributions': (('pension_er', 'medical_er', 'group_life_er'),
+                               lambda g, *amounts: sum_money(amounts)),
+    # CTC is fixed; cash takes whatever the other components leave
+    'cash_component': (('ctc', 'car_allowance', 'housing_allowance', 'cellphone_allowance',
+                        'data_service_allowance', 'total_er_contributions', 'bonus_provision'),
+                       lambda g, ctc, *costs: round_money(ctc - sum_money(costs))),
+    'tctc': (('cash_component', 'car_allowance', 'housing_allowance', 'cellphone_allowance',
+              'data_service_allowance', 'total_er_contributions', 'bonus_provision'),
+             lambda g, *amounts: sum_money(amounts, 'tctc')),
+    'within_budget': (('cash_component',), lambda g, cash: cash >= 0),
+    'tpe_percent': (('tpe', 'ctc'), lambda g, tpe, ctc: _percent(tpe, ctc)),
+    'car_percent': (('car_allowance', 'ctc'), lambda g, car, ctc: _percent(car, ctc)),
+    'bonus_percent': (('bonus', 'ctc'), lambda g, bonus, ctc: _percent(bonus, ctc)),
+    'total_earnings': (('cash_component', 'car_allowance', 'housing_allowance', 'cellphone_allowance',
+                        'data_service_allowance'), lambda g, *amounts: sum_money(amounts)),
+    'taxable_income_annual': (('cash_component', 'car_allowance', 'housing_allowance', 'cellphone_allowance',
+                               'data_service_allowance', 'pension_ee', 'pension_er'),
+                              lambda g, cash, car, housing, cell, data, pension_ee, pension_er: round(
+                                  (cash + housing + cell + data - pension_ee - pension_er
+                                   + car * TRAVEL_TAXABLE_PORTION) * 12, 2)),
+    'tax_rebate': (('age',), lambda g, age: calculate_rebate(age, g.settings)),
+    'medical_credit': (('medical_ee', 'main_members', 'first_dependants', 'additional_dependants'),
+                       lambda g, medical_ee, main, first, additional: (
+                           min(main + first, 2) * g.settings.get('medical_main', 364)
+                           + additional * g.settings.get('medical_additional', 246)) if medical_ee > 0 else 0.0),
+    'paye': (('taxable_income_annual', 'tax_rebate', 'medical_credit'),
+             lambda g, taxable, rebate, credit: round_money(
+                 max(g.table.tax(taxable) - rebate - credit * 12, 0) / 12, 'paye')),
+    'bonus_tax': (('bonus',), lambda g, bonus: round_money(bonus * BONUS_TAX_RATE / 12, 'bonus_tax')),
+    'total_tax': (('paye', 'bonus_tax'), lambda g, *amounts: sum_money(amounts)),
+    'uif': (('total_earnings',),
+            lambda g, earnings: round_money(min(earnings * UIF_RATE, float(g.settings.get('uif_ceiling', 177.12))),
+                                            'uif')),
+    'total_deductions': (('pension_ee', 'medical_ee', 'group_life_ee', 'uif', 'total_tax'),
+                         lambda g, *amounts: sum_money(amounts)),
+    'net_pay': (('total_earnings', 'total_deductions'),
+                lambda g, earnings, deductions: round_money(earnings - deductions)),
+}
+
+# Internal nodes that are not sent to the client
+HIDDEN_NODES = ('pension_rates', 'group_life_rates')
+
+
+class CalcGraph:
+    """Memoised calculation graph for one package being edited"""
+
+    def __init__(self, inputs: Dict, settings: Optional[Dict] = None,
+                 pension_rates: Optional[Callable] = None, group_life_rates: Optional[Callable] = None):
+        self.settings = settings or {}
+        self.table = get_tax_table(self.settings)
+        self.pension_rates = pension_rates or (lambda option: (0.0, 0.0))
+        self.group_life_rates = group_life_rates or (lambda option: {'employee': 0.0, 'employer': 0.0})
+        self.version = 0
+        self.values = dict(INPUTS)
+        for name, value in inputs.items():
+            if name in INPUTS:
+                self.values[name] = self._coerce(name, value)
+        for name, (deps, func) in NODES.items():
+            self.values[name] = func(self, *(self.values[dep] for dep in deps))
+
+    @staticmethod
+    def _coerce(name: str, value):
+        if name in TEXT_INPUTS:
+            return str(value)
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a number")
+        if number != number or number in (float('inf'), float('-inf')):
+            raise ValueError(f"{name} must be a number")
+        return number
+
+    def outputs(self, names=None) -> Dict:
+        names = self.values if names is None else names
+        return {name: self.values[name] for name in names if name not in HIDDEN_NODES}
+
+    def update(self, changes: Dict) -> Tuple[Dict, List[str]]:
+        """Apply input changes; returns (changed values, recomputed node names)"""
+        unknown = [name for name in changes if name not in INPUTS]
+        if unknown:
+            raise ValueError(f"Unknown input(s): {', '.join(sorted(unknown))}")
+
+        # Coerce everything first so a bad value leaves the graph untouched
+        changes = {name: self._coerce(name, value) for name, value in changes.items()}
+        changed = set()
+        for name, value in changes.items():
+            if value != self.values[name]:
+                self.values[name] = value
+                changed.add(name)
+
+        # NODES is in dependency order, so one pass settles the dirty sub-graph
+        recomputed = []
+        for name, (deps, func) in NODES.items():
+            if not changed.intersection(deps):
+                continue
+            recomputed.append(name)
+            value = func(self, *(self.values[dep] for dep in deps))
+            if value != self.values[name]:
+                self.values[name] = value
+                changed.add(name)
+
+        if changed:
+            self.version += 1
+        return self.outputs(sorted(changed)), recomputed
@@ -1,21 +1,500 @@
 import sqlite3
 import json
 import os
+import re
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, List, Optional, Any
 
+# Columns added after the original schema: table -> [(column, type)]
+ADDED_COLUMNS = {
+    'sap_uploads': [('financial_year', 'TEXT'), ('period', 'TEXT')],
+    'employees': [('sap_data', 'TEXT')],
+    'employee_packages': [('package_data', 'TEXT'), ('version', 'INTEGER DEFAULT 0')],
+    'audit_log': [('user_type', 'TEXT')],
+}
+
+# (name, table, columns); built by init_database and rebuilt after bulk loads
+INDEXES = [
+    ('idx_employee_packages_employee', 'employee_packages', 'employee_id'),
+    ('idx_employee_packages_status', 'employee_packages', 'status'),
+    ('idx_employees_upload_employee', 'employees', 'upload_id, employee_id'),
+    ('idx_employees_employee', 'employees', 'employee_id'),
+    ('idx_package_history_employee', 'package_history', 'employee_id'),
+    # Keyset pagination walks these newest first: (table_name[, filter], timestamp, id)
+    ('idx_audit_log_time', 'audit_log', 'table_name, timestamp, id'),
+    ('idx_audit_log_record_time', 'audit_log', 'table_name, record_id, timestamp, id'),
+    ('idx_audit_log_action_time', 'audit_log', 'table_name, action, timestamp, id'),
+    ('idx_audit_log_user_time', 'audit_log', 'table_name, user_id, timestamp, id'),
+    ('idx_package_stat_rows_cell', 'package_stat_rows', 'source, band, department, status, upload_id, tctc'),
+]
+# Indexes superseded by the ones above
+DROPPED_INDEXES = ('idx_audit_log_record',)
+
+# audit_log table_name for package audit entries (PackageManager and calculator)
+PACKAGE_AUDIT_TABLE = 'employee_packages'
+AUDIT_PAGE_SIZE = 100
+
+# employees columns in the employee_search FTS5 index -> bm25 weight
+SEARCH_COLUMNS = {
+    'employee_id': 10.0,
+    'surname': 6.0,
+    'firstname': 6.0,
+    'department': 2.0,
+    'position': 2.0,
+}
+SEARCH_LIMIT = 20
+
+# package_stats cell dimensions; each stored package counts in exactly one cell per source
+STAT_DIMENSIONS = ('band', 'department', 'status', 'upload_id')
+# package_stat_rows source for employee_packages rows (maintained by triggers)
+DATABASE_STATS_SOURCE = 'database'
+
+# Page cache for bulk loads, in KiB
+BULK_CACHE_KIB = 200000
+
+# Bumped whenever init_database gains tables, columns or indexes
+SCHEMA_VERSION = 5
+
+# Per-connection settings, applied once when a pooled connection is opened
+CACHE_KIB = 16000
+MMAP_SIZE = 256 * 1024 * 1024
+# Prepared statements kept per connection: room for every distinct SQL string
+# issued by database.py, db_models.py and package_store.py, so none is re-prepared
+STATEMENT_CACHE_SIZE = 256
+
+# employees column -> SAP header
+EMPLOYEE_COLUMNS = {
+    'surname': 'SURNAME',
+    'firstname': 'FIRSTNAME',
+    'title': 'TITLE',
+    'band': 'BAND',
+    'cost_center': 'CostCenter',
+    'department': 'DEPARTMENT',
+    'position': 'JOBSHORT',
+    'grade_band': 'BAND',
+    'employee_group': 'EMPLOYEEGROUPDESCRIPTION',
+    'employee_subgroup': 'EMPLOYEESUBGROUPDESCRIPTION',
+}
+
+# employee_packages column -> PackageManager package_components key
+COMPONENT_COLUMNS = {
+    'basic_salary': 'basic_salary',
+    'housing_allowance': 'housing_allowance',
+    'transport_allowance': 'transport_allowance',
+    'medical_aid': 'medical_aid',
+    'pension_fund': 'provident_fund',
+    'group_life': 'group_life',
+    'car_allowance': 'car_allowance',
+    'cellphone_allowance': 'cellphone_allowance',
+    'data_service_allowance': 'data_service_allowance',
+    'bonus': 'bonus',
+    'other_allowances': 'other_allowances',
+    'critical_skills': 'critical_skills',
+    'uif': 'uif',
+}
+
+PACKAGE_COLUMNS = (['employee_id', 'upload_id'] + list(COMPONENT_COLUMNS)
+                   + ['current_tctc', 'target_tctc', 'status', 'created_date', 'last_modified', 'submitted_date',
+                      'package_data'])
+
+# employee_packages column -> SAP header for packages created straight from an upload
+INITIAL_PACKAGE_HEADERS = {
+    'basic_salary': 'BASIC',
+    'housing_allowance': 'HOUSING',
+    'transport_allowance': 'TRANSPORT',
+    'medical_aid': 'MEDICAL',
+    'pension_fund': 'PENSIONCONTRIBUTIONFUND',
+    'group_life': 'GROUPLIFEEECONTRIBUTION',
+    'car_allowance': 'CAR',
+    'cellphone_allowance': 'CELLPHONEALLOWANCE',
+    'data_service_allowance': 'DATASERVICEALLOWANCE',
+    'bonus': 'BONUSPROVISION',
+    'other_allowances': 'CASH',
+    'critical_skills': 'CRITICALSKILLS',
+    'uif': 'UIF',
+}
+
+
+def _index_sql(index) -> str:
+    name, table, columns = index
+    return f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'
+
+
+def _number(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _load_stats(rows: int, started: float) -> Dict:
+    seconds = time.perf_counter() - started
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_second': int(rows / seconds) if seconds else rows}
+
+
+def open_connection(db_path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open and configure a connection that waits on writer locks instead of failing"""
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=check_same_thread,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    # WAL lets readers in every worker run alongside a writer; the mode persists in the file
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA busy_timeout = 30000')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    return conn
+
+
+class ConnectionPool:
+    """One configured connection per thread, kept open and reused for every query"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._local = threading.local()
+        self._connections = {}  # thread ident -> (thread, connection)
+        self._pid = os.getpid()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._pid == os.getpid():
+            return conn
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: connections inherited from the parent must not be used
+                self._reset()
+            self._close_finished_threads()
+            # Only its own thread uses it, but it is closed from another once that thread exits
+            conn = open_connection(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._connections[threading.get_ident()] = (threading.current_thread(), conn)
+        return conn
+
+    def _close_finished_threads(self):
+        for ident, (thread, conn) in list(self._connections.items()):
+            if not thread.is_alive():
+                conn.close()
+                del self._connections[ident]
+
+    def close_all(self):
+        with self._lock:
+            for _, conn in self._connections.values():
+                conn.close()
+            self._reset()
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_schema_ready = set()
+_registry_lock = threading.Lock()
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """The process-wide connection pool for a database file"""
+    key = os.path.abspath(db_path)
+    with _registry_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(db_path)
+        return _pools[key]
+
+
+def _schema_key(db_path: str):
+    # The inode catches a database file that was deleted or replaced since it was initialised
+    try:
+        return os.path.abspath(db_path), os.stat(db_path).st_ino
+    except OSError:
+        return None
+
+
+def search_trigger_sql() -> List[str]:
+    """
+    Triggers keeping employee_search on each employee's latest employees row.
+    
+    Ids only grow, so a new row always replaces the employee's previous one
+    in the index, and deleting the latest row puts the one before it back.
+    External-content rows are removed with the 'delete' command and the
+    values they were indexed with.
+    """
+    columns = ', '.join(SEARCH_COLUMNS)
+    latest = 'SELECT MAX(id) FROM employees WHERE employee_id = {}'
+
+    def values(row):
+        return ', '.join(f'{row}.{column}' for column in SEARCH_COLUMNS)
+
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS employees_search_insert AFTER INSERT ON employees BEGIN
+            INSERT INTO employee_search (employee_search, rowid, {columns})
+                SELECT 'delete', id, {columns} FROM employees
+                WHERE id = (SELECT MAX(id) FROM employees WHERE employee_id = new.employee_id AND id < new.id);
+            INSERT INTO employee_search (rowid, {columns}) VALUES (new.id, {values('new')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS employees_search_delete AFTER DELETE ON employees
+        WHEN old.id > IFNULL(({latest.format('old.employee_id')}), 0) BEGIN
+            INSERT INTO employee_search (employee_search, rowid, {columns}) VALUES ('delete', old.id, {values('old')});
+            INSERT INTO employee_search (rowid, {columns})
+                SELECT id, {columns} FROM employees WHERE id = ({latest.format('old.employee_id')});
+        END
+        ''',
+        # employee_id itself is never edited in place; uploads add new rows instead
+        f'''
+        CREATE TRIGGER IF NOT EXISTS employees_search_update
+        AFTER UPDATE OF surname, firstname, department, position ON employees
+        WHEN old.id = ({latest.format('old.employee_id')}) BEGIN
+            INSERT INTO employee_search (employee_search, rowid, {columns}) VALUES ('delete', old.id, {values('old')});
+            INSERT INTO employee_search (rowid, {columns}) VALUES (new.id, {values('new')});
+        END
+        ''',
+    ]
+
+
+SEARCH_TRIGGERS = ('employees_search_insert', 'employees_search_delete', 'employees_search_update')
+
+
+def has_search_index(conn) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'employee_search'").fetchone() is not None
+
+
+def refresh_search_index(conn):
+    """Re-index every employee's latest row from scratch"""
+    conn.execute("INSERT INTO employee_search (employee_search) VALUES ('rebuild')")
+
+
+def _package_stat_values(row: str) -> str:
+    """package_stat_rows values for an employee_packages row, band and department from its SAP data"""
+    return f'''
+        '{DATABASE_STATS_SOURCE}', CAST({row}.id AS TEXT), {row}.employee_id,
+        COALESCE(NULLIF(json_extract({row}.package_data, '$.sap_data.BAND'), ''),
+                 (SELECT band FROM employees WHERE employee_id = {row}.employee_id ORDER BY id DESC LIMIT 1), ''),
+        COALESCE(NULLIF(json_extract({row}.package_data, '$.sap_data.DEPARTMENT'), ''),
+                 (SELECT department FROM employees WHERE employee_id = {row}.employee_id ORDER BY id DESC LIMIT 1), ''),
+        COALESCE({row}.status, ''), COALESCE({row}.upload_id, 0), COALESCE({row}.current_tctc, 0)
+    '''
+
+
+STAT_ROW_COLUMNS = 'source, package_key, employee_id, band, department, status, upload_id, tctc'
+STATS_TRIGGERS = ('package_stat_rows_insert', 'package_stat_rows_delete', 'package_stat_rows_update',
+                  'employee_packages_stats_insert', 'employee_packages_stats_delete',
+                  'employee_packages_stats_update')
+
+
+def stats_trigger_sql() -> List[str]:
+    """
+    Triggers keeping package_stats (count, TCTC sum, min and max per cell)
+    in step with package_stat_rows, and the 'database' rows in step with
+    employee_packages.
+    
+    Adding a row is O(1). Removing one is O(1) too unless it held its cell's
+    minimum or maximum, which is then re-read from the cell's index range.
+    """
+    cell = ', '.join(('source',) + STAT_DIMENSIONS)
+    same_cell = ' AND '.join(f'{column} = old.{column}' for column in ('source',) + STAT_DIMENSIONS)
+    add = f'''
+            INSERT INTO package_stats ({cell}, packages, tctc_sum, tctc_min, tctc_max)
+            VALUES (new.source, {', '.join(f'new.{column}' for column in STAT_DIMENSIONS)}, 1, new.tctc, new.tctc, new.tctc)
+            ON CONFLICT ({cell}) DO UPDATE SET
+                packages = packages + 1,
+                tctc_sum = tctc_sum + excluded.tctc_sum,
+                tctc_min = MIN(tctc_min, excluded.tctc_min),
+                tctc_max = MAX(tctc_max, excluded.tctc_max);
+    '''
+    remove = f'''
+            UPDATE package_stats SET
+                packages = packages - 1,
+                tctc_sum = tctc_sum - old.tctc,
+                tctc_min = CASE WHEN old.tctc <= tctc_min
+                                THEN (SELECT MIN(tctc) FROM package_stat_rows WHERE {same_cell}) ELSE tctc_min END,
+                tctc_max = CASE WHEN old.tctc >= tctc_max
+                                THEN (SELECT MAX(tctc) FROM package_stat_rows WHERE {same_cell}) ELSE tctc_max END
+            WHERE {same_cell};
+            DELETE FROM package_stats WHERE {same_cell} AND packages <= 0;
+    '''
+    remove_database_row = (f"DELETE FROM package_stat_rows WHERE source = '{DATABASE_STATS_SOURCE}' "
+                           f"AND package_key = CAST(old.id AS TEXT);")
+    add_database_row = f"INSERT INTO package_stat_rows ({STAT_ROW_COLUMNS}) VALUES ({_package_stat_values('new')});"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS package_stat_rows_insert AFTER INSERT ON package_stat_rows BEGIN {add} END",
+        f"CREATE TRIGGER IF NOT EXISTS package_stat_rows_delete AFTER DELETE ON package_stat_rows BEGIN {remove} END",
+        f"CREATE TRIGGER IF NOT EXISTS package_stat_rows_update AFTER UPDATE ON package_stat_rows "
+        f"BEGIN {remove} {add} END",
+        f"CREATE TRIGGER IF NOT EXISTS employee_packages_stats_insert AFTER INSERT ON employee_packages "
+        f"BEGIN {add_database_row} END",
+        f"CREATE TRIGGER IF NOT EXISTS employee_packages_stats_delete AFTER DELETE ON employee_packages "
+        f"BEGIN {remove_database_row} END",
+        f"CREATE TRIGGER IF NOT EXISTS employee_packages_stats_update "
+        f"AFTER UPDATE OF employee_id, upload_id, status, current_tctc, package_data ON employee_packages "
+        f"BEGIN {remove_database_row} {add_database_row} END",
+    ]
+
+
+def rebuild_package_stats(conn, file_rows: Optional[Dict[str, List[tuple]]] = None):
+    """
+    Recompute the statistics from scratch, inside the caller's transaction.
+    
+    The 'database' rows are re-read from employee_packages; file_rows
+    replaces the rows of other sources ({source: [package_stat_rows
+    tuples]}), and sources not given keep theirs. Every aggregate is then
+    rebuilt from the rows.
+    """
+    for name in STATS_TRIGGERS:
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    conn.execute('DELETE FROM package_stat_rows WHERE source = ?', (DATABASE_STATS_SOURCE,))
+    conn.execute(f'INSERT INTO package_stat_rows ({STAT_ROW_COLUMNS}) '
+                 f'SELECT {_package_stat_values("p")} FROM employee_packages p')
+    for source, rows in (file_rows or {}).items():
+        conn.execute('DELETE FROM package_stat_rows WHERE source = ?', (source,))
+        conn.executemany(f'INSERT INTO package_stat_rows ({STAT_ROW_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         rows)
+    cell = ', '.join(('source',) + STAT_DIMENSIONS)
+    conn.execute('DELETE FROM package_stats')
+    conn.execute(f'''
+        INSERT INTO package_stats ({cell}, packages, tctc_sum, tctc_min, tctc_max)
+        SELECT {cell}, COUNT(*), SUM(tctc), MIN(tctc), MAX(tctc) FROM package_stat_rows GROUP BY {cell}
+    ''')
+    for sql in stats_trigger_sql():
+        conn.execute(sql)
+
+
+def search_match(query: str) -> str:
+    """FTS5 MATCH expression requiring every word of the query, each as a prefix"""
+    words = re.findall(r'\w+', query or '')[:8]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _search_words(value) -> List[str]:
+    """Lower-case words without diacritics, as the unicode61 tokenizer splits them"""
+    text = unicodedata.normalize('NFKD', str(value or '').lower())
+    return re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)))
+
+
+def search_employee_rows(rows: List[Dict], query: str, limit: int = SEARCH_LIMIT) -> List[Dict]:
+    """
+    The employee_search match over rows in memory, for stores without the
+    employees table. Every word must prefix a word in one of SEARCH_COLUMNS;
+    rank is lower for better matches, weighted like the bm25 ranking.
+    """
+    words = _search_words(query)[:8]
+    if not words:
+        return []
+    found = []
+    for row in rows:
+        columns = {column: _search_words(row.get(column)) for column in SEARCH_COLUMNS}
+        score = 0.0
+        for word in words:
+            weight = max((SEARCH_COLUMNS[column] for column, tokens in columns.items()
+                          if any(token.startswith(word) for token in tokens)), default=0.0)
+            if not weight:
+                break
+            score += weight
+        else:
+            found.append(dict(row, rank=-score))
+    found.sort(key=lambda row: (row['rank'], str(row.get('surname') or ''), str(row.get('firstname') or '')))
+    return found[:limit]
+
+
+def insert_upload(conn, filename: str, file_path: str, employee_data: List[Dict], uploaded_by: str = None,
+                  file_size: int = 0, financial_year: str = None, period: str = None, upload_date: str = None,
+                  status: str = 'ACTIVE', employee_count: int = None) -> int:
+    """Insert one sap_uploads row and return its id"""
+    cursor = conn.execute('''
+        INSERT INTO sap_uploads (filename, file_path, upload_date, uploaded_by, employee_count, file_size,
+                                 status, financial_year, period)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (filename, file_path, upload_date or datetime.now().isoformat(), uploaded_by,
+          len(employee_data) if employee_count is None else employee_count, file_size, status,
+          financial_year, period))
+    return cursor.lastrowid
+
+
+def insert_employees(conn, upload_id: int, employee_data: List[Dict]) -> int:
+    """executemany the employees rows (with the full SAP row as JSON) for one upload"""
+    headers = tuple(EMPLOYEE_COLUMNS.values())
+    conn.executemany(f'''
+        INSERT INTO employees (employee_id, upload_id, {', '.join(EMPLOYEE_COLUMNS)}, sap_data)
+        VALUES (?, ?, {', '.join('?' for _ in headers)}, ?)
+    ''', (
+        (str(emp.get('EMPLOYEECODE') or emp.get('EMPLOYEE') or ''), upload_id)
+        + tuple(str(emp.get(header) or '') for header in headers)
+        + (json.dumps(emp, default=str),)
+        for emp in employee_data
+    ))
+    return len(employee_data)
+
+
+def insert_initial_packages(conn, upload_id: int, employee_data: List[Dict]) -> int:
+    """executemany starting packages taken straight from the SAP columns"""
+    columns = list(INITIAL_PACKAGE_HEADERS)
+    headers = tuple(INITIAL_PACKAGE_HEADERS.values())
+    # TCTC counts every component except UIF
+    tctc_headers = tuple(header for header in headers if header != 'UIF')
+
+    def row(emp):
+        values = tuple(_number(emp.get(header)) for header in headers)
+        return ((str(emp.get('EMPLOYEECODE') or emp.get('EMPLOYEE') or ''), upload_id) + values
+                + (sum(_number(emp.get(header)) for header in tctc_headers),))
+
+    conn.executemany(f'''
+        INSERT INTO employee_packages (employee_id, upload_id, {', '.join(columns)}, current_tctc)
+        VALUES (?, ?, {', '.join('?' for _ in columns)}, ?)
+    ''', (row(emp) for emp in employee_data))
+    return len(employee_data)
+
+
+def package_row(package: Dict) -> tuple:
+    """employee_packages values (PACKAGE_COLUMNS order) for a PackageManager package"""
+    components = package.get('package_components') or {}
+    return ((package.get('employee_id', ''), package.get('sap_upload_id'))
+            + tuple(_number(components.get(component)) for component in COMPONENT_COLUMNS.values())
+            + (_number(package.get('current_tctc')), _number(package.get('tctc_limit', package.get('target_tctc'))),
+               package.get('status', 'DRAFT'), package.get('created_date') or datetime.now().isoformat(),
+               package.get('last_modified'), package.get('submitted_date'), json.dumps(package, default=str)))
+
 class RandwaterDatabase:
     """SQLite database manager for Randwater Calculator with full historic tracking"""
     
     def __init__(self, db_path: str = 'randwater_data.db'):
         self.db_path = db_path
+        self.pool = get_pool(db_path)
         self.init_database()
     
+    def connection(self) -> sqlite3.Connection:
+        """This thread's pooled connection (sqlite3.Row rows); never close it"""
+        return self.pool.connection()
+    
+    def connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        """A dedicated connection outside the pool, for sessions that change its settings"""
+        return open_connection(self.db_path, check_same_thread)
+    
     def init_database(self):
-        """Initialize database with all required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        """Create or upgrade the schema, once per process and only when the stored version is behind"""
+        with _registry_lock:
+            if _schema_key(self.db_path) in _schema_ready:
+                return
+            conn = self.connection()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER NOT NULL,
+                    applied_date DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            if (conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0) < SCHEMA_VERSION:
+                with conn:
+                    self._create_schema(conn.cursor())
+                    conn.execute('INSERT INTO schema_version (version) VALUES (?)', (SCHEMA_VERSION,))
+                print(f"✅ Database initialized: {self.db_path} (schema v{SCHEMA_VERSION})")
+            _schema_ready.add(_schema_key(self.db_path))
+    
+    def _create_schema(self, cursor):
+        """Create all required tables (idempotent) and upgrade older files"""
         # Users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -171,29 +650,156 @@ class RandwaterDatabase:
             )
         ''')
         
-        conn.commit()
-        conn.close()
-        print(f"✅ Database initialized: {self.db_path}")
+        # Materialised package statistics: one row per stored package and source...
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS package_stat_rows (
+                source TEXT NOT NULL,
+                package_key TEXT NOT NULL,
+                employee_id TEXT,
+                band TEXT NOT NULL DEFAULT '',
+                department TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL DEFAULT '',
+                upload_id INTEGER NOT NULL DEFAULT 0,
+                tctc REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (source, package_key)
+            )
+        ''')
+        
+        # ...and their aggregates per source, band, department, status and upload
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS package_stats (
+                source TEXT NOT NULL,
+                band TEXT NOT NULL,
+                department TEXT NOT NULL,
+                status TEXT NOT NULL,
+                upload_id INTEGER NOT NULL,
+                packages INTEGER NOT NULL,
+                tctc_sum REAL NOT NULL,
+                tctc_min REAL,
+                tctc_max REAL,
+                PRIMARY KEY (source, band, department, status, upload_id)
+            )
+        ''')
+        
+        self._upgrade_schema(cursor)
+        self._create_search_index(cursor)
+        rebuild_package_stats(cursor)
+    
+    def _upgrade_schema(self, cursor):
+        """Add columns and indexes that older database files are missing"""
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+            for column, column_type in columns:
+                if column not in existing:
+                    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        for name in DROPPED_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        for index in INDEXES:
+            cursor.execute(_index_sql(index))
+    
+    def _create_search_index(self, cursor):
+        """FTS5 index over each employee's latest row, maintained by triggers"""
+        # The index's content is this view, so 'rebuild' and 'integrity-check' see the same rows
+        cursor.execute('''
+            CREATE VIEW IF NOT EXISTS latest_employees AS
+            SELECT * FROM employees WHERE id IN (SELECT MAX(id) FROM employees GROUP BY employee_id)
+        ''')
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS employee_search USING fts5(
+                    {', '.join(SEARCH_COLUMNS)}, content='latest_employees', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"⚠️  Full-text search unavailable ({e}); employee search will use LIKE")
+            return
+        for sql in search_trigger_sql():
+            cursor.execute(sql)
+        refresh_search_index(cursor)
     
     def migrate_from_json(self):
         """Migrate existing JSON data to SQL database"""
         print("🔄 Starting migration from JSON files to SQL database...")
+        started = time.perf_counter()
         
-        # Migrate users
-        self._migrate_users()
-        
-        # Migrate SAP uploads
-        self._migrate_sap_uploads()
+        # One bulk transaction: everything lands or nothing does
+        with self.bulk_session(['users', 'sap_uploads', 'employees', 'employee_packages',
+                                'employee_access']) as conn:
+            rows = (self._migrate_users(conn) + self._migrate_sap_uploads(conn)
+                    + self._migrate_employee_packages(conn) + self._migrate_employee_access(conn))
         
-        # Migrate employee packages
-        self._migrate_employee_packages()
+        stats = _load_stats(rows, started)
+        print(f"✅ Migration completed successfully! {stats['rows']} rows in {stats['seconds']}s "
+              f"({stats['rows_per_second']:,} rows/sec)")
+        return stats
+    
+    @contextmanager
+    def bulk_session(self, tables: List[str]):
+        """
+        Connection for a large load, committed as one transaction.
         
-        # Migrate employee access
-        self._migrate_employee_access()
+        Durability is relaxed and the page cache enlarged for the load, and the
+        tables' secondary indexes (and the employee search index and package
+        statistics) are dropped and rebuilt once at the end rather than
+        updated row by row.
+        """
+        conn = self.connect()
+        conn.isolation_level = None
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute(f'PRAGMA cache_size = -{BULK_CACHE_KIB}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        deferred = [index for index in INDEXES if index[1] in tables]
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            search = 'employees' in tables and has_search_index(conn)
+            stats = 'employee_packages' in tables
+            for name, _, _ in deferred:
+                conn.execute(f'DROP INDEX IF EXISTS {name}')
+            if search:
+                for name in SEARCH_TRIGGERS:
+                    conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+            if stats:
+                for name in STATS_TRIGGERS:
+                    conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+            yield conn
+            for index in deferred:
+                conn.execute(_index_sql(index))
+            if search:
+                refresh_search_index(conn)
+                for sql in search_trigger_sql():
+                    conn.execute(sql)
+            if stats:
+                rebuild_package_stats(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    def ingest_upload(self, filename: str, file_path: str, employee_data: List[Dict],
+                      uploaded_by: str = None, file_size: int = 0, financial_year: str = None,
+                      period: str = None, initial_packages: bool = False) -> Dict:
+        """
+        Load a whole SAP upload (employee rows and optionally their starting
+        packages) in one transaction; returns the upload id and load rate.
+        """
+        started = time.perf_counter()
+        tables = ['sap_uploads', 'employees'] + (['employee_packages'] if initial_packages else [])
+        with self.bulk_session(tables) as conn:
+            upload_id = insert_upload(conn, filename, file_path, employee_data, uploaded_by, file_size,
+                                      financial_year, period)
+            rows = 1 + insert_employees(conn, upload_id, employee_data)
+            if initial_packages:
+                rows += insert_initial_packages(conn, upload_id, employee_data)
         
-        print("✅ Migration completed successfully!")
+        stats = dict(_load_stats(rows, started), upload_id=upload_id)
+        print(f"✅ Upload {upload_id}: {stats['rows']} rows in {stats['seconds']}s "
+              f"({stats['rows_per_second']:,} rows/sec)")
+        return stats
     
-    def _migrate_users(self):
+    def _migrate_users(self, conn) -> int:
         """Migrate user data"""
         # Default system users
         default_users = [
@@ -213,176 +819,253 @@ class RandwaterDatabase:
             }
         ]
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        for user in default_users:
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (username, password, profile, full_name, email)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user['username'], user['password'], user['profile'], 
-                  user['full_name'], user['email']))
-        
-        conn.commit()
-        conn.close()
+        conn.executemany('''
+            INSERT OR REPLACE INTO users (username, password, profile, full_name, email)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(user['username'], user['password'], user['profile'], user['full_name'], user['email'])
+              for user in default_users])
         print("✅ Users migrated")
+        return len(default_users)
     
-    def _migrate_sap_uploads(self):
-        """Migrate SAP upload data"""
+    def _migrate_sap_uploads(self, conn) -> int:
+        """Migrate SAP upload data, including each upload's employee rows"""
         json_file = 'sap_uploads.json'
         if not os.path.exists(json_file):
             print(f"⚠️  {json_file} not found, skipping SAP uploads migration")
-            return
+            return 0
         
         with open(json_file, 'r') as f:
             uploads = json.load(f)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        rows = 0
         for upload in uploads:
-            cursor.execute('''
-                INSERT INTO sap_uploads 
-                (filename, file_path, upload_date, employee_count, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                upload.get('filename', ''),
-                f"uploads/{upload.get('filename', '')}",
-                upload.get('upload_date', datetime.now().isoformat()),
-                upload.get('employee_count', 0),
-                upload.get('status', 'ACTIVE')
-            ))
-        
-        conn.commit()
-        conn.close()
+            employee_data = upload.get('employee_data') or []
+            upload_id = insert_upload(conn, upload.get('filename', ''), f"uploads/{upload.get('filename', '')}",
+                                      employee_data, None, 0, upload.get('financial_year'), upload.get('period'),
+                                      upload.get('upload_date', datetime.now().isoformat()),
+                                      upload.get('status', 'ACTIVE'), upload.get('employee_count'))
+            rows += 1 + insert_employees(conn, upload_id, employee_data)
+        
         print(f"✅ {len(uploads)} SAP uploads migrated")
+        return rows
     
-    def _migrate_employee_packages(self):
+    def _migrate_employee_packages(self, conn) -> int:
         """Migrate employee package data"""
         json_file = 'employee_packages.json'
         if not os.path.exists(json_file):
             print(f"⚠️  {json_file} not found, skipping employee packages migration")
-            return
+            return 0
         
         with open(json_file, 'r') as f:
             packages = json.load(f)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        for package in packages:
-            components = package.get('package_components', {})
-            cursor.execute('''
-                INSERT INTO employee_packages 
-                (employee_id, basic_salary, housing_allowance, transport_allowance,
-                 medical_aid, pension_fund, group_life, car_allowance, 
-                 cellphone_allowance, data_service_allowance, bonus, 
-                 other_allowances, critical_skills, uif, current_tctc, 
-                 target_tctc, status, created_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                package.get('employee_id', ''),
-                components.get('basic_salary', 0),
-                components.get('housing_allowance', 0),
-                components.get('transport_allowance', 0),
-                components.get('medical_aid', 0),
-                components.get('pension_fund', 0),
-                components.get('group_life', 0),
-                components.get('car_allowance', 0),
-                components.get('cellphone_allowance', 0),
-                components.get('data_service_allowance', 0),
-                components.get('bonus', 0),
-                components.get('other_allowances', 0),
-                components.get('critical_skills', 0),
-                components.get('uif', 0),
-                package.get('current_tctc', 0),
-                package.get('target_tctc', 0),
-                package.get('status', 'DRAFT'),
-                package.get('created_date', datetime.now().isoformat())
-            ))
-        
-        conn.commit()
-        conn.close()
+        conn.executemany(f'''
+            INSERT INTO employee_packages ({', '.join(PACKAGE_COLUMNS)})
+            VALUES ({', '.join('?' for _ in PACKAGE_COLUMNS)})
+        ''', [package_row(package) for package in packages])
+        
         print(f"✅ {len(packages)} employee packages migrated")
+        return len(packages)
     
-    def _migrate_employee_access(self):
+    def _migrate_employee_access(self, conn) -> int:
         """Migrate employee access data"""
         json_file = 'employee_access.json'
         if not os.path.exists(json_file):
             print(f"⚠️  {json_file} not found, skipping employee access migration")
-            return
+            return 0
         
         with open(json_file, 'r') as f:
             access_data = json.load(f)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        for access in access_data:
-            cursor.execute('''
-                INSERT INTO employee_access 
-                (employee_id, access_granted_date, status)
-                VALUES (?, ?, ?)
-            ''', (
-                access.get('employee_id', ''),
-                access.get('access_granted', datetime.now().isoformat()),
-                access.get('status', 'active')
-            ))
-        
-        conn.commit()
-        conn.close()
+        conn.executemany('''
+            INSERT INTO employee_access 
+            (employee_id, access_granted_date, status)
+            VALUES (?, ?, ?)
+        ''', [(access.get('employee_id', ''), access.get('access_granted', datetime.now().isoformat()),
+               access.get('status', 'active')) for access in access_data])
+        
         print(f"✅ {len(access_data)} employee access records migrated")
+        return len(access_data)
     
     # Data access methods
     def get_user(self, username: str) -> Optional[Dict]:
         """Get user by username"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self.connection().cursor()
         
         cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
         row = cursor.fetchone()
-        conn.close()
         
         return dict(row) if row else None
     
     def log_user_login(self, username: str):
         """Log user login"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET last_login = CURRENT_TIMESTAMP, login_count = login_count + 1
-            WHERE username = ?
-        ''', (username,))
+        conn = self.connection()
         
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('''
+                UPDATE users 
+                SET last_login = CURRENT_TIMESTAMP, login_count = login_count + 1
+                WHERE username = ?
+            ''', (username,))
     
     def save_sap_upload(self, filename: str, file_path: str, uploaded_by: str, 
                        employee_count: int, file_size: int) -> int:
         """Save SAP upload record and return upload ID"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self.connection()
         
-        cursor.execute('''
-            INSERT INTO sap_uploads 
-            (filename, file_path, uploaded_by, employee_count, file_size)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (filename, file_path, uploaded_by, employee_count, file_size))
+        with conn:
+            cursor = conn.execute('''
+                INSERT INTO sap_uploads 
+                (filename, file_path, uploaded_by, employee_count, file_size)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (filename, file_path, uploaded_by, employee_count, file_size))
+        
+        return cursor.lastrowid
+    
+    def search_employees(self, query: str, limit: int = SEARCH_LIMIT) -> List[Dict]:
+        """
+        Ranked prefix search over employee number, names, department and position.
+        
+        Every word must match the start of a word in one of those columns.
+        Returns each matching employee's most recent row, best match first.
+        """
+        match = search_match(query)
+        if not match:
+            return []
+        
+        conn = self.connection()
+        weights = ', '.join(str(weight) for weight in SEARCH_COLUMNS.values())
+        if has_search_index(conn):
+            rows = conn.execute('''
+                SELECT e.id, e.employee_id, e.upload_id, e.title, e.firstname, e.surname, e.band,
+                       e.department, e.position, e.cost_center, found.rank
+                FROM (
+                    SELECT rowid, rank FROM employee_search
+                    WHERE employee_search MATCH ? AND rank MATCH ?
+                    ORDER BY rank
+                    LIMIT ?
+                ) found
+                JOIN employees e ON e.id = found.rowid
+                ORDER BY found.rank
+            ''', (match, f'bm25({weights})', limit)).fetchall()
+        else:
+            # SQLite built without FTS5: unranked substring match on the same columns
+            words = re.findall(r'\w+', query)[:8]
+            clauses = ' AND '.join(
+                '(' + ' OR '.join(f'{column} LIKE ?' for column in SEARCH_COLUMNS) + ')' for _ in words)
+            rows = conn.execute(f'''
+                SELECT id, employee_id, upload_id, title, firstname, surname, band, department, position,
+                       cost_center, 0 AS rank
+                FROM employees
+                WHERE id IN (SELECT MAX(id) FROM employees GROUP BY employee_id) AND {clauses}
+                ORDER BY surname, firstname
+                LIMIT ?
+            ''', [f'%{word}%' for word in words for _ in SEARCH_COLUMNS] + [limit]).fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def package_stat_cells(self, sources: Optional[List[str]] = None) -> List[Dict]:
+        """Materialised statistics cells, optionally for some sources only"""
+        conn = self.connection()
+        if sources:
+            rows = conn.execute(f'''
+                SELECT * FROM package_stats WHERE source IN ({', '.join('?' for _ in sources)})
+            ''', list(sources)).fetchall()
+        else:
+            rows = conn.execute('SELECT * FROM package_stats').fetchall()
+        return [dict(row) for row in rows]
+    
+    def record_package_stats(self, source: str, rows: List[tuple]):
+        """Add or replace package_stat_rows for a file-based source (rows in STAT_ROW_COLUMNS order)"""
+        conn = self.connection()
+        with conn:
+            conn.executemany('DELETE FROM package_stat_rows WHERE source = ? AND package_key = ?',
+                             [(source, row[1]) for row in rows])
+            conn.executemany(f'INSERT INTO package_stat_rows ({STAT_ROW_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             [(source,) + tuple(row[1:]) for row in rows])
+    
+    def remove_package_stats(self, source: str, package_keys: Optional[List[str]] = None):
+        """Drop a file-based source's rows (all of them when no keys are given)"""
+        conn = self.connection()
+        with conn:
+            if package_keys is None:
+                conn.execute('DELETE FROM package_stat_rows WHERE source = ?', (source,))
+            else:
+                conn.executemany('DELETE FROM package_stat_rows WHERE source = ? AND package_key = ?',
+                                 [(source, key) for key in package_keys])
+    
+    def rebuild_statistics(self, file_rows: Optional[Dict[str, List[tuple]]] = None) -> int:
+        """Recompute every materialised statistic to repair drift; returns the number of cells"""
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rebuild_package_stats(conn, file_rows)
+        return conn.execute('SELECT COUNT(*) FROM package_stats').fetchone()[0]
+    
+    def insert_audit_rows(self, rows: List[tuple]):
+        """Append audit_log rows: (user_id, action, table_name, record_id, old_data, new_data, user_type, timestamp)"""
+        conn = self.connection()
+        with conn:
+            conn.executemany('''
+                INSERT INTO audit_log (user_id, action, table_name, record_id, old_data, new_data, user_type, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+    
+    def query_audit_log(self, table_name: str = PACKAGE_AUDIT_TABLE, record_id: Optional[str] = None,
+                        start: Optional[str] = None, end: Optional[str] = None, action: Optional[str] = None,
+                        user: Optional[str] = None, after: Optional[tuple] = None,
+                        limit: int = AUDIT_PAGE_SIZE) -> Dict:
+        """
+        One page of audit_log rows, newest first, using keyset pagination.
         
-        upload_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        start is inclusive and end exclusive. after is the (timestamp, id)
+        of the last row of the previous page; the result's 'next' is the
+        value to pass for the following page, or None on the last one.
+        Every filter combination walks an index in (timestamp, id) order, so
+        a page costs the same however long the trail is.
+        """
+        clauses, params = ['table_name = ?'], [table_name]
+        for column, value in (('record_id', record_id), ('action', action), ('user_id', user)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        if start is not None:
+            clauses.append('timestamp >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('timestamp < ?')
+            params.append(end)
+        if after is not None:
+            clauses.append('(timestamp, id) < (?, ?)')
+            params.extend(after)
         
-        return upload_id
+        # Walk the most selective filter's index; the planner has no statistics to choose by
+        if record_id is not None:
+            index = 'idx_audit_log_record_time'
+        elif user is not None:
+            index = 'idx_audit_log_user_time'
+        elif action is not None:
+            index = 'idx_audit_log_action_time'
+        else:
+            index = 'idx_audit_log_time'
+        
+        rows = self.connection().execute(f'''
+            SELECT * FROM audit_log INDEXED BY {index}
+            WHERE {' AND '.join(clauses)}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+        
+        entries = [dict(row) for row in rows[:limit]]
+        more = len(rows) > limit
+        return {
+            'entries': entries,
+            'next': (entries[-1]['timestamp'], entries[-1]['id']) if more else None
+        }
     
     def get_package_history(self, employee_id: str) -> List[Dict]:
         """Get complete history of package changes for an employee"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self.connection().cursor()
         
         cursor.execute('''
             SELECT * FROM package_history 
@@ -390,18 +1073,18 @@ class RandwaterDatabase:
             ORDER BY change_date DESC
         ''', (employee_id,))
         
-        rows = cursor.fetchall()
-        conn.close()
-        
-        return [dict(row) for row in rows]
+        return [dict(row) for row in cursor.fetchall()]
     
     def backup_database(self, backup_path: str = None):
-        """Create a backup of the database"""
+        """Create a consistent backup of the database, including pages still in the WAL"""
         if backup_path is None:
             backup_path = f"randwater_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         
-        import shutil
-        shutil.copy2(self.db_path, backup_path)
+        target = sqlite3.connect(backup_path)
+        try:
+            self.connection().backup(target)
+        finally:
+            target.close()
         print(f"✅ Database backed up to: {backup_path}")
         return backup_path
 
@@ -3,12 +3,133 @@ Database models and data access layer for Randwater Calculator
 Provides SQLite-based data management with full historic tracking
 """
 
-import sqlite3
 import json
 import os
 from datetime import datetime
 from typing import Dict, List, Optional, Any
-from database import RandwaterDatabase
+from database import DATABASE_STATS_SOURCE, RandwaterDatabase
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a package changed since it was read; nothing in the unit of work is written"""
+    
+    def __init__(self, employee_ids: List[str]):
+        self.employee_ids = employee_ids
+        super().__init__(f"Package(s) changed by another user since they were loaded: {', '.join(employee_ids)}")
+
+
+def _history_value(value) -> float:
+    try:
+        return float(value) if value else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+class UnitOfWork:
+    """
+    Collects the package updates, history rows and audit entries for one
+    request and writes them in a single transaction with executemany.
+    
+    Package updates are checked optimistically: each one only applies if
+    the row still has the version it was read at, otherwise the whole unit
+    is rolled back and ConcurrentUpdateError is raised.
+    
+        with db_manager.unit_of_work() as uow:
+            uow.update_package(package, {'car_allowance': 12000}, 'admin')
+            uow.log_audit('PACKAGE_UPDATE', 'employee_packages', employee_id, 'admin', 'Car allowance')
+    """
+    
+    def __init__(self, db: RandwaterDatabase):
+        self.db = db
+        self.package_updates = {}  # package id -> (package, fields, expected version)
+        self.history = []
+        self.audit = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+    
+    def update_package(self, package: Dict, updates: Dict, updated_by: str, reason: str = "",
+                       expected_version: Optional[int] = None):
+        """Queue field changes to a package row read earlier, with a history row per changed field"""
+        changed = {field: value for field, value in updates.items()
+                   if field not in package or package[field] != value}
+        if not changed:
+            return
+        if package['id'] in self.package_updates:
+            # A second change to the same package in this unit joins the first
+            self.package_updates[package['id']][1].update(changed)
+        else:
+            version = (package.get('version') or 0) if expected_version is None else expected_version
+            self.package_updates[package['id']] = (package, changed, version)
+        for field, new_value in changed.items():
+            if field in package:
+                self.history.append((package['id'], package['employee_id'], field, _history_value(package[field]),
+                                     _history_value(new_value), reason, updated_by))
+    
+    def log_audit(self, action: str, table_name: str, record_id: str, user_id: str, details: str):
+        self.audit.append((user_id, action, table_name, record_id, details))
+    
+    def discard(self):
+        self.package_updates, self.history, self.audit = {}, [], []
+    
+    def commit(self):
+        """Flush everything queued in one transaction"""
+        if not (self.package_updates or self.history or self.audit):
+            return
+        now = datetime.now().isoformat()
+        # Updates touching the same columns share one executemany
+        groups = {}
+        for package, fields, version in self.package_updates.values():
+            groups.setdefault(tuple(fields), []).append(
+                tuple(fields.values()) + (now, package['id'], version))
+        
+        conn = self.db.connection()
+        try:
+            with conn:
+                # The write lock is held from here, so the versions cannot move under the check
+                conn.execute('BEGIN IMMEDIATE')
+                stale = self._stale(conn)
+                if stale:
+                    raise ConcurrentUpdateError(stale)
+                for columns, rows in groups.items():
+                    set_clause = ', '.join(f"{column} = ?" for column in columns)
+                    conn.executemany(f'''
+                        UPDATE employee_packages 
+                        SET {set_clause}, last_modified = ?, version = version + 1
+                        WHERE id = ? AND version = ?
+                    ''', rows)
+                
+                conn.executemany('''
+                    INSERT INTO package_history 
+                    (package_id, employee_id, field_name, old_value, 
+                     new_value, change_reason, changed_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', self.history)
+                
+                conn.executemany('''
+                    INSERT INTO audit_log 
+                    (user_id, action, table_name, record_id, new_data)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', self.audit)
+        finally:
+            self.discard()
+    
+    def _stale(self, conn) -> List[str]:
+        """Employees whose package row is gone or no longer at the version it was read at"""
+        stale = []
+        for package_id, (package, _, version) in self.package_updates.items():
+            row = conn.execute('SELECT version FROM employee_packages WHERE id = ?', (package_id,)).fetchone()
+            if row is None or (row['version'] or 0) != version:
+                stale.append(package['employee_id'])
+        return stale
+
 
 class DatabaseManager:
     """Enhanced database manager with Randwater-specific operations"""
@@ -28,92 +149,28 @@ class DatabaseManager:
                                  uploaded_by: str, employee_data: List[Dict]) -> int:
         """Save SAP upload with employee data"""
         file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
-        upload_id = self.db.save_sap_upload(
+        
+        # Upload, employee rows and starting packages in one bulk transaction
+        stats = self.db.ingest_upload(
             filename=filename,
             file_path=file_path,
+            employee_data=employee_data,
             uploaded_by=uploaded_by,
-            employee_count=len(employee_data),
-            file_size=file_size
+            file_size=file_size,
+            initial_packages=True
         )
-        
-        # Save employee data
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        for emp_data in employee_data:
-            # Save employee info
-            cursor.execute('''
-                INSERT OR REPLACE INTO employees 
-                (employee_id, upload_id, surname, firstname, title, band, 
-                 cost_center, department, position, grade_band, 
-                 employee_group, employee_subgroup)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                emp_data.get('EMPLOYEE', ''),
-                upload_id,
-                emp_data.get('SURNAME', ''),
-                emp_data.get('FIRSTNAME', ''),
-                emp_data.get('TITLE', ''),
-                emp_data.get('BAND', ''),
-                emp_data.get('CostCenter', ''),
-                emp_data.get('DEPARTMENT', ''),
-                emp_data.get('JOBSHORT', ''),
-                emp_data.get('BAND', ''),
-                emp_data.get('EMPLOYEEGROUPDESCRIPTION', ''),
-                emp_data.get('EMPLOYEESUBGROUPDESCRIPTION', '')
-            ))
-            
-            # Save initial package
-            cursor.execute('''
-                INSERT OR REPLACE INTO employee_packages 
-                (employee_id, upload_id, basic_salary, housing_allowance, 
-                 transport_allowance, medical_aid, pension_fund, group_life,
-                 car_allowance, cellphone_allowance, data_service_allowance,
-                 bonus, other_allowances, critical_skills, uif, current_tctc)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                emp_data.get('EMPLOYEE', ''),
-                upload_id,
-                float(emp_data.get('BASIC', 0)),
-                float(emp_data.get('HOUSING', 0)),
-                float(emp_data.get('TRANSPORT', 0)),
-                float(emp_data.get('MEDICAL', 0)),
-                float(emp_data.get('PENSIONCONTRIBUTIONFUND', 0)),
-                float(emp_data.get('GROUPLIFEEECONTRIBUTION', 0)),
-                float(emp_data.get('CAR', 0)),
-                float(emp_data.get('CELLPHONEALLOWANCE', 0)),
-                float(emp_data.get('DATASERVICEALLOWANCE', 0)),
-                float(emp_data.get('BONUSPROVISION', 0)),
-                float(emp_data.get('CASH', 0)),
-                float(emp_data.get('CRITICALSKILLS', 0)),
-                float(emp_data.get('UIF', 0)),
-                self._calculate_tctc(emp_data)
-            ))
-        
-        conn.commit()
-        conn.close()
+        upload_id = stats['upload_id']
         
         # Log the upload
         self._log_audit('SAP_UPLOAD', 'sap_uploads', str(upload_id), 
-                       uploaded_by, f"Uploaded {len(employee_data)} employees")
+                       uploaded_by, f"Uploaded {len(employee_data)} employees "
+                                    f"({stats['rows_per_second']:,} rows/sec)")
         
         return upload_id
     
-    def _calculate_tctc(self, emp_data: Dict) -> float:
-        """Calculate Total Cost to Company"""
-        components = [
-            'BASIC', 'HOUSING', 'TRANSPORT', 'MEDICAL', 
-            'PENSIONCONTRIBUTIONFUND', 'GROUPLIFEEECONTRIBUTION',
-            'CAR', 'CELLPHONEALLOWANCE', 'DATASERVICEALLOWANCE',
-            'BONUSPROVISION', 'CASH', 'CRITICALSKILLS'
-        ]
-        return sum(float(emp_data.get(comp, 0)) for comp in components)
-    
     def get_employee_package(self, employee_id: str) -> Optional[Dict]:
         """Get current employee package"""
-        conn = sqlite3.connect(self.db.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self.db.connection().cursor()
         
         cursor.execute('''
             SELECT ep.*, e.surname, e.firstname, e.title, e.department
@@ -125,61 +182,37 @@ class DatabaseManager:
         ''', (employee_id,))
         
         row = cursor.fetchone()
-        conn.close()
         
         return dict(row) if row else None
     
+    def unit_of_work(self) -> UnitOfWork:
+        """Batch a request's writes into one transaction (use as a context manager)"""
+        return UnitOfWork(self.db)
+    
     def update_employee_package(self, employee_id: str, updates: Dict, 
-                               updated_by: str, reason: str = "") -> bool:
-        """Update employee package with full audit trail"""
+                               updated_by: str, reason: str = "",
+                               expected_version: Optional[int] = None) -> bool:
+        """
+        Update employee package with full audit trail.
+        
+        Fields, history and audit land in one transaction. Raises
+        ConcurrentUpdateError if the package changed since expected_version
+        (or since it was read here, when no version is given).
+        """
         current_package = self.get_employee_package(employee_id)
         if not current_package:
             return False
         
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        # Record changes in history
-        for field, new_value in updates.items():
-            if field in current_package:
-                old_value = current_package[field]
-                if old_value != new_value:
-                    cursor.execute('''
-                        INSERT INTO package_history 
-                        (package_id, employee_id, field_name, old_value, 
-                         new_value, change_reason, changed_by)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        current_package['id'], employee_id, field,
-                        float(old_value) if old_value else 0,
-                        float(new_value) if new_value else 0,
-                        reason, updated_by
-                    ))
-        
-        # Update the package
-        set_clause = ', '.join([f"{field} = ?" for field in updates.keys()])
-        values = list(updates.values()) + [datetime.now().isoformat(), employee_id]
-        
-        cursor.execute(f'''
-            UPDATE employee_packages 
-            SET {set_clause}, last_modified = ?
-            WHERE employee_id = ?
-        ''', values)
-        
-        conn.commit()
-        conn.close()
-        
-        # Log the update
-        self._log_audit('PACKAGE_UPDATE', 'employee_packages', employee_id,
-                       updated_by, f"Updated: {', '.join(updates.keys())}")
+        with self.unit_of_work() as uow:
+            uow.update_package(current_package, updates, updated_by, reason, expected_version)
+            uow.log_audit('PACKAGE_UPDATE', 'employee_packages', employee_id,
+                          updated_by, f"Updated: {', '.join(updates.keys())}")
         
         return True
     
     def get_all_uploads(self) -> List[Dict]:
         """Get all SAP uploads with metadata"""
-        conn = sqlite3.connect(self.db.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self.db.connection().cursor()
         
         cursor.execute('''
             SELECT *, 
@@ -190,15 +223,12 @@ class DatabaseManager:
         ''')
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
     def get_employees_by_upload(self, upload_id: int) -> List[Dict]:
         """Get all employees from a specific upload"""
-        conn = sqlite3.connect(self.db.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self.db.connection().cursor()
         
         cursor.execute('''
             SELECT e.*, ep.current_tctc, ep.status as package_status
@@ -209,39 +239,32 @@ class DatabaseManager:
         ''', (upload_id,))
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
     def search_employees(self, search_term: str) -> List[Dict]:
-        """Search employees by ID, name, or department"""
-        conn = sqlite3.connect(self.db.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        """Search employees by ID, name, department or position (full-text, best match first)"""
+        matches = self.db.search_employees(search_term, limit=50)
+        if not matches:
+            return []
         
-        search_term = f"%{search_term}%"
-        cursor.execute('''
+        cursor = self.db.connection().cursor()
+        cursor.execute(f'''
             SELECT e.*, ep.current_tctc, ep.status as package_status
             FROM employees e
             LEFT JOIN employee_packages ep ON e.employee_id = ep.employee_id
-            WHERE e.employee_id LIKE ? 
-               OR e.surname LIKE ? 
-               OR e.firstname LIKE ?
-               OR e.department LIKE ?
-            ORDER BY e.surname, e.firstname
-            LIMIT 50
-        ''', (search_term, search_term, search_term, search_term))
+            WHERE e.id IN ({', '.join('?' for _ in matches)})
+        ''', [match['id'] for match in matches])
         
-        rows = cursor.fetchall()
-        conn.close()
+        # Keep the search ranking
+        order = {match['id']: position for position, match in enumerate(matches)}
+        rows = sorted(cursor.fetchall(), key=lambda row: order[row['id']])
         
         return [dict(row) for row in rows]
     
     def get_audit_trail(self, employee_id: str = None, limit: int = 100) -> List[Dict]:
         """Get audit trail, optionally filtered by employee"""
-        conn = sqlite3.connect(self.db.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self.db.connection().cursor()
         
         if employee_id:
             cursor.execute('''
@@ -258,29 +281,18 @@ class DatabaseManager:
             ''', (limit,))
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
     def _log_audit(self, action: str, table_name: str, record_id: str,
                    user_id: str, details: str):
         """Log audit entry"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO audit_log 
-            (user_id, action, table_name, record_id, new_data)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, action, table_name, record_id, details))
-        
-        conn.commit()
-        conn.close()
+        with self.unit_of_work() as uow:
+            uow.log_audit(action, table_name, record_id, user_id, details)
     
     def get_statistics(self) -> Dict:
         """Get system statistics"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
+        cursor = self.db.connection().cursor()
         
         # Total employees
         cursor.execute('SELECT COUNT(*) FROM employees')
@@ -290,12 +302,13 @@ class DatabaseManager:
         cursor.execute("SELECT COUNT(*) FROM sap_uploads WHERE status = 'ACTIVE'")
         total_uploads = cursor.fetchone()[0]
         
-        # Package statuses
+        # Package statuses, from the materialised statistics
         cursor.execute('''
-            SELECT status, COUNT(*) 
-            FROM employee_packages 
+            SELECT NULLIF(status, ''), SUM(packages)
+            FROM package_stats
+            WHERE source = ?
             GROUP BY status
-        ''')
+        ''', (DATABASE_STATS_SOURCE,))
         package_stats = dict(cursor.fetchall())
         
         # Recent uploads
@@ -305,8 +318,7 @@ class DatabaseManager:
             WHERE upload_date >= datetime('now', '-7 days')
         ''')
         recent_uploads = cursor.fetchone()[0]
-        
-        conn.close()
+
         
         return {
             'total_employees': total_employees,
@@ -0,0 +1,263 @@
+"""
+Net-to-gross solver and net pay curves for Rand Water packages
+Net pay is piecewise linear in any one package input between the PAYE
+bracket, rebate and UIF cap breakpoints, so the input for a target take-home
+is found by locating the segment that contains it and solving one linear
+equation.
+
+Both models follow the payslip rules of the batch engine, where TPE is not
+earnings and only drives pension:
+- the monthly cash salary, solved by /api/gross_up
+- TPE with the CTC fixed, as on the package edit page, where cash is what
+  the CTC leaves after allowances, employer contributions and the bonus
+  provision
+"""
+
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batch_engine import (BONUS_TAX_RATE, TRAVEL_TAXABLE_PORTION, UIF_RATE,
+                          calculate_columns, load_package_columns)
+from money import round_money, round_money_array
+from tax_engine import calculate_rebate, get_tax_table
+
+logger = logging.getLogger(__name__)
+
+
+class GrossUpModel:
+    """
+    Continuous monthly take-home as a function of one package input x.
+
+    Earnings, monthly taxable income, the employee's non-tax deductions and
+    cash are each linear in x, held as (base, slope). upper is the largest
+    valid x, if any.
+    """
+
+    def __init__(self, row: Dict[str, float], settings: Dict, earnings: Tuple[float, float],
+                 taxable: Tuple[float, float], deductions: Tuple[float, float], cash: Tuple[float, float],
+                 upper: Optional[float] = None):
+        self.table = get_tax_table(settings)
+        self.earnings = earnings
+        self.taxable = taxable
+        self.deductions = deductions
+        self.cash = cash
+        self.upper = upper
+        self.uif_ceiling = float(settings.get('uif_ceiling', 177.12))
+        self.bonus_tax = row['bonus'] * BONUS_TAX_RATE / 12
+
+        credits = 0.0
+        if row['medical_employee'] > 0:
+            first_two = min(row['main_members'] + row['first_dependants'], 2)
+            credits = (first_two * settings.get('medical_main', 364)
+                       + row['additional_dependants'] * settings.get('medical_additional', 246)) * 12
+        self.tax_relief = calculate_rebate(row['age'], settings) + credits
+
+    @classmethod
+    def for_cash(cls, row: Dict[str, float], rates: Dict[str, float], settings: Dict) -> 'GrossUpModel':
+        """
+        x is the monthly cash salary. Pension and group life are rates of the
+        row's TPE; with no TPE the cash salary is pensionable, as the
+        simulator's basic salary is.
+        """
+        allowances = row['car'] + row['housing'] + row['cellphone'] + row['data_service']
+        allowances_taxable = (row['car'] * TRAVEL_TAXABLE_PORTION + row['housing']
+                              + row['cellphone'] + row['data_service'])
+        ee_share = rates['pension_employee'] + rates['group_life_employee']
+        pension_share = rates['pension_employee'] + rates['pension_employer']
+        if row['tpe'] > 0:
+            taxable = (allowances_taxable - pension_share * row['tpe'], 1.0)
+            deductions = (row['medical_employee'] + ee_share * row['tpe'], 0.0)
+        else:
+            if pension_share >= 1:
+                raise ValueError("Pension rates leave no taxable cash salary")
+            taxable = (allowances_taxable, 1 - pension_share)
+            deductions = (row['medical_employee'], ee_share)
+        return cls(row, settings, (allowances, 1.0), taxable, deductions, (0.0, 1.0))
+
+    @classmethod
+    def for_tpe(cls, row: Dict[str, float], rates: Dict[str, float], ctc: float,
+                settings: Dict) -> 'GrossUpModel':
+        """
+        x is TPE with a fixed monthly CTC. Cash is CTC less the allowances,
+        medical ER, pension and group life ER (rates of TPE) and the monthly
+        bonus provision, so TPE runs from zero to where cash runs out.
+        """
+        er_share = rates['pension_employer'] + rates['group_life_employer']
+        allowances = row['car'] + row['housing'] + row['cellphone'] + row['data_service']
+        cash = ctc - allowances - row['medical_employer'] - row['bonus'] / 12
+        if cash < 0:
+            raise ValueError("CTC does not cover the allowances and bonus provision")
+        taxable = (cash + row['housing'] + row['cellphone'] + row['data_service']
+                   + row['car'] * TRAVEL_TAXABLE_PORTION,
+                   -(er_share + rates['pension_employee'] + rates['pension_employer']))
+        deductions = (row['medical_employee'], rates['pension_employee'] + rates['group_life_employee'])
+        return cls(row, settings, (cash + allowances, -er_share), taxable, deductions, (cash, -er_share),
+                   upper=cash / er_share if er_share > 0 else None)
+
+    @staticmethod
+    def _at(line: Tuple[float, float], x: float) -> float:
+        return line[0] + line[1] * x
+
+    def taxable_annual(self, x: float) -> float:
+        return self._at(self.taxable, x) * 12
+
+    def cash_at(self, x: float) -> float:
+        return self._at(self.cash, x)
+
+    def evaluate(self, x: float) -> Tuple[float, float, float]:
+        """Monthly (UIF, total tax, take-home) at x, before rounding to cents"""
+        earnings = self._at(self.earnings, x)
+        uif = min(earnings * UIF_RATE, self.uif_ceiling)
+        annual_tax = max(self.table.tax(self.taxable_annual(x)) - self.tax_relief, 0)
+        tax = annual_tax / 12 + self.bonus_tax
+        net = earnings - uif - tax - self._at(self.deductions, x)
+        return uif, tax, net
+
+    def net_pay(self, x: float) -> float:
+        """Monthly take-home at x, before rounding to cents"""
+        return self.evaluate(x)[2]
+
+    def breakpoints(self) -> List[float]:
+        """Values of x where the slope of net pay changes, ending at upper when there is one"""
+        taxable_points = [0.0] + list(self.table.thresholds)
+        # Where gross tax first exceeds rebates and credits
+        for i, (lower, base, rate) in enumerate(zip(self.table.thresholds, self.table.bases, self.table.rates)):
+            upper = self.table.thresholds[i + 1] if i + 1 < len(self.table.thresholds) else float('inf')
+            if rate > 0:
+                point = lower + (self.tax_relief - base) / rate
+                if lower <= point < upper:
+                    taxable_points.append(point)
+                    break
+
+        points = []
+        if self.taxable[1]:
+            points.extend((t / 12 - self.taxable[0]) / self.taxable[1] for t in taxable_points)
+        if self.earnings[1]:
+            points.append((self.uif_ceiling / UIF_RATE - self.earnings[0]) / self.earnings[1])
+        points = [p for p in points if p > 0 and (self.upper is None or p < self.upper)]
+        if self.upper is not None and self.upper > 0:
+            points.append(self.upper)
+        return sorted(set(points))
+
+    def solve(self, target_net: float) -> float:
+        """Smallest x that produces the target monthly take-home"""
+        points = [0.0] + self.breakpoints()
+        nets = [self.net_pay(x) for x in points]
+        for low, high, net_low, net_high in zip(points, points[1:], nets, nets[1:]):
+            if min(net_low, net_high) <= target_net <= max(net_low, net_high):
+                if net_high == net_low:
+                    return low
+                return low + (target_net - net_low) * (high - low) / (net_high - net_low)
+
+        if self.upper is None:
+            # Beyond the last breakpoint net pay is linear with a constant slope
+            low, net_low = points[-1], nets[-1]
+            slope = self.net_pay(low + 1.0) - net_low
+            if slope and (target_net - net_low) / slope >= 0:
+                return low + (target_net - net_low) / slope
+            raise ValueError(f"Target is below the lowest reachable take-home (R{min(nets):,.2f})")
+        raise ValueError(f"Target is outside the reachable take-home range "
+                         f"(R{min(nets):,.2f} to R{max(nets):,.2f})")
+
+
+def net_pay_curve(model: GrossUpModel) -> Dict:
+    """
+    Piecewise-linear take-home curve over TPE (a GrossUpModel.for_tpe model).
+
+    Values between consecutive points are exact linear interpolations. The
+    last point is max_tpe, where cash runs out; without one, each series
+    continues with the matching *_slope.
+    """
+    points = [0.0] + model.breakpoints()
+    uif, tax, net = zip(*(model.evaluate(tpe) for tpe in points))
+    step = 1000.0
+    end_uif, end_tax, end_net = model.evaluate(points[-1] + step)
+    return {
+        'tpe': [round(tpe, 4) for tpe in points],
+        'cash': [round(model.cash_at(tpe), 4) for tpe in points],
+        'uif': [round(value, 4) for value in uif],
+        'total_tax': [round(value, 4) for value in tax],
+        'net_pay': [round(value, 4) for value in net],
+        'max_tpe': round(model.upper, 4) if model.upper is not None else None,
+        'uif_slope': round((end_uif - uif[-1]) / step, 10),
+        'total_tax_slope': round((end_tax - tax[-1]) / step, 10),
+        'net_pay_slope': round((end_net - net[-1]) / step, 10),
+    }
+
+
+def solve_gross_up_batch(targets: List, rates: List[Dict[str, float]],
+                         settings: Optional[Dict] = None) -> Tuple[List[Dict], Dict[int, str]]:
+    """
+    Solve the monthly cash salary for each target row and verify the result
+    with the batch engine.
+
+    Each row carries target_net plus the fixed components accepted by the
+    batch net pay API; its tpe (the cash salary when omitted) sets pension
+    and group life. rates holds per-row pension and group life rates as
+    fractions of TPE. Returns (results, errors by row index).
+    """
+    settings = settings or {}
+    employee_ids, columns, errors = load_package_columns(targets)
+    cash = np.zeros(len(targets), dtype=np.float64)
+
+    for i, target in enumerate(targets):
+        if i in errors:
+            continue
+        if target.get('target_net') is None:
+            errors[i] = 'target_net is required'
+            continue
+        try:
+            target_net = float(target['target_net'])
+        except (TypeError, ValueError):
+            target_net = float('nan')
+        if not -float('inf') < target_net < float('inf'):
+            errors[i] = 'target_net must be a number'
+            continue
+        try:
+            row = {field: float(column[i]) for field, column in columns.items()}
+            cash[i] = round_money(GrossUpModel.for_cash(row, rates[i], settings).solve(target_net))
+        except ValueError as e:
+            errors[i] = str(e)
+
+    # Run the solved packages forward so the reported figures match net pay exactly
+    tpe = np.where(columns['tpe'] > 0, columns['tpe'], cash)
+    rate = {key: np.array([r.get(key, 0.0) for r in rates]) for key in
+            ('pension_employee', 'pension_employer', 'group_life_employee', 'group_life_employer')}
+    columns.update({
+        'tpe': tpe,
+        'cash': cash,
+        'pension_employee': round_money_array(rate['pension_employee'] * tpe, 'pension'),
+        'pension_employer': round_money_array(rate['pension_employer'] * tpe, 'pension'),
+        'group_life_employee': round_money_array(rate['group_life_employee'] * tpe, 'group_life'),
+        'group_life_employer': round_money_array(rate['group_life_employer'] * tpe, 'group_life'),
+        'sap_uif': np.zeros(len(targets)),
+    })
+    outputs = calculate_columns(columns, settings)
+    # Cost to company as the package edit page builds it
+    ctc = (outputs['total_earnings'] + columns['pension_employer'] + columns['group_life_employer']
+           + columns['medical_employer'] + columns['bonus'] / 12)
+
+    results = []
+    for i, employee_id in enumerate(employee_ids):
+        if i in errors:
+            results.append({'index': i, 'employee_id': employee_id, 'success': False, 'error': errors[i]})
+            continue
+        results.append({
+            'index': i,
+            'employee_id': employee_id,
+            'success': True,
+            'target_net': round_money(targets[i]['target_net']),
+            'cash': float(cash[i]),
+            'tpe': float(tpe[i]),
+            'ctc': round_money(ctc[i]),
+            'total_earnings': float(outputs['total_earnings'][i]),
+            'pension_employee': float(columns['pension_employee'][i]),
+            'pension_employer': float(columns['pension_employer'][i]),
+            'group_life_employee': float(columns['group_life_employee'][i]),
+            'uif_employee': float(outputs['uif_employee'][i]),
+            'total_tax': float(outputs['total_tax'][i]),
+            'net_pay': float(outputs['net_pay'][i]),
+        })
+    return results, errors
@@ -0,0 +1,334 @@
+"""
+Impact recompute for tax, pension, group life and medical rate changes
+Works out which stored drafts and submitted packages a proposed configuration
+change can affect, recomputes only those in one batch, and returns a
+field-by-field diff that can be reviewed before the change is applied.
+
+A configuration is a dict with:
+
+    {"tax": settings, "pension": {option: (ee %, er %)},
+     "group_life": {option: {"employee": %, "employer": %}}, "medical": load_medical_aid_rates()}
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from batch_engine import (DEPENDANT_COLUMNS, MEDICAL_MEMBER_COLUMNS, UIF_RATE, calculate_columns, load_columns,
+                          medical_dependants, sap_column)
+from money import round_money, round_money_array
+from option_matrix import medical_options
+from tax_engine import get_tax_table, rebate_array
+
+logger = logging.getLogger(__name__)
+
+DRAFTS_DIR = 'drafts'
+SUBMITTED_PACKAGES_FILE = 'submitted_packages.json'
+
+# Previews awaiting apply, one file each so every worker can apply them
+IMPACT_PREVIEW_DIR = 'impact_previews'
+IMPACT_PREVIEW_LIMIT = 20
+PREVIEW_ID_PATTERN = re.compile(r'^[0-9a-f]{24}$')
+
+# Stored package component -> batch engine column
+COMPONENT_FIELDS = {
+    'tpe': 'tpe',
+    'cash_component': 'cash',
+    'car_allowance': 'car',
+    'housing_allowance': 'housing',
+    'cellphone_allowance': 'cellphone',
+    'data_service_allowance': 'data_service',
+    'bonus': 'bonus',
+    'pension_ee': 'pension_employee',
+    'pension_er': 'pension_employer',
+    'medical_ee': 'medical_employee',
+    'medical_er': 'medical_employer',
+    'group_life_ee': 'group_life_employee',
+    'group_life_er': 'group_life_employer',
+}
+
+# Components rewritten by a recompute
+DERIVED_FIELDS = ('pension_ee', 'pension_er', 'group_life_ee', 'group_life_er', 'medical_ee',
+                  'cash_component', 'uif', 'tax')
+
+MEDICAL_CREDIT_KEYS = ('medical_main', 'medical_first', 'medical_additional')
+REBATE_KEYS = ('rebate_primary', 'rebate_secondary', 'rebate_tertiary')
+
+
+def stored_packages(drafts_dir: str = DRAFTS_DIR, submitted_file: str = SUBMITTED_PACKAGES_FILE) -> List[Dict]:
+    """Every draft and submitted package with its package components"""
+    packages = []
+    if os.path.isdir(drafts_dir):
+        for name in sorted(os.listdir(drafts_dir)):
+            if not (name.startswith('package_') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(drafts_dir, name), 'r') as f:
+                    draft = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable draft {name}: {str(e)}")
+                continue
+            packages.append({'source': 'draft', 'employee_id': str(draft.get('employee_id', name[8:-5])),
+                             'package_components': draft.get('package_components') or {}})
+
+    if os.path.exists(submitted_file):
+        with open(submitted_file, 'r') as f:
+            for package in json.load(f):
+                if package.get('status') == 'submitted':
+                    packages.append({'source': 'submitted', 'employee_id': str(package.get('employee_id')),
+                                     'package_components': package.get('package_components') or {}})
+    return packages
+
+
+def _changed_keys(old: Dict, new: Dict) -> set:
+    return {key for key in set(old) | set(new) if old.get(key) != new.get(key)}
+
+
+def _bracket_bound(old_settings: Dict, new_settings: Dict) -> Optional[float]:
+    """Lowest annual taxable income whose gross tax can differ between two bracket tables"""
+    old, new = get_tax_table(old_settings), get_tax_table(new_settings)
+    old_rows = list(zip(old.thresholds, old.bases, old.rates))
+    new_rows = list(zip(new.thresholds, new.bases, new.rates))
+    for i in range(max(len(old_rows), len(new_rows))):
+        old_row = old_rows[i] if i < len(old_rows) else None
+        new_row = new_rows[i] if i < len(new_rows) else None
+        if old_row != new_row:
+            return min(row[0] for row in (old_row, new_row) if row is not None)
+    return None
+
+
+def _package_columns(packages: List[Dict], sap_rows: Dict[str, Dict]) -> Dict[str, np.ndarray]:
+    """Batch engine columns from stored components, with age, members and dependants from SAP"""
+    sap = load_columns([sap_rows.get(package['employee_id']) or {} for package in packages])
+    columns = {field: sap[field] for field in ('age', *MEDICAL_MEMBER_COLUMNS, *DEPENDANT_COLUMNS)}
+    components = [package['package_components'] for package in packages]
+    for key, field in COMPONENT_FIELDS.items():
+        columns[field] = sap_column(components, key)
+    # Recomputed UIF replaces whatever was stored
+    columns['sap_uif'] = np.zeros(len(packages))
+    return columns
+
+
+def _medical_keys(packages: List[Dict]) -> List[str]:
+    keys = []
+    for package in packages:
+        components = package['package_components']
+        provider, option = components.get('medical_provider'), components.get('medical_option')
+        keys.append(f'{provider}/{option}' if provider and option else '')
+    return keys
+
+
+def impact_diff(packages: List[Dict], sap_rows: Dict[str, Dict], old_config: Dict, new_config: Dict) -> Dict:
+    """
+    Dry-run diff of a configuration change over stored packages.
+
+    Each affected package lists the reasons it was selected and the derived
+    components whose values change. The CTC is held fixed, so employer
+    contribution changes come out of cash_component.
+    """
+    count = len(packages)
+    result = {'checked': count, 'affected': 0, 'changed': 0, 'reasons': {}, 'changes': []}
+    if not count:
+        return result
+
+    columns = _package_columns(packages, sap_rows)
+    components = [package['package_components'] for package in packages]
+    reasons = {}
+
+    def flag(name: str, mask: np.ndarray):
+        if mask.any():
+            reasons[name] = mask
+
+    pension_options = np.array([str(c.get('pension_option', 'B')).upper() for c in components])
+    group_life_options = np.array([str(c.get('group_life_option', 'standard')).lower() for c in components])
+    medical_keys = np.array(_medical_keys(packages))
+
+    changed = _changed_keys(old_config['pension'], new_config['pension'])
+    flag('pension_rates', np.isin(pension_options, list(changed)))
+    changed = _changed_keys(old_config['group_life'], new_config['group_life'])
+    flag('group_life_rates', np.isin(group_life_options, list(changed)))
+    old_medical, new_medical = medical_options(old_config['medical']), medical_options(new_config['medical'])
+    changed = _changed_keys(old_medical, new_medical)
+    flag('medical_rates', np.isin(medical_keys, list(changed)) & (medical_keys != ''))
+
+    # New contributions first, since they feed taxable income
+    tpe = columns['tpe']
+    new_columns = dict(columns)
+    pension_rates = np.array([new_config['pension'].get(option, (0, 0)) for option in pension_options],
+                             dtype=np.float64).reshape(count, 2)
+    group_life_rates = np.array([[new_config['group_life'].get(option, {}).get('employee', 0),
+                                  new_config['group_life'].get(option, {}).get('employer', 0)]
+                                 for option in group_life_options], dtype=np.float64).reshape(count, 2)
+    for name, rates, ee, er, rule in (('pension_rates', pension_rates, 'pension_employee', 'pension_employer',
+                                       'pension'),
+                                      ('group_life_rates', group_life_rates, 'group_life_employee',
+                                       'group_life_employer', 'group_life')):
+        if name in reasons:
+            mask = reasons[name]
+            new_columns[ee] = np.where(mask, round_money_array(tpe * rates[:, 0] / 100, rule), columns[ee])
+            new_columns[er] = np.where(mask, round_money_array(tpe * rates[:, 1] / 100, rule), columns[er])
+    new_columns['cash'] = (columns['cash']
+                           - (new_columns['pension_employer'] - columns['pension_employer'])
+                           - (new_columns['group_life_employer'] - columns['group_life_employer']))
+    if 'medical_rates' in reasons:
+        bands = np.array([c.get('band_range', 'o_to_q') for c in components])
+        multiplier = np.where(bands == 'o_to_q', 1.0, 0.33)
+        rates = [new_medical.get(key, {}) for key in medical_keys]
+        adults, children = medical_dependants(columns)
+        cost = (np.array([r.get('main_member', 0) for r in rates], dtype=np.float64)
+                + np.array([r.get('spouse', 0) for r in rates], dtype=np.float64) * adults
+                + np.array([r.get('child', 0) for r in rates], dtype=np.float64) * children)
+        new_columns['medical_employee'] = np.where(reasons['medical_rates'],
+                                                   round_money_array(cost * multiplier, 'medical'),
+                                                   columns['medical_employee'])
+
+    # Tax rules: only employees whose income reaches a changed part of the rules
+    old_tax, new_tax = old_config['tax'], new_config['tax']
+    taxable = calculate_columns(new_columns, new_tax)['taxable_income_annual']
+    bound = _bracket_bound(old_tax, new_tax)
+    if bound is not None:
+        flag('tax_brackets', taxable > bound)
+    if any(old_tax.get(key) != new_tax.get(key) for key in REBATE_KEYS):
+        old_rebate, new_rebate = rebate_array(columns['age'], old_tax), rebate_array(columns['age'], new_tax)
+        gross = get_tax_table(new_tax).tax_array(taxable)
+        flag('rebates', (old_rebate != new_rebate) & (gross > np.minimum(old_rebate, new_rebate)))
+    if any(old_tax.get(key) != new_tax.get(key) for key in MEDICAL_CREDIT_KEYS):
+        flag('medical_credits', new_columns['medical_employee'] > 0)
+    old_ceiling, new_ceiling = float(old_tax.get('uif_ceiling', 177.12)), float(new_tax.get('uif_ceiling', 177.12))
+    if old_ceiling != new_ceiling:
+        earnings = (new_columns['cash'] + new_columns['car'] + new_columns['housing']
+                    + new_columns['cellphone'] + new_columns['data_service'])
+        flag('uif_ceiling', earnings * UIF_RATE > min(old_ceiling, new_ceiling))
+
+    affected = np.zeros(count, dtype=bool)
+    for mask in reasons.values():
+        affected |= mask
+    result['affected'] = int(affected.sum())
+    result['reasons'] = {name: int(mask.sum()) for name, mask in reasons.items()}
+    if not affected.any():
+        return result
+
+    # Recompute the affected packages only
+    index = np.flatnonzero(affected)
+    subset = {field: column[index] for field, column in new_columns.items()}
+    outputs = calculate_columns(subset, new_tax)
+    new_values = {
+        'pension_ee': subset['pension_employee'],
+        'pension_er': subset['pension_employer'],
+        'group_life_ee': subset['group_life_employee'],
+        'group_life_er': subset['group_life_employer'],
+        'medical_ee': subset['medical_employee'],
+        'cash_component': subset['cash'],
+        'uif': outputs['uif_employee'],
+        'tax': outputs['total_tax'],
+    }
+
+    for position, i in enumerate(index):
+        package = packages[i]
+        changes = {}
+        for field in DERIVED_FIELDS:
+            old_value = round_money(sap_column([components[i]], field)[0])
+            new_value = round_money(new_values[field][position])
+            if abs(new_value - old_value) >= 0.01:
+                changes[field] = {'old': old_value, 'new': new_value}
+        if changes:
+            result['changes'].append({
+                'employee_id': package['employee_id'],
+                'source': package['source'],
+                'reasons': [name for name, mask in reasons.items() if mask[i]],
+                'changes': changes
+            })
+    result['changed'] = len(result['changes'])
+    return result
+
+
+def diff_fingerprint(diff: Dict) -> str:
+    """Hash identifying a dry-run diff, used to confirm an apply matches its preview"""
+    payload = json.dumps(diff['changes'], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def persist_changes(changes: List[Dict], drafts_dir: str = DRAFTS_DIR,
+                    submitted_file: str = SUBMITTED_PACKAGES_FILE) -> int:
+    """Write recomputed components back to drafts and submitted packages"""
+    updates = {}
+    for change in changes:
+        new_values = {field: values['new'] for field, values in change['changes'].items()}
+        updates[(change['source'], change['employee_id'])] = new_values
+
+    written = 0
+    for (source, employee_id), new_values in updates.items():
+        if source != 'draft':
+            continue
+        path = os.path.join(drafts_dir, f'package_{employee_id}.json')
+        with open(path, 'r') as f:
+            draft = json.load(f)
+        draft.setdefault('package_components', {}).update(new_values)
+        with open(path, 'w') as f:
+            json.dump(draft, f, indent=2)
+        written += 1
+
+    submitted_updates = {employee_id: values for (source, employee_id), values in updates.items()
+                         if source == 'submitted'}
+    if submitted_updates:
+        with open(submitted_file, 'r') as f:
+            submitted = json.load(f)
+        for package in submitted:
+            new_values = submitted_updates.get(str(package.get('employee_id')))
+            if new_values and package.get('status') == 'submitted':
+                package.setdefault('package_components', {}).update(new_values)
+                written += 1
+        with open(submitted_file, 'w') as f:
+            json.dump(submitted, f, indent=2)
+    return written
+
+
+def _preview_path(preview_id: str, preview_dir: str) -> Optional[str]:
+    if not PREVIEW_ID_PATTERN.match(str(preview_id or '')):
+        return None
+    return os.path.join(preview_dir, f'{preview_id}.json')
+
+
+def save_preview(preview_id: str, preview: Dict, preview_dir: str = IMPACT_PREVIEW_DIR,
+                 limit: int = IMPACT_PREVIEW_LIMIT):
+    """Store a preview for apply, dropping the oldest beyond limit"""
+    os.makedirs(preview_dir, exist_ok=True)
+    path = _preview_path(preview_id, preview_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(preview, f)
+    os.replace(tmp_path, path)
+
+    previews = sorted((entry for entry in os.scandir(preview_dir) if entry.name.endswith('.json')),
+                      key=lambda entry: entry.stat().st_mtime_ns)
+    for entry in previews[:-limit]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # another worker pruned it first
+
+
+def load_preview(preview_id: str, preview_dir: str = IMPACT_PREVIEW_DIR) -> Optional[Dict]:
+    """A stored preview, or None when it is unknown or has been applied or pruned"""
+    path = _preview_path(preview_id, preview_dir)
+    if path is None:
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def discard_preview(preview_id: str, preview_dir: str = IMPACT_PREVIEW_DIR):
+    path = _preview_path(preview_id, preview_dir)
+    if path is not None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -3,10 +3,24 @@ from typing import Dict, List, Optional
 import json
 import os
 import logging
+import threading
+
+from budget_rules import check_package
+from db_models import ConcurrentUpdateError
+from package_journal import (COMPACT_AFTER_RECORDS, PACKAGE_JOURNAL_FILE, PackageJournal, apply_record,
+                             read_snapshot, write_snapshot)
+from package_stats import PackageStats, manager_package_stat, summarise
+from money import from_cents, round_money, sum_money, to_cents
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Journal record op -> snapshot it changes
+JOURNAL_FILES = {'package_add': 'packages', 'package_update': 'packages', 'packages_clear': 'packages',
+                 'audit': 'audit', 'sap_upload': 'sap_uploads', 'sap_upload_update': 'sap_uploads',
+                 'sap_employee_update': 'sap_uploads', 'sap_upload_remove': 'sap_uploads',
+                 'sap_uploads_clear': 'sap_uploads'}
+
 class EmployeeAccess:
     """Employee access management for Package Builder"""
     
@@ -110,6 +124,9 @@ class PackageManager:
         self.packages_file = 'employee_packages.json'
         self.sap_uploads_file = 'sap_uploads.json'
         self.audit_file = 'randwater_package_audit.json'
+        self.journal = PackageJournal(PACKAGE_JOURNAL_FILE)
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
         self.load_data()
     
     def load_data(self):
@@ -146,17 +163,108 @@ class PackageManager:
         except (json.JSONDecodeError, ValueError) as e:
             print(f"Warning: Corrupted audit trail file, reinitializing: {e}")
             self.audit_trail = []
+        
+        # Changes made since the last compaction
+        replayed = self.journal.replay(
+            lambda record: apply_record(record, self.packages, self.sap_uploads, self.audit_trail))
+        if replayed:
+            logger.info(f"Replayed {replayed} package journal record(s)")
+        
+        self.stats = PackageStats()
+        self.rebuild_statistics()
     
     def save_data(self):
-        """Save package and SAP upload data"""
-        with open(self.packages_file, 'w') as f:
-            json.dump(self.packages, f, indent=2)
-        
-        with open(self.sap_uploads_file, 'w') as f:
-            json.dump(self.sap_uploads, f, indent=2)
+        """Fold the journal into the snapshot files now (every change is already journalled)"""
+        self.compact()
+    
+    def _record(self, record: Dict):
+        """Journal one change; compaction runs in the background once the journal grows"""
+        self.journal.append(record)
+        if self.journal.records >= COMPACT_AFTER_RECORDS and not self._compact_lock.locked():
+            threading.Thread(target=self.compact, daemon=True).start()
+    
+    def compact(self):
+        """
+        Fold the journal into the snapshot files that it changes.
         
-        with open(self.audit_file, 'w') as f:
-            json.dump(self.audit_trail, f, indent=2)
+        Snapshots are rebuilt from disk plus the whole journal rather than
+        from this worker's lists, so records other workers appended are kept.
+        """
+        paths = {'packages': self.packages_file, 'sap_uploads': self.sap_uploads_file, 'audit': self.audit_file}
+        with self._compact_lock, self.journal.locked():
+            merged = {name: read_snapshot(path) for name, path in paths.items()}
+            changed = set()
+            
+            def replay(record):
+                apply_record(record, merged['packages'], merged['sap_uploads'], merged['audit'])
+                changed.add(JOURNAL_FILES.get(record.get('op'), 'packages'))
+            
+            self.journal.replay(replay)
+            for name in changed:
+                write_snapshot(paths[name], json.dumps(merged[name], indent=2))
+            self.journal.clear()
+    
+    # Persistence hooks; SqlPackageManager (package_store.py) writes rows instead
+    def _save_upload(self, upload_record: Dict):
+        # The id is issued and journalled under the journal lock, so the journal stays in id order
+        with self._lock, self.journal.locked():
+            known = max((int(upload.get('id') or 0) for upload in self.sap_uploads), default=0)
+            upload_record['id'] = self.journal.next_id('sap_upload', known)
+            self.sap_uploads.append(upload_record)
+            self._record({'op': 'sap_upload', 'upload': upload_record})
+    
+    def _save_new_package(self, package: Dict):
+        with self._lock:
+            self.packages.append(package)
+            self.stats.set(*manager_package_stat(package))
+            self._record({'op': 'package_add', 'package': package})
+    
+    def _save_package_update(self, package: Dict, components: Dict, previous: Dict):
+        self.stats.set(*manager_package_stat(package))
+        self._record({
+            'op': 'package_update',
+            'employee_id': package['employee_id'],
+            'components': components,
+            'set': {'current_tctc': package['current_tctc'], 'last_modified': package['last_modified']}
+        })
+    
+    def _save_package_fields(self, package: Dict, fields: tuple):
+        self.stats.set(*manager_package_stat(package))
+        self._record({
+            'op': 'package_update',
+            'employee_id': package['employee_id'],
+            'set': {key: package[key] for key in fields}
+        })
+    
+    def _save_audit_entry(self, audit_entry: Dict):
+        with self._lock, self.journal.locked():
+            known = int(self.audit_trail[-1].get('audit_id') or 0) if self.audit_trail else 0
+            audit_entry['audit_id'] = self.journal.next_id('audit', known)
+            self.audit_trail.append(audit_entry)
+            self._record({'op': 'audit', 'entry': audit_entry})
+    
+    def update_sap_employee(self, upload: Dict, employee_id: str, fields: Dict) -> bool:
+        """Change SAP columns on one employee's row of an upload; False if they are not in it"""
+        with self._lock:
+            for row in upload.get('employee_data', []):
+                if str(row.get('EMPLOYEECODE', '')) == str(employee_id):
+                    row.update(fields)
+                    self._record({'op': 'sap_employee_update', 'upload_id': upload.get('id'),
+                                  'employee_id': str(employee_id), 'set': fields})
+                    return True
+        return False
+    
+    def set_upload_status(self, upload: Dict, status: str):
+        with self._lock:
+            upload['status'] = status
+            self._record({'op': 'sap_upload_update', 'upload_id': upload.get('id'), 'set': {'status': status}})
+    
+    def remove_sap_uploads(self, upload_ids: List):
+        """Drop the given uploads, keeping the rest"""
+        with self._lock:
+            removed = set(upload_ids)
+            self.sap_uploads = [upload for upload in self.sap_uploads if upload.get('id') not in removed]
+            self._record({'op': 'sap_upload_remove', 'upload_ids': list(removed)})
     
     def upload_sap_data(self, filename: str, upload_date: str, 
                         employee_data: List[Dict], 
@@ -164,7 +272,6 @@ class PackageManager:
                         period: str = None) -> Dict:
         """Upload SAP Excel data for employee packages"""
         upload_record = {
-            'id': len(self.sap_uploads) + 1,
             'filename': filename,
             'upload_date': upload_date,
             'status': 'UPLOADED',
@@ -174,8 +281,7 @@ class PackageManager:
             'period': period
         }
         
-        self.sap_uploads.append(upload_record)
-        self.save_data()
+        self._save_upload(upload_record)
         return upload_record
     
     def create_employee_package(self, employee_id: str, sap_data: Dict, 
@@ -225,8 +331,7 @@ class PackageManager:
         # Calculate initial TCTC
         package['current_tctc'] = self._calculate_tctc(package['package_components'])
         
-        self.packages.append(package)
-        self.save_data()
+        self._save_new_package(package)
         return package
     
     def update_employee_package(self, employee_id: str, updates: Dict) -> Dict:
@@ -234,53 +339,59 @@ class PackageManager:
         Update employee package with new values and budget validation.
         NO auto-adjustments - validation is non-blocking (warnings only).
         """
-        for package in self.packages:
-            if package['employee_id'] == employee_id:
-                # First validate budget constraints (returns warnings, not blocking)
-                validation_result = self.validate_budget_constraints(package, updates)
-                
-                # Check if validation failed (hard error)
-                if not validation_result['valid']:
-                    return {
-                        'success': False,
-                        'error': validation_result['error']
-                    }
-                
-                # Update package components with user-provided values
-                for key, value in updates.items():
-                    if key in package['package_components']:
-                        package['package_components'][key] = float(value)
+        package = self.get_employee_package(employee_id)
+        if package:
+            # First validate budget constraints (returns warnings, not blocking)
+            validation_result = self.validate_budget_constraints(package, updates)
+            
+            # Check if validation failed (hard error)
+            if not validation_result['valid']:
+                return {
+                    'success': False,
+                    'error': validation_result['error']
+                }
+            
+            # Update package components with user-provided values
+            components = {key: float(value) for key, value in updates.items()
+                          if key in package['package_components']}
+            previous = {key: package['package_components'].get(key) for key in components}
+            with self._lock:
+                package['package_components'].update(components)
                 
                 # Recalculate TCTC
                 package['current_tctc'] = self._calculate_tctc(package['package_components'])
                 package['last_modified'] = datetime.now().isoformat()
                 
-                self.save_data()
-                
-                # Return success with warnings (non-blocking)
-                return {
-                    'success': True,
-                    'package': package,
-                    'warnings': validation_result.get('warnings', []),
-                    'current_tctc': validation_result.get('current_tctc', package['current_tctc']),
-                    'remaining_budget': validation_result.get('remaining_budget', 0),
-                    'percentages': validation_result.get('percentages', {})
-                }
+                try:
+                    self._save_package_update(package, components, previous)
+                except ConcurrentUpdateError as e:
+                    return {'success': False, 'error': str(e), 'conflict': True}
+            
+            # Return success with warnings (non-blocking)
+            return {
+                'success': True,
+                'package': package,
+                'warnings': validation_result.get('warnings', []),
+                'current_tctc': validation_result.get('current_tctc', package['current_tctc']),
+                'remaining_budget': validation_result.get('remaining_budget', 0),
+                'percentages': validation_result.get('percentages', {})
+            }
         
         return {'success': False, 'error': 'Package not found'}
     
     def submit_employee_package(self, employee_id: str) -> Optional[Dict]:
         """Submit completed employee package"""
-        for package in self.packages:
-            if package['employee_id'] == employee_id:
+        package = self.get_employee_package(employee_id)
+        if package:
+            with self._lock:
                 package['status'] = 'SUBMITTED'
                 package['submitted_date'] = datetime.now().isoformat()
                 
                 # Calculate final net pay
                 package['net_pay_calculation'] = self._calculate_net_pay(package)
                 
-                self.save_data()
-                return package
+                self._save_package_fields(package, ('status', 'submitted_date', 'net_pay_calculation'))
+            return package
         
         return None
     
@@ -327,12 +438,10 @@ class PackageManager:
             'changes': changes,
             'user_type': user_type,
             'admin_user': user_id,  # Template expects 'admin_user' field
-            'timestamp': datetime.now().isoformat(),
-            'audit_id': len(self.audit_trail) + 1
+            'timestamp': datetime.now().isoformat()
         }
         
-        self.audit_trail.append(audit_entry)
-        self.save_data()
+        self._save_audit_entry(audit_entry)
     
     def get_employee_audit_trail(self, employee_id: str) -> List[Dict]:
         """Get audit trail for a specific employee"""
@@ -366,13 +475,25 @@ class PackageManager:
     
     def clear_sap_uploads(self):
         """Clear all SAP upload data"""
-        self.sap_uploads = []
-        self.save_data()
+        with self._lock:
+            self.sap_uploads = []
+            self._record({'op': 'sap_uploads_clear'})
     
     def clear_all_packages(self):
         """Clear all employee packages"""
-        self.packages = []
-        self.save_data()
+        with self._lock:
+            self.packages = []
+            self.stats.clear()
+            self._record({'op': 'packages_clear'})
+    
+    def package_statistics(self) -> Dict:
+        """Package counts and TCTC totals overall and per band, department, status and upload"""
+        return summarise(self.stats.cells())
+    
+    def rebuild_statistics(self) -> int:
+        """Recompute the package statistics from the packages; returns the number of cells"""
+        self.stats.rebuild(manager_package_stat(package) for package in self.packages)
+        return len(self.stats.cells())
     
     def _calculate_tctc(self, components: Dict) -> float:
         """
@@ -390,36 +511,35 @@ class PackageManager:
         # Group life option
         group_life_option = components.get('group_life_option', 'standard')
         
-        # Calculate contributions
-        pension_ee = tpe * (pension_ee_rate / 100)
-        pension_er = tpe * (pension_er_rate / 100)
+        # Calculate contributions, rounded to the cent as payroll does
+        pension_er = round_money(tpe * (pension_er_rate / 100), 'pension')
         
         # Group life contributions (percentage of TPE)
         group_life_rates = self._get_group_life_rates(group_life_option)
-        group_life_er = tpe * (group_life_rates['employer'] / 100)
-        group_life_ee = tpe * (group_life_rates['employee'] / 100)
-        
-        # TCTC calculation
-        tctc = 0
-        tctc += tpe  # Basic salary (TPE)
-        tctc += components.get('car_allowance', 0)
-        tctc += components.get('cellphone_allowance', 0)
-        tctc += components.get('data_service_allowance', 0)
-        tctc += components.get('housing_allowance', 0)
-        tctc += components.get('medical_aid', 0)
-        tctc += components.get('bonus', 0)
-        tctc += pension_er  # Employer pension contribution
-        tctc += group_life_er  # Employer group life contribution
+        group_life_er = round_money(tpe * (group_life_rates['employer'] / 100), 'group_life')
+        
+        # TCTC calculation (summed in cents)
+        amounts = [
+            tpe,  # Basic salary (TPE)
+            components.get('car_allowance', 0),
+            components.get('cellphone_allowance', 0),
+            components.get('data_service_allowance', 0),
+            components.get('housing_allowance', 0),
+            components.get('medical_aid', 0),
+            components.get('bonus', 0),
+            pension_er,  # Employer pension contribution
+            group_life_er  # Employer group life contribution
+        ]
         
         # Add other allowances
         other_allowances = components.get('other_allowances', 0)
         if isinstance(other_allowances, (int, float)):
-            tctc += other_allowances
+            amounts.append(other_allowances)
         elif isinstance(other_allowances, list):
             for allowance in other_allowances:
-                tctc += allowance.get('value', 0)
+                amounts.append(allowance.get('value', 0))
         
-        return round(tctc, 2)
+        return sum_money(amounts, 'tctc')
     
     def _get_pension_rates(self, pension_option: str) -> tuple:
         """
@@ -519,53 +639,35 @@ class PackageManager:
             
             # Calculate employer contributions
             pension_ee_rate, pension_er_rate = self._get_pension_rates(pension_option)
-            pension_er = tpe * (pension_er_rate / 100)
+            pension_er = round_money(tpe * (pension_er_rate / 100), 'pension')
             
             group_life_rates = self._get_group_life_rates(group_life_option)
-            group_life_er = tpe * (group_life_rates['employer'] / 100)
+            group_life_er = round_money(tpe * (group_life_rates['employer'] / 100), 'group_life')
             
-            # Calculate current TCTC (includes employer contributions)
-            current_tctc = (tpe + car_allowance + bonus_annual + 
-                          housing_allowance + cellphone_allowance + 
-                          data_service_allowance + medical_aid +
-                          pension_er + group_life_er)
+            # Calculate current TCTC (includes employer contributions), in cents
+            current_tctc = sum_money([tpe, car_allowance, bonus_annual,
+                                      housing_allowance, cellphone_allowance,
+                                      data_service_allowance, medical_aid,
+                                      pension_er, group_life_er], 'tctc')
             
-            # Check if TCTC exceeds limit
-            if current_tctc > ctc:
-                return {
-                    'valid': False,
-                    'error': f'TCTC limit exceeded. Current: R{current_tctc:,.2f}, Limit: R{ctc:,.2f}'
-                }
+            # Band rules from budget_rules (the CTC limit is the blocking one)
+            result = check_package(ctc, tpe, car_allowance, bonus_annual, current_tctc,
+                                   package.get('grade_band', ''))
+            if result['errors']:
+                return {'valid': False, 'error': '; '.join(result['errors']), 'errors': result['errors']}
             
             # Validation warnings (non-blocking)
-            warnings = []
-            
-            # TPE validation (50% - 70% of CTC)
+            warnings = [f"⚠️ {warning}" for warning in result['warnings']]
             tpe_percentage = (tpe / ctc * 100) if ctc > 0 else 0
-            if tpe_percentage < 50:
-                warnings.append(f"⚠️ TPE is {tpe_percentage:.1f}% of CTC (below 50% minimum for O-Q Band)")
-            elif tpe_percentage > 70:
-                warnings.append(f"⚠️ TPE is {tpe_percentage:.1f}% of CTC (above 70% maximum for O-Q Band)")
-            
-            # Car Allowance validation (minimum 30% of CTC)
             car_percentage = (car_allowance / ctc * 100) if ctc > 0 else 0
-            if car_allowance > 0 and car_percentage < 30:
-                warnings.append(f"⚠️ Car Allowance is {car_percentage:.1f}% of CTC (below 30% minimum)")
-            
-            # Bonus validation (10% - 70% of CTC)
             bonus_percentage = (bonus_annual / ctc * 100) if ctc > 0 else 0
-            if bonus_annual > 0:
-                if bonus_percentage < 10:
-                    warnings.append(f"⚠️ Bonus is {bonus_percentage:.1f}% of CTC (below 10% minimum)")
-                elif bonus_percentage > 70:
-                    warnings.append(f"⚠️ Bonus is {bonus_percentage:.1f}% of CTC (above 70% maximum)")
             
             # Return validation result with warnings
             return {
                 'valid': True, 
                 'warnings': warnings,
                 'current_tctc': current_tctc,
-                'remaining_budget': ctc - current_tctc,
+                'remaining_budget': from_cents(to_cents(ctc) - to_cents(current_tctc)),
                 'percentages': {
                     'tpe': tpe_percentage,
                     'car': car_percentage,
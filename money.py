@@ -0,0 +1,96 @@
+"""
+Fixed-point money helpers for the Rand Water calculators
+Amounts are held as integer cents (int, or int64 NumPy arrays) so sums and
+comparisons are exact, and scalar and batch paths round identically
+"""
+
+import math
+from typing import Iterable
+
+import numpy as np
+
+# Rounding policies
+HALF_UP = 'half_up'       # 0.5c rounds away from zero
+HALF_EVEN = 'half_even'   # 0.5c rounds to the even cent
+DOWN = 'down'             # truncate toward zero
+UP = 'up'                 # any fraction rounds away from zero
+
+# Policy applied by each payroll rule; rules are kept separate so a SARS
+# ruling for one deduction can change without touching the others
+ROUNDING_POLICIES = {
+    'paye': HALF_UP,          # monthly employees' tax
+    'bonus_tax': HALF_UP,     # monthly provision for tax on bonus
+    'uif': HALF_UP,           # 1% UIF, after the ceiling
+    'pension': HALF_UP,       # rate x TPE contributions
+    'group_life': HALF_UP,
+    'medical': HALF_UP,
+    'tctc': HALF_UP,
+    'money': HALF_UP,         # any other Rand amount
+}
+
+# Float cents are first snapped to this many decimal places so binary noise
+# (1.005 * 100 == 100.49999999999999) does not decide the rounding direction
+_CENT_PRECISION = 1e6
+
+
+def _policy(rule: str) -> str:
+    return ROUNDING_POLICIES.get(rule, rule)
+
+
+def to_cents(value, rule: str = 'money') -> int:
+    """Convert a Rand amount to integer cents using a rule's rounding policy"""
+    if value is None:
+        return 0
+    cents = round(float(value) * 100.0 * _CENT_PRECISION) / _CENT_PRECISION
+    policy = _policy(rule)
+    if policy == HALF_UP:
+        return int(math.copysign(math.floor(abs(cents) + 0.5), cents))
+    if policy == HALF_EVEN:
+        return int(round(cents))
+    if policy == DOWN:
+        return int(math.trunc(cents))
+    if policy == UP:
+        return int(math.copysign(math.ceil(abs(cents)), cents))
+    raise ValueError(f"Unknown rounding policy: {rule}")
+
+
+def to_cents_array(values, rule: str = 'money') -> np.ndarray:
+    """Vectorised to_cents returning an int64 array"""
+    cents = np.rint(np.asarray(values, dtype=np.float64) * 100.0 * _CENT_PRECISION) / _CENT_PRECISION
+    policy = _policy(rule)
+    if policy == HALF_UP:
+        rounded = np.copysign(np.floor(np.abs(cents) + 0.5), cents)
+    elif policy == HALF_EVEN:
+        rounded = np.rint(cents)
+    elif policy == DOWN:
+        rounded = np.trunc(cents)
+    elif policy == UP:
+        rounded = np.copysign(np.ceil(np.abs(cents)), cents)
+    else:
+        raise ValueError(f"Unknown rounding policy: {rule}")
+    return rounded.astype(np.int64)
+
+
+def from_cents(cents) -> float:
+    """Rand amount for integer cents"""
+    return int(cents) / 100
+
+
+def from_cents_array(cents) -> np.ndarray:
+    """Rand amounts for an array of cents"""
+    return np.asarray(cents, dtype=np.int64) / 100
+
+
+def round_money(value, rule: str = 'money') -> float:
+    """Round a Rand amount to the cent under a rule's policy"""
+    return from_cents(to_cents(value, rule))
+
+
+def round_money_array(values, rule: str = 'money') -> np.ndarray:
+    """Vectorised round_money"""
+    return from_cents_array(to_cents_array(values, rule))
+
+
+def sum_money(values: Iterable, rule: str = 'money') -> float:
+    """Exact sum of Rand amounts, each rounded to the cent first"""
+    return from_cents(sum(to_cents(value, rule) for value in values))
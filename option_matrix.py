@@ -0,0 +1,254 @@
+"""
+Option-matrix cache for the package builder
+Precomputes every employee's take-home for each pension, group life and
+medical aid option when a SAP upload arrives, and stores the results as int32
+cent arrays (employee x pension x group life x medical) so option screens are
+a dictionary lookup rather than a calculation
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batch_engine import calculate_columns, load_columns, medical_dependants
+from money import from_cents, to_cents_array
+
+logger = logging.getLogger(__name__)
+
+OPTION_MATRIX_DIR = 'option_matrix_cache'
+
+# Matrices held in memory (newest uploads first); older ones are reloaded from disk
+OPTION_MATRIX_LIMIT = 4
+
+# Stored per option combination, in cents
+MATRIX_FIELDS = ('cash', 'pension_employee', 'pension_employer', 'group_life_employee',
+                 'group_life_employer', 'medical_employee', 'uif_employee', 'total_tax', 'net_pay')
+
+CURRENT_MEDICAL = 'current'
+NO_MEDICAL = 'none'
+
+
+def medical_options(medical_rates: Dict) -> Dict[str, Dict[str, float]]:
+    """Flatten load_medical_aid_rates() into 'provider/option' -> member rates"""
+    options = {}
+    for provider, provider_options in (medical_rates or {}).items():
+        if not isinstance(provider_options, dict):
+            continue
+        for option, rates in provider_options.items():
+            if isinstance(rates, dict) and 'main_member' in rates:
+                options[f'{provider}/{option}'] = rates
+    return options
+
+
+def build_option_matrix(employee_data, pension_rates: Dict[str, Tuple[float, float]],
+                        group_life_rates: Dict[str, Dict[str, float]], medical_rates: Dict,
+                        settings: Optional[Dict] = None, fingerprint: str = '') -> 'OptionMatrix':
+    """
+    Net pay for every employee under every option combination.
+
+    Pension and group life rates are percentages of TPE. The CTC is held
+    fixed, so a change in employer contributions comes out of cash, as on the
+    package edit page. Medical options replace the employee's medical
+    contribution, priced for the spouse, adult and child dependants on the
+    SAP row.
+    """
+    base = load_columns(employee_data)
+    employee_ids = [str(row.get('EMPLOYEECODE', '')) for row in employee_data]
+    tpe = base['tpe']
+    medical = medical_options(medical_rates)
+
+    adults, children = medical_dependants(base)
+    medical_costs = {CURRENT_MEDICAL: base['medical_employee'], NO_MEDICAL: np.zeros(len(tpe))}
+    for label, rates in medical.items():
+        medical_costs[label] = (rates.get('main_member', 0) * np.minimum(base['main_members'], 1)
+                                + rates.get('spouse', 0) * adults
+                                + rates.get('child', 0) * children)
+
+    pension_labels = list(pension_rates)
+    group_life_labels = list(group_life_rates)
+    medical_labels = list(medical_costs)
+    shape = (len(tpe), len(pension_labels), len(group_life_labels), len(medical_labels))
+    values = {field: np.zeros(shape, dtype=np.int32) for field in MATRIX_FIELDS}
+
+    for p, pension_option in enumerate(pension_labels):
+        pension_ee_rate, pension_er_rate = pension_rates[pension_option]
+        for g, group_life_option in enumerate(group_life_labels):
+            group_life = group_life_rates[group_life_option]
+            columns = dict(base)
+            columns['pension_employee'] = tpe * pension_ee_rate / 100
+            columns['pension_employer'] = tpe * pension_er_rate / 100
+            columns['group_life_employee'] = tpe * group_life['employee'] / 100
+            columns['group_life_employer'] = tpe * group_life['employer'] / 100
+            columns['cash'] = (base['cash']
+                               - (columns['pension_employer'] - base['pension_employer'])
+                               - (columns['group_life_employer'] - base['group_life_employer']))
+            for m, medical_label in enumerate(medical_labels):
+                columns['medical_employee'] = medical_costs[medical_label]
+                outputs = calculate_columns(columns, settings)
+                outputs['cash'] = columns['cash']
+                for field in MATRIX_FIELDS:
+                    values[field][:, p, g, m] = to_cents_array(outputs[field])
+
+    return OptionMatrix(employee_ids, pension_labels, group_life_labels, medical_labels, values, fingerprint)
+
+
+class OptionMatrix:
+    """Columnar option results for one SAP upload"""
+
+    def __init__(self, employee_ids: List[str], pension_options: List[str], group_life_options: List[str],
+                 medical_options: List[str], values: Dict[str, np.ndarray], fingerprint: str = ''):
+        self.employee_ids = list(employee_ids)
+        self.pension_options = list(pension_options)
+        self.group_life_options = list(group_life_options)
+        self.medical_options = list(medical_options)
+        self.values = values
+        self.fingerprint = fingerprint
+        self._rows = {employee_id: i for i, employee_id in enumerate(self.employee_ids)}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.values.values())
+
+    def lookup(self, employee_id: str) -> Optional[List[Dict]]:
+        """Every option combination for one employee, or None if not in the upload"""
+        row = self._rows.get(str(employee_id))
+        if row is None:
+            return None
+        results = []
+        for p, pension_option in enumerate(self.pension_options):
+            for g, group_life_option in enumerate(self.group_life_options):
+                for m, medical_option in enumerate(self.medical_options):
+                    entry = {'pension_option': pension_option, 'group_life_option': group_life_option,
+                             'medical_option': medical_option}
+                    entry.update({field: from_cents(self.values[field][row, p, g, m]) for field in MATRIX_FIELDS})
+                    results.append(entry)
+        return results
+
+    def save(self, path: str):
+        """Write the matrix as a compressed .npz (no pickled objects)"""
+        meta = {
+            'employee_ids': self.employee_ids,
+            'pension_options': self.pension_options,
+            'group_life_options': self.group_life_options,
+            'medical_options': self.medical_options,
+            'fingerprint': self.fingerprint
+        }
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)), **self.values)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'OptionMatrix':
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            values = {field: data[field] for field in MATRIX_FIELDS}
+        return cls(meta['employee_ids'], meta['pension_options'], meta['group_life_options'],
+                   meta['medical_options'], values, meta['fingerprint'])
+
+
+def matrix_fingerprint(upload: Dict, *versions) -> str:
+    """Identifies an upload plus the rate/tax versions its matrix was built from"""
+    payload = json.dumps([upload.get('id'), upload.get('filename'), upload.get('upload_date'), list(versions)],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class OptionMatrixCache:
+    """Builds option matrices in the background and serves them from memory or disk"""
+
+    def __init__(self, cache_dir: str = OPTION_MATRIX_DIR, limit: int = OPTION_MATRIX_LIMIT):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self._matrices: Dict[str, OptionMatrix] = {}
+        self._building: Dict[str, threading.Thread] = {}
+        self._status: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, upload_id) -> str:
+        return os.path.join(self.cache_dir, f'upload_{upload_id}.npz')
+
+    def _remember(self, upload_id: str, matrix: OptionMatrix):
+        """Hold a matrix in memory, evicting the least recently used; call under _lock"""
+        self._matrices.pop(upload_id, None)
+        self._matrices[upload_id] = matrix
+        while len(self._matrices) > self.limit:
+            self._matrices.pop(next(iter(self._matrices)))
+
+    def build_async(self, upload: Dict, fingerprint: str, pension_rates: Dict, group_life_rates: Dict,
+                    medical_rates: Dict, settings: Optional[Dict] = None) -> bool:
+        """Start a background build; returns False if one is already running"""
+        upload_id = str(upload.get('id'))
+        with self._lock:
+            if upload_id in self._building:
+                return False
+            thread = threading.Thread(
+                target=self._build,
+                args=(upload, fingerprint, pension_rates, group_life_rates, medical_rates, settings),
+                daemon=True
+            )
+            self._building[upload_id] = thread
+            self._status[upload_id] = {'status': 'building', 'fingerprint': fingerprint,
+                                       'started_at': datetime.now().isoformat()}
+        thread.start()
+        return True
+
+    def _build(self, upload, fingerprint, pension_rates, group_life_rates, medical_rates, settings):
+        upload_id = str(upload.get('id'))
+        started = datetime.now()
+        try:
+            matrix = build_option_matrix(upload.get('employee_data', []), pension_rates, group_life_rates,
+                                         medical_rates, settings, fingerprint)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            matrix.save(self._path(upload_id))
+            seconds = (datetime.now() - started).total_seconds()
+            with self._lock:
+                self._remember(upload_id, matrix)
+                self._status[upload_id] = {
+                    'status': 'ready',
+                    'fingerprint': fingerprint,
+                    'employees': len(matrix.employee_ids),
+                    'combinations': len(matrix.pension_options) * len(matrix.group_life_options)
+                                    * len(matrix.medical_options),
+                    'bytes': matrix.nbytes,
+                    'seconds': round(seconds, 2),
+                    'built_at': datetime.now().isoformat()
+                }
+            logger.info(f"Option matrix for upload {upload_id} built in {seconds:.2f}s "
+                        f"({matrix.nbytes / 1e6:.1f} MB)")
+        except Exception as e:
+            logger.error(f"Error building option matrix for upload {upload_id}: {str(e)}")
+            with self._lock:
+                self._status[upload_id] = {'status': 'failed', 'fingerprint': fingerprint, 'error': str(e)}
+        finally:
+            with self._lock:
+                self._building.pop(upload_id, None)
+
+    def get(self, upload: Dict, fingerprint: str) -> Optional[OptionMatrix]:
+        """Matrix for an upload if one built from the same inputs is available"""
+        upload_id = str(upload.get('id'))
+        with self._lock:
+            matrix = self._matrices.get(upload_id)
+            if matrix is not None:
+                self._remember(upload_id, matrix)
+        if matrix is None and os.path.exists(self._path(upload_id)):
+            try:
+                matrix = OptionMatrix.load(self._path(upload_id))
+                with self._lock:
+                    self._remember(upload_id, matrix)
+            except Exception as e:
+                logger.warning(f"Could not load option matrix for upload {upload_id}: {str(e)}")
+                return None
+        if matrix is None or matrix.fingerprint != fingerprint:
+            return None
+        return matrix
+
+    def status(self, upload: Dict) -> Dict:
+        upload_id = str(upload.get('id'))
+        return dict(self._status.get(upload_id, {'status': 'missing'}), upload_id=upload.get('id'))
@@ -0,0 +1,165 @@
+"""
+Package audit trail stored in SQLite
+The calculator's package audit entries ({timestamp, admin_user, action,
+field_name, old_value, new_value, ...} per employee) are written to the
+audit_log table next to the PackageManager's, so a filtered, time-ordered
+page of the whole trail is an index range scan instead of a load of
+randwater_package_audit.json. One employee's full history is read from the
+segment log in audit_segments.py.
+
+Pages are keyset paginated: each carries an opaque cursor naming the last
+(timestamp, id) it returned, and the next page starts strictly after it.
+"""
+
+import base64
+import json
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from database import PACKAGE_AUDIT_TABLE, RandwaterDatabase
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_AUDIT_FILE = 'randwater_package_audit.json'
+
+# system_settings key marking the one-time import of PACKAGE_AUDIT_FILE
+IMPORTED_SETTING = 'package_audit_imported'
+
+# Entry keys kept in their own audit_log columns rather than in new_data
+ROW_KEYS = ('timestamp', 'admin_user', 'action', 'employee_id', 'user_type', 'audit_id')
+
+
+def audit_rows(employee_id: str, entries: List[Dict]) -> List[tuple]:
+    """
+    audit_log rows (RandwaterDatabase.insert_audit_rows order) for calculator audit entries.
+    Entries without a timestamp are stamped now, as a NULL would break keyset page cursors.
+    """
+    rows = []
+    for entry in entries:
+        details = {key: value for key, value in entry.items() if key not in ROW_KEYS}
+        rows.append((entry.get('admin_user'), entry.get('action') or 'field_update', PACKAGE_AUDIT_TABLE,
+                     str(entry.get('employee_id') or employee_id), None, json.dumps(details, default=str),
+                     entry.get('user_type'), entry.get('timestamp') or datetime.now().isoformat()))
+    return rows
+
+
+def row_entry(row: Dict) -> Dict:
+    """An audit_log row back in the calculator's entry shape"""
+    try:
+        details = json.loads(row['new_data']) if row.get('new_data') else {}
+    except ValueError:
+        details = {'changes': row['new_data']}
+    if not isinstance(details, dict):
+        details = {'changes': details}
+    entry = dict(details)
+    entry.update({
+        'audit_id': row['id'],
+        'employee_id': row['record_id'],
+        'timestamp': row['timestamp'],
+        'admin_user': row['user_id'],
+        'action': row['action']
+    })
+    if row.get('user_type'):
+        entry['user_type'] = row['user_type']
+    return entry
+
+
+def encode_cursor(position: Optional[tuple]) -> Optional[str]:
+    if position is None:
+        return None
+    raw = json.dumps(list(position), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """(timestamp, id) from a page cursor; ValueError when it is not one"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, audit_id = json.loads(raw)
+        return str(timestamp), int(audit_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def day_bounds(start: Optional[str], end: Optional[str]) -> tuple:
+    """
+    Timestamp bounds for a from/to filter: from is inclusive and a bare
+    YYYY-MM-DD to covers that whole day. ValueError on a malformed date.
+    """
+    def checked(value):
+        if value and len(value) >= 10:
+            date.fromisoformat(value[:10])
+        return value or None
+
+    start, end = checked(start), checked(end)
+    if end and len(end) == 10:
+        end = (date.fromisoformat(end) + timedelta(days=1)).isoformat()
+    return start, end
+
+
+def query_package_audit(db: RandwaterDatabase, employee_id: Optional[str] = None, start: Optional[str] = None,
+                        end: Optional[str] = None, action: Optional[str] = None, user: Optional[str] = None,
+                        after: Optional[str] = None, limit: int = 100) -> Dict:
+    """One page of package audit entries, newest first, with the cursor for the next page"""
+    start, end = day_bounds(start, end)
+    page = db.query_audit_log(PACKAGE_AUDIT_TABLE, record_id=employee_id, start=start, end=end, action=action,
+                              user=user, after=decode_cursor(after) if after else None, limit=limit)
+    return {'entries': [row_entry(row) for row in page['entries']], 'next': encode_cursor(page['next'])}
+
+
+def record_package_audit(db: RandwaterDatabase, entries_by_employee: Dict[str, List[Dict]]):
+    """Store calculator audit entries for several employees in one transaction"""
+    rows = [row for employee_id, entries in entries_by_employee.items() for row in audit_rows(employee_id, entries)]
+    if rows:
+        db.insert_audit_rows(rows)
+
+
+def import_audit_file(db: RandwaterDatabase, path: str = PACKAGE_AUDIT_FILE) -> int:
+    """
+    Copy an existing audit file into audit_log, once per database.
+
+    Accepts the calculator's {employee_id: [entries]} layout and the
+    PackageManager's list of entries. Returns the number imported.
+    """
+    conn = db.connection()
+    if conn.execute('SELECT 1 FROM system_settings WHERE setting_key = ?', (IMPORTED_SETTING,)).fetchone():
+        return 0
+
+    rows = []
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                audits = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not import audit file {path}: {str(e)}")
+            return 0
+        if isinstance(audits, dict):
+            for employee_id, entries in audits.items():
+                rows.extend(audit_rows(employee_id, entries if isinstance(entries, list) else []))
+        elif isinstance(audits, list):
+            for entry in audits:
+                if isinstance(entry, dict) and entry.get('employee_id') is not None:
+                    # PackageManager entries keep their details under 'changes'
+                    if isinstance(entry.get('changes'), dict):
+                        entry = dict(entry)
+                        entry.update(entry.pop('changes'))
+                    rows.extend(audit_rows(entry['employee_id'], [entry]))
+
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        # Another worker may have imported while this one read the file
+        if conn.execute('SELECT 1 FROM system_settings WHERE setting_key = ?', (IMPORTED_SETTING,)).fetchone():
+            return 0
+        conn.executemany('''
+            INSERT INTO audit_log (user_id, action, table_name, record_id, old_data, new_data, user_type, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.execute('''
+            INSERT INTO system_settings (setting_key, setting_value, setting_type, description)
+            VALUES (?, ?, 'int', 'Package audit entries imported from the JSON audit file')
+        ''', (IMPORTED_SETTING, str(len(rows))))
+    if rows:
+        logger.info(f"Imported {len(rows)} audit entries from {path}")
+    return len(rows)
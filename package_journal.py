@@ -0,0 +1,209 @@
+"""
+Append-only journal for PackageManager persistence
+Package edits, submissions, audit entries and SAP uploads are appended as
+one JSON line each instead of rewriting the snapshot files. Compaction folds
+the journal into the snapshots (employee_packages.json, sap_uploads.json and
+the audit file), so loading is a snapshot read plus a replay of the tail.
+
+Every web worker appends to the same journal, so appends and compaction
+take an exclusive lock on a sidecar file. Compaction rebuilds the snapshots
+from disk plus the whole journal rather than from one worker's memory, so
+other workers' records are kept. Every record is safe to replay twice, which
+covers a crash between writing the snapshots and removing the journal.
+
+Upload ids and audit ids come from sequences kept next to the journal and
+issued under its lock, so two workers never hand out the same id.
+"""
+
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: the journal is serialised within the process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_JOURNAL_FILE = 'package_journal.jsonl'
+
+# Compact in the background once the live journal holds this many records
+COMPACT_AFTER_RECORDS = 500
+
+
+class PackageJournal:
+    """Line-per-record JSON journal shared by every worker process"""
+
+    def __init__(self, path: str = PACKAGE_JOURNAL_FILE, fsync: bool = True):
+        self.path = path
+        # Left by compactions before journal locking; replayed first
+        self.rotated_path = f'{path}.compacting'
+        self.lock_path = f'{path}.lock'
+        self.ids_path = f'{path}.ids'
+        self.fsync = fsync
+        # Records in the live journal, as far as this process knows
+        self.records = 0
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def locked(self):
+        """Hold the journal against appends and compaction in every process (re-entrant)"""
+        with self._lock:
+            # flock on a second descriptor would wait on this process's own lock
+            if fcntl is None or self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def next_id(self, sequence: str, floor: int = 0) -> int:
+        """
+        Next id in a sequence shared by every worker. floor is the highest id
+        this process knows of, for ids issued before the sequence existed.
+        Call under locked() and journal the record before releasing it, so
+        the journal stays in id order.
+        """
+        with self.locked():
+            try:
+                with open(self.ids_path, 'r', encoding='utf-8') as f:
+                    ids = json.load(f)
+            except (OSError, ValueError):
+                ids = {}
+            value = max(int(ids.get(sequence) or 0), int(floor or 0)) + 1
+            ids[sequence] = value
+            write_snapshot(self.ids_path, json.dumps(ids))
+            return value
+
+    def append(self, record: Dict):
+        line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        with self.locked():
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            self.records += 1
+
+    @staticmethod
+    def _read(path: str) -> Iterator[Dict]:
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Only a torn final write can leave a partial line
+                    logger.warning(f"Stopping replay of {path} at unreadable line {number}")
+                    return
+
+    def replay(self, apply: Callable[[Dict], None]) -> int:
+        """Apply every record not yet folded into the snapshots, oldest first"""
+        count = 0
+        with self.locked():
+            for path in (self.rotated_path, self.path):
+                for record in self._read(path):
+                    apply(record)
+                    count += 1
+            self.records = sum(1 for _ in self._read(self.path))
+        return count
+
+    def clear(self):
+        """Discard the journal once its records are in the snapshots; call under locked()"""
+        for path in (self.rotated_path, self.path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.records = 0
+
+
+def read_snapshot(path: str) -> List[Dict]:
+    """A snapshot file's records; a missing file is empty"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_snapshot(path: str, payload: str):
+    """Replace a snapshot file atomically"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _find_upload(sap_uploads: List[Dict], upload_id) -> Optional[Dict]:
+    return next((upload for upload in sap_uploads if upload.get('id') == upload_id), None)
+
+
+def apply_record(record: Dict, packages: List[Dict], sap_uploads: List[Dict], audit_trail: List[Dict]):
+    """Replay one journal record onto the in-memory lists (idempotent)"""
+    op = record.get('op')
+    if op == 'package_add':
+        package = record['package']
+        for i, existing in enumerate(packages):
+            if existing.get('employee_id') == package.get('employee_id'):
+                packages[i] = package
+                break
+        else:
+            packages.append(package)
+    elif op == 'package_update':
+        for package in packages:
+            if package.get('employee_id') == record.get('employee_id'):
+                package.update(record.get('set') or {})
+                package.setdefault('package_components', {}).update(record.get('components') or {})
+                break
+    elif op == 'packages_clear':
+        packages.clear()
+    elif op == 'audit':
+        entry = record['entry']
+        audit_id = int(entry.get('audit_id') or 0)
+        # audit_ids are issued in journal order, so a replayed entry can only be in the tail
+        for existing in reversed(audit_trail):
+            existing_id = int(existing.get('audit_id') or 0)
+            if existing_id <= audit_id:
+                if existing_id < audit_id:
+                    audit_trail.append(entry)
+                break
+        else:
+            audit_trail.append(entry)
+    elif op == 'sap_upload':
+        upload = record['upload']
+        if _find_upload(sap_uploads, upload.get('id')) is None:
+            sap_uploads.append(upload)
+    elif op == 'sap_upload_update':
+        upload = _find_upload(sap_uploads, record.get('upload_id'))
+        if upload is not None:
+            upload.update(record.get('set') or {})
+    elif op == 'sap_employee_update':
+        upload = _find_upload(sap_uploads, record.get('upload_id'))
+        for row in (upload or {}).get('employee_data', []):
+            if str(row.get('EMPLOYEECODE', '')) == str(record.get('employee_id')):
+                row.update(record.get('set') or {})
+                break
+    elif op == 'sap_upload_remove':
+        removed = set(record.get('upload_ids') or [])
+        sap_uploads[:] = [upload for upload in sap_uploads if upload.get('id') not in removed]
+    elif op == 'sap_uploads_clear':
+        sap_uploads.clear()
+    else:
+        logger.warning(f"Ignoring unknown package journal record: {op}")
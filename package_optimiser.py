@@ -0,0 +1,193 @@
+"""
+Package-structure optimiser for O-Q band employees
+Searches car allowance x bonus x pension option on a vectorised grid. TPE takes
+whatever the CTC leaves after fixed costs and employer contributions, and is
+paid as cash. Every feasible split is scored with the batch net pay engine.
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from batch_engine import MEDICAL_MEMBER_COLUMNS, SAP_COLUMNS, calculate_columns, sap_column
+from money import from_cents_array, to_cents, to_cents_array
+
+logger = logging.getLogger(__name__)
+
+# O-Q band rules, as percentages of monthly CTC (bonus is annual); car and bonus may also be zero
+TPE_PERCENT_RANGE = (50.0, 70.0)
+CAR_MIN_PERCENT = 30.0
+BONUS_PERCENT_RANGE = (10.0, 70.0)
+
+OBJECTIVES = ('monthly', 'annual')
+MIN_STEP_PERCENT = 0.1
+# Most (car, bonus, option) splits one request may score
+MAX_GRID_SIZE = 150000
+
+# Fixed inputs the optimiser does not move
+FIXED_FIELDS = ('housing', 'cellphone', 'data_service', 'medical_employee', 'medical_employer', 'age',
+                'main_members', 'first_dependants', 'additional_dependants')
+
+
+class OptimiserError(ValueError):
+    """Raised when an optimisation request cannot be evaluated"""
+
+
+def _percent_grid(start: float, stop: float, step: float) -> np.ndarray:
+    """Percentages from start to stop inclusive, always including both ends"""
+    grid = np.arange(start, stop, step)
+    return np.unique(np.round(np.append(grid, stop), 6))
+
+
+def grid_size(step_percent: float, option_count: int) -> int:
+    """Splits package_grid generates for a step, before the feasibility filter, across all options"""
+    cars = 1 + len(_percent_grid(CAR_MIN_PERCENT, 100.0, step_percent))
+    bonuses = 1 + len(_percent_grid(BONUS_PERCENT_RANGE[0], BONUS_PERCENT_RANGE[1], step_percent))
+    return cars * bonuses * option_count
+
+
+def package_grid(ctc: float, fixed: Dict[str, float], option: Dict, step_percent: float) -> Dict[str, np.ndarray]:
+    """Every feasible (car, bonus) split for one pension / group life option"""
+    car_percent = np.append(0.0, _percent_grid(CAR_MIN_PERCENT, 100.0, step_percent))
+    # Car and bonus are optional, so zero is always a candidate
+    bonus_percent = np.append(0.0, _percent_grid(BONUS_PERCENT_RANGE[0], BONUS_PERCENT_RANGE[1], step_percent))
+    car_percent, bonus_percent = (grid.ravel() for grid in np.meshgrid(car_percent, bonus_percent))
+
+    ctc_cents = to_cents(ctc)
+    car = to_cents_array(ctc * car_percent / 100)
+    bonus = to_cents_array(ctc * bonus_percent / 100)
+    fixed_cost = to_cents(fixed['housing'] + fixed['cellphone'] + fixed['data_service']) + to_cents(
+        fixed['medical_employer'], 'medical')
+
+    # CTC = TPE x (1 + ER pension + ER group life) + car + bonus / 12 + fixed costs
+    er_share = option['pension_employer'] + option['group_life_employer']
+    available = ctc_cents - fixed_cost - car - bonus / 12
+    tpe = to_cents_array(available / 100 / (1 + er_share), 'down')
+
+    def employer_cost(tpe_cents):
+        pension_er = to_cents_array(from_cents_array(tpe_cents) * option['pension_employer'], 'pension')
+        group_life_er = to_cents_array(from_cents_array(tpe_cents) * option['group_life_employer'], 'group_life')
+        return pension_er, group_life_er, tpe_cents + pension_er + group_life_er + car + bonus / 12 + fixed_cost
+
+    # Per-contribution rounding can add a cent or two; step TPE down until it fits
+    for _ in range(3):
+        pension_er, group_life_er, cost = employer_cost(tpe)
+        over = cost > ctc_cents
+        if not over.any():
+            break
+        tpe = tpe - over
+
+    tpe_percent = from_cents_array(tpe) / ctc * 100
+    feasible = ((tpe_percent >= TPE_PERCENT_RANGE[0] - 1e-9) & (tpe_percent <= TPE_PERCENT_RANGE[1] + 1e-9)
+                & (cost <= ctc_cents))
+    return {
+        'tpe': from_cents_array(tpe[feasible]),
+        'car': from_cents_array(car[feasible]),
+        'bonus': from_cents_array(bonus[feasible]),
+        'pension_employer': from_cents_array(pension_er[feasible]),
+        'group_life_employer': from_cents_array(group_life_er[feasible]),
+        'tctc': from_cents_array(np.rint(cost[feasible]).astype(np.int64)),
+    }
+
+
+def optimise_package(ctc: float, fixed: Dict[str, float], options: List[Dict], settings: Optional[Dict] = None,
+                     objective: str = 'annual', top_n: int = 5, step_percent: float = 1.0) -> Dict:
+    """
+    Best TPE / car / bonus / pension option split for a CTC.
+
+    options are dicts with 'pension_option', 'group_life_option' and the
+    employee/employer rates as fractions of TPE. Returns the best package and
+    the next top_n - 1 alternatives, ranked by monthly or annual take-home.
+    """
+    if ctc <= 0:
+        raise OptimiserError("CTC must be greater than zero")
+    if objective not in OBJECTIVES:
+        raise OptimiserError(f"objective must be one of {', '.join(OBJECTIVES)}")
+    if not options:
+        raise OptimiserError("At least one pension option is required")
+    step_percent = max(float(step_percent), MIN_STEP_PERCENT)
+    top_n = max(int(top_n), 1)
+    size = grid_size(step_percent, len(options))
+    if size > MAX_GRID_SIZE:
+        raise OptimiserError(f"{size:,} splits exceed the limit of {MAX_GRID_SIZE:,}; "
+                             f"use a larger step_percent or fewer pension options")
+
+    grids = []
+    for index, option in enumerate(options):
+        grid = package_grid(ctc, fixed, option, step_percent)
+        grid['option'] = np.full(len(grid['tpe']), index)
+        grids.append(grid)
+    candidates = {field: np.concatenate([grid[field] for grid in grids]) for field in grids[0]}
+    count = len(candidates['tpe'])
+    if not count:
+        return {'objective': objective, 'evaluated': 0, 'best': None, 'alternatives': []}
+
+    option_index = candidates['option']
+    rates = {key: np.array([option[key] for option in options])[option_index]
+             for key in ('pension_employee', 'group_life_employee')}
+    columns = {
+        'tpe': candidates['tpe'],
+        'cash': candidates['tpe'],
+        'car': candidates['car'],
+        'bonus': candidates['bonus'],
+        'pension_employee': candidates['tpe'] * rates['pension_employee'],
+        'pension_employer': candidates['pension_employer'],
+        'group_life_employee': candidates['tpe'] * rates['group_life_employee'],
+        'group_life_employer': candidates['group_life_employer'],
+        'sap_uif': np.zeros(count),
+    }
+    for field in FIXED_FIELDS:
+        columns[field] = np.full(count, float(fixed[field]))
+    outputs = calculate_columns(columns, settings or {})
+
+    annual = outputs['net_pay'] * 12 + candidates['bonus']
+    score = outputs['net_pay'] if objective == 'monthly' else annual
+    # Highest take-home first; ties go to the larger (pensionable) TPE
+    order = np.lexsort((-candidates['tpe'], -score))[:top_n]
+
+    packages = []
+    for i in order:
+        option = options[option_index[i]]
+        tpe = float(candidates['tpe'][i])
+        packages.append({
+            'pension_option': option['pension_option'],
+            'group_life_option': option['group_life_option'],
+            'tpe': tpe,
+            'car_allowance': float(candidates['car'][i]),
+            'bonus': float(candidates['bonus'][i]),
+            'tpe_percent': round(tpe / ctc * 100, 2),
+            'car_percent': round(float(candidates['car'][i]) / ctc * 100, 2),
+            'bonus_percent': round(float(candidates['bonus'][i]) / ctc * 100, 2),
+            'pension_employee': float(outputs['pension_employee'][i]),
+            'pension_employer': float(outputs['pension_employer'][i]),
+            'group_life_employee': float(outputs['group_life_employee'][i]),
+            'group_life_employer': float(outputs['group_life_employer'][i]),
+            'tctc': float(candidates['tctc'][i]),
+            'uif_employee': float(outputs['uif_employee'][i]),
+            'total_tax': float(outputs['total_tax'][i]),
+            'net_pay': float(outputs['net_pay'][i]),
+            'annual_take_home': round(float(annual[i]), 2),
+        })
+
+    logger.info(f"Package optimiser evaluated {count} feasible splits over {len(options)} option(s)")
+    return {'objective': objective, 'evaluated': count, 'best': packages[0], 'alternatives': packages[1:]}
+
+
+def fixed_inputs_from_sap(employee: Dict, components: Optional[Dict] = None) -> Dict[str, float]:
+    """Fixed optimiser inputs from a SAP row, overridden by package components"""
+    fixed = {}
+    for field in FIXED_FIELDS:
+        if field in MEDICAL_MEMBER_COLUMNS:
+            column, default = MEDICAL_MEMBER_COLUMNS[field]
+        else:
+            column, default = SAP_COLUMNS[field], 0.0
+        fixed[field] = float(sap_column([employee], column, default)[0])
+
+    component_fields = {'housing': 'housing_allowance', 'cellphone': 'cellphone_allowance',
+                        'data_service': 'data_service_allowance', 'medical_employee': 'medical_ee',
+                        'medical_employer': 'medical_er'}
+    for field, key in component_fields.items():
+        if components and key in components:
+            fixed[field] = float(sap_column([components], key, fixed[field])[0])
+    return fixed
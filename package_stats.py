@@ -0,0 +1,190 @@
+"""
+Materialised package statistics
+Analytics pages read package counts and TCTC totals, minimums and maximums
+from aggregates kept per band, department, status and upload, instead of
+scanning every package on each page load.
+
+The SQLite tables (package_stat_rows and package_stats in database.py) are
+maintained by triggers for employee_packages rows; the calculator's draft and
+submitted package files record theirs through record_package_stats on each
+write. The JSON PackageManager keeps a PackageStats cube in memory instead.
+rebuild_statistics() recomputes everything when the aggregates drift.
+"""
+
+import bisect
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database import DATABASE_STATS_SOURCE, RandwaterDatabase
+from money import from_cents, sum_money, to_cents
+
+logger = logging.getLogger(__name__)
+
+DRAFT_SOURCE = 'draft'
+SUBMITTED_SOURCE = 'submitted'
+FILE_SOURCES = (DRAFT_SOURCE, SUBMITTED_SOURCE)
+
+# Source name for the JSON PackageManager's in-memory cube
+MANAGER_SOURCE = 'packages'
+
+# Calculator package components that make up TCTC
+TCTC_COMPONENTS = ('tpe', 'car_allowance', 'housing_allowance', 'cellphone_allowance', 'data_service_allowance',
+                   'cash_component', 'bonus', 'pension_er', 'medical_er', 'group_life_er')
+
+Cell = Tuple[str, str, str, int]
+
+
+def _amount(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class PackageStats:
+    """
+    In-memory count, TCTC total, minimum and maximum per (band, department,
+    status, upload) cell, updated one package at a time.
+
+    Totals are kept in cents so repeated updates do not drift; each cell's
+    TCTC values stay sorted, so the minimum and maximum survive removals.
+    """
+
+    def __init__(self, source: str = MANAGER_SOURCE):
+        self.source = source
+        self._members: Dict[str, Tuple[Cell, int]] = {}
+        self._cells: Dict[Cell, List] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, key: str, cell: Cell, cents: int):
+        count_sum_values = self._cells.setdefault(cell, [0, 0, []])
+        count_sum_values[0] += 1
+        count_sum_values[1] += cents
+        bisect.insort(count_sum_values[2], cents)
+        self._members[key] = (cell, cents)
+
+    def _remove(self, key: str):
+        member = self._members.pop(key, None)
+        if member is None:
+            return
+        cell, cents = member
+        count_sum_values = self._cells[cell]
+        count_sum_values[0] -= 1
+        count_sum_values[1] -= cents
+        del count_sum_values[2][bisect.bisect_left(count_sum_values[2], cents)]
+        if not count_sum_values[0]:
+            del self._cells[cell]
+
+    def set(self, key: str, cell: Cell, tctc: float):
+        """Add a package, or move it to its new cell and TCTC"""
+        with self._lock:
+            self._remove(key)
+            self._add(key, cell, to_cents(_amount(tctc)))
+
+    def discard(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def rebuild(self, members: Iterable[Tuple[str, Cell, float]]):
+        """Replace the cube with (key, cell, tctc) members"""
+        with self._lock:
+            self._members, self._cells = {}, {}
+            for key, cell, tctc in members:
+                self._remove(key)
+                self._add(key, cell, to_cents(_amount(tctc)))
+
+    def clear(self):
+        self.rebuild([])
+
+    def cells(self) -> List[Dict]:
+        """Cells in the same shape as RandwaterDatabase.package_stat_cells"""
+        with self._lock:
+            return [{'source': self.source, 'band': cell[0], 'department': cell[1], 'status': cell[2],
+                     'upload_id': cell[3], 'packages': count, 'tctc_sum': from_cents(total),
+                     'tctc_min': from_cents(values[0]), 'tctc_max': from_cents(values[-1])}
+                    for cell, (count, total, values) in self._cells.items()]
+
+
+def manager_package_stat(package: Dict) -> Tuple[str, Cell, float]:
+    """(key, cell, tctc) of a PackageManager package; band and department come from its SAP data"""
+    info = package.get('employee_info') or {}
+    sap_data = package.get('sap_data') or {}
+    cell = (str(sap_data.get('BAND') or info.get('band') or ''),
+            str(sap_data.get('DEPARTMENT') or info.get('department') or ''),
+            str(package.get('status') or ''),
+            int(package.get('sap_upload_id') or 0))
+    return str(package.get('employee_id')), cell, _amount(package.get('current_tctc'))
+
+
+def stored_package_tctc(components: Dict) -> float:
+    """TCTC of a calculator draft or submitted package"""
+    return sum_money(_amount(components.get(key)) for key in TCTC_COMPONENTS)
+
+
+def stored_package_stat_row(source: str, employee_id: str, components: Dict,
+                            sap_row: Optional[Dict] = None) -> tuple:
+    """package_stat_rows tuple for a calculator draft or submitted package"""
+    sap_row = sap_row or {}
+    return (source, str(employee_id), str(employee_id), str(sap_row.get('BAND') or ''),
+            str(sap_row.get('DEPARTMENT') or ''), source, 0, stored_package_tctc(components or {}))
+
+
+def rebuild_statistics(db: RandwaterDatabase, packages: List[Dict], sap_rows: Dict[str, Dict]) -> int:
+    """
+    Recompute every materialised statistic from the stored packages.
+
+    packages are impact_engine.stored_packages() entries; band and
+    department come from the employee's SAP row. Returns the cell count.
+    """
+    file_rows = {source: [] for source in FILE_SOURCES}
+    for package in packages:
+        file_rows[package['source']].append(stored_package_stat_row(
+            package['source'], package['employee_id'], package.get('package_components'),
+            sap_rows.get(package['employee_id'])))
+    cells = db.rebuild_statistics(file_rows)
+    logger.info(f"Rebuilt package statistics: {cells} cell(s) from {len(packages)} stored package(s)")
+    return cells
+
+
+def latest_sap_rows(sap_uploads: List[Dict]) -> Dict[str, Dict]:
+    """Employee code -> row of the most recent SAP upload"""
+    if not sap_uploads:
+        return {}
+    latest_upload = max(sap_uploads, key=lambda x: x.get('upload_date', ''))
+    return {str(emp.get('EMPLOYEECODE', '')): emp for emp in latest_upload.get('employee_data', [])}
+
+
+def _group(cells: List[Dict], dimension: str, blank: str) -> Dict[str, Dict]:
+    groups = {}
+    for cell in cells:
+        key = cell[dimension]
+        key = blank if key in ('', None) else str(key)
+        groups.setdefault(key, []).append(cell)
+    return {key: _totals(group) for key, group in sorted(groups.items())}
+
+
+def _totals(cells: List[Dict]) -> Dict:
+    packages = sum(cell['packages'] for cell in cells)
+    total = sum_money(cell['tctc_sum'] for cell in cells)
+    return {
+        'packages': packages,
+        'total_tctc': total,
+        'avg_tctc': round(total / packages, 2) if packages else 0,
+        'min_tctc': min((cell['tctc_min'] for cell in cells), default=0),
+        'max_tctc': max((cell['tctc_max'] for cell in cells), default=0)
+    }
+
+
+def summarise(cells: List[Dict]) -> Dict:
+    """Overall totals plus a breakdown per band, department, status, upload and source"""
+    summary = _totals(cells)
+    summary.update({
+        'by_band': _group(cells, 'band', 'Unknown'),
+        'by_department': _group(cells, 'department', 'Unknown'),
+        'by_status': _group(cells, 'status', 'Unknown'),
+        'by_upload': _group(cells, 'upload_id', '0'),
+        'by_source': _group(cells, 'source', DATABASE_STATS_SOURCE)
+    })
+    return summary
+
@@ -0,0 +1,398 @@
+"""
+SQLite-backed PackageManager
+Same interface as models.PackageManager, stored in RandwaterDatabase's
+employee_packages, employees, sap_uploads, package_history and audit_log
+tables (WAL mode), so lookups go through indexes and every gunicorn worker
+sees the same state without rewriting whole files.
+
+Select it with PACKAGE_STORE=sqlite (and optionally PACKAGE_DB_PATH);
+the JSON store stays the default.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from database import (COMPONENT_COLUMNS, DATABASE_STATS_SOURCE, PACKAGE_AUDIT_TABLE, PACKAGE_COLUMNS,
+                      RandwaterDatabase, insert_employees, insert_upload, package_row)
+from db_models import ConcurrentUpdateError
+from models import PackageManager
+from package_stats import summarise
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_STORE_ENV = 'PACKAGE_STORE'
+PACKAGE_DB_ENV = 'PACKAGE_DB_PATH'
+PACKAGE_DB_FILE = 'randwater_data.db'
+
+UPLOADS_VERSION_KEY = 'sap_uploads_version'
+AUDIT_TABLE = PACKAGE_AUDIT_TABLE
+
+
+def _number(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _upload_digest(upload: Dict) -> str:
+    return hashlib.sha1(json.dumps(upload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class SqlPackageManager(PackageManager):
+    """PackageManager stored in the Randwater SQLite database"""
+
+    def __init__(self, db_path: str = PACKAGE_DB_FILE):
+        self.db = RandwaterDatabase(db_path)
+        self._lock = threading.RLock()
+        self.load_data()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The calling thread's pooled connection"""
+        return self.db.connection()
+
+    def load_data(self):
+        """Drop cached uploads; they are reloaded on next access"""
+        self._uploads = None
+        self._uploads_version = None
+        self._upload_digests = {}
+
+    def compact(self):
+        """Nothing to fold; every change is already a row"""
+
+    # SAP uploads stay a list attribute, as callers read and edit them in place
+    def _uploads_version_now(self) -> Optional[str]:
+        row = self.conn.execute('SELECT setting_value FROM system_settings WHERE setting_key = ?',
+                                (UPLOADS_VERSION_KEY,)).fetchone()
+        return row[0] if row else None
+
+    def _bump_uploads_version(self):
+        self.conn.execute('''
+            INSERT INTO system_settings (setting_key, setting_value, setting_type, description)
+            VALUES (?, '1', 'int', 'Incremented whenever SAP uploads change')
+            ON CONFLICT(setting_key) DO UPDATE SET
+                setting_value = CAST(setting_value AS INTEGER) + 1, last_updated = CURRENT_TIMESTAMP
+        ''', (UPLOADS_VERSION_KEY,))
+        self._uploads_version = self._uploads_version_now()
+
+    @property
+    def sap_uploads(self) -> List[Dict]:
+        with self._lock:
+            version = self._uploads_version_now()
+            if self._uploads is None or version != self._uploads_version:
+                self._uploads = self._load_uploads()
+                self._uploads_version = version
+            return self._uploads
+
+    @sap_uploads.setter
+    def sap_uploads(self, uploads: List[Dict]):
+        with self._lock:
+            self._uploads = list(uploads)
+
+    def _load_uploads(self) -> List[Dict]:
+        uploads = []
+        by_id = {}
+        for row in self.conn.execute('''
+            SELECT id, filename, upload_date, status, employee_count, financial_year, period
+            FROM sap_uploads ORDER BY id
+        '''):
+            upload = {
+                'id': row['id'],
+                'filename': row['filename'],
+                'upload_date': row['upload_date'],
+                'status': row['status'],
+                'employee_count': row['employee_count'],
+                'employee_data': [],
+                'financial_year': row['financial_year'],
+                'period': row['period']
+            }
+            uploads.append(upload)
+            by_id[row['id']] = upload
+        for upload_id, sap_data in self.conn.execute(
+                'SELECT upload_id, sap_data FROM employees WHERE sap_data IS NOT NULL ORDER BY id'):
+            if upload_id in by_id:
+                by_id[upload_id]['employee_data'].append(json.loads(sap_data))
+        self._upload_digests = {upload['id']: _upload_digest(upload) for upload in uploads}
+        return uploads
+
+    def _write_upload(self, upload: Dict) -> int:
+        """Insert or replace one upload and its employee rows; returns the upload id"""
+        employee_data = upload.get('employee_data', [])
+        fields = {
+            'filename': upload.get('filename', ''),
+            'file_path': f"uploads/{upload.get('filename', '')}",
+            'upload_date': upload.get('upload_date') or datetime.now().isoformat(),
+            'employee_count': upload.get('employee_count', len(employee_data)),
+            'status': upload.get('status', 'UPLOADED'),
+            'financial_year': upload.get('financial_year'),
+            'period': upload.get('period')
+        }
+        exists = upload.get('id') is not None and self.conn.execute(
+            'SELECT 1 FROM sap_uploads WHERE id = ?', (upload['id'],)).fetchone()
+        if exists:
+            self.conn.execute(f'''
+                UPDATE sap_uploads SET {', '.join(f'{column} = ?' for column in fields)} WHERE id = ?
+            ''', tuple(fields.values()) + (upload['id'],))
+            self.conn.execute('DELETE FROM employees WHERE upload_id = ?', (upload['id'],))
+            upload_id = upload['id']
+        else:
+            upload_id = insert_upload(self.conn, fields.pop('filename'), fields.pop('file_path'), employee_data,
+                                      **fields)
+        insert_employees(self.conn, upload_id, employee_data)
+        return upload_id
+
+    def _save_upload(self, upload_record: Dict):
+        with self._lock, self.conn:
+            # Load the cache first so the new upload is not read back and appended twice
+            uploads = self.sap_uploads
+            upload_record['id'] = self._write_upload(upload_record)
+            uploads.append(upload_record)
+            self._upload_digests[upload_record['id']] = _upload_digest(upload_record)
+            self._bump_uploads_version()
+
+    def save_data(self):
+        """Write back uploads that callers changed in place (package changes are already saved)"""
+        with self._lock, self.conn:
+            if self._uploads is None:
+                return
+            kept = {upload.get('id') for upload in self._uploads}
+            removed = [upload_id for upload_id in self._upload_digests if upload_id not in kept]
+            for upload_id in removed:
+                self.conn.execute('DELETE FROM employees WHERE upload_id = ?', (upload_id,))
+                self.conn.execute('DELETE FROM sap_uploads WHERE id = ?', (upload_id,))
+                del self._upload_digests[upload_id]
+
+            written = 0
+            for upload in self._uploads:
+                digest = _upload_digest(upload)
+                if upload.get('id') in self._upload_digests and self._upload_digests[upload['id']] == digest:
+                    continue
+                upload['id'] = self._write_upload(upload)
+                self._upload_digests[upload['id']] = _upload_digest(upload)
+                written += 1
+            if removed or written:
+                self._bump_uploads_version()
+                logger.info(f"Saved {written} changed and removed {len(removed)} SAP upload(s)")
+
+    def update_sap_employee(self, upload: Dict, employee_id: str, fields: Dict) -> bool:
+        """Change SAP columns on one employee's row of an upload; False if they are not in it"""
+        with self._lock, self.conn:
+            row = next((row for row in upload.get('employee_data', [])
+                        if str(row.get('EMPLOYEECODE', '')) == str(employee_id)), None)
+            if row is None:
+                return False
+            row.update(fields)
+            self.conn.execute('UPDATE employees SET sap_data = ? WHERE upload_id = ? AND employee_id = ?',
+                              (json.dumps(row, default=str), upload['id'], str(employee_id)))
+            self._upload_digests[upload['id']] = _upload_digest(upload)
+            self._bump_uploads_version()
+            return True
+
+    def set_upload_status(self, upload: Dict, status: str):
+        with self._lock, self.conn:
+            upload['status'] = status
+            self.conn.execute('UPDATE sap_uploads SET status = ? WHERE id = ?', (status, upload['id']))
+            self._upload_digests[upload['id']] = _upload_digest(upload)
+            self._bump_uploads_version()
+
+    def remove_sap_uploads(self, upload_ids: List):
+        """Drop the given uploads, keeping the rest"""
+        with self._lock, self.conn:
+            removed = set(upload_ids)
+            kept = [upload for upload in self.sap_uploads if upload.get('id') not in removed]
+            for upload_id in removed:
+                self.conn.execute('DELETE FROM employees WHERE upload_id = ?', (upload_id,))
+                self.conn.execute('DELETE FROM sap_uploads WHERE id = ?', (upload_id,))
+                self._upload_digests.pop(upload_id, None)
+            self._uploads = kept
+            self._bump_uploads_version()
+
+    def clear_sap_uploads(self):
+        """Clear all SAP upload data"""
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM employees')
+            self.conn.execute('DELETE FROM sap_uploads')
+            self._uploads = []
+            self._upload_digests = {}
+            self._bump_uploads_version()
+
+    # Packages
+    @classmethod
+    def _row_to_package(cls, row) -> Dict:
+        package = cls._row_package(row)
+        # The version it was read at, checked when it is written back
+        package['version'] = row['version'] or 0
+        return package
+
+    @staticmethod
+    def _row_package(row) -> Dict:
+        if row['package_data']:
+            return json.loads(row['package_data'])
+        # Rows from RandwaterDatabase.migrate_from_json only have the flat columns
+        return {
+            'employee_id': row['employee_id'],
+            'sap_upload_id': row['upload_id'],
+            'tctc_limit': row['target_tctc'],
+            'current_tctc': row['current_tctc'],
+            'package_components': {component: row[column] for column, component in COMPONENT_COLUMNS.items()},
+            'status': row['status'],
+            'created_date': row['created_date'],
+            'last_modified': row['last_modified'],
+            'submitted_date': row['submitted_date'],
+            'net_pay_calculation': None
+        }
+
+    @property
+    def packages(self) -> List[Dict]:
+        return self.get_all_packages()
+
+    def get_employee_package(self, employee_id: str) -> Optional[Dict]:
+        """Get package for specific employee"""
+        with self._lock:
+            row = self.conn.execute('SELECT * FROM employee_packages WHERE employee_id = ? ORDER BY id LIMIT 1',
+                                    (employee_id,)).fetchone()
+        return self._row_to_package(row) if row else None
+
+    def get_all_packages(self) -> List[Dict]:
+        """Get all employee packages"""
+        with self._lock:
+            rows = self.conn.execute('SELECT * FROM employee_packages ORDER BY id').fetchall()
+        return [self._row_to_package(row) for row in rows]
+
+    def get_submitted_packages(self) -> List[Dict]:
+        """Get all submitted packages"""
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM employee_packages WHERE status = 'SUBMITTED' ORDER BY id"
+                                     ).fetchall()
+        return [self._row_to_package(row) for row in rows]
+
+    def _save_new_package(self, package: Dict):
+        with self._lock, self.conn:
+            self.conn.execute(f'''
+                INSERT INTO employee_packages ({', '.join(PACKAGE_COLUMNS)})
+                VALUES ({', '.join('?' for _ in PACKAGE_COLUMNS)})
+            ''', package_row(package))
+
+    def _write_package(self, package: Dict):
+        """Write a package back; ConcurrentUpdateError if another worker wrote it since it was read"""
+        expected = package.get('version') or 0
+        package['version'] = expected + 1
+        cursor = self.conn.execute(f'''
+            UPDATE employee_packages SET {', '.join(f'{column} = ?' for column in PACKAGE_COLUMNS)},
+                version = COALESCE(version, 0) + 1
+            WHERE id = (SELECT id FROM employee_packages WHERE employee_id = ? ORDER BY id LIMIT 1)
+                AND COALESCE(version, 0) = ?
+        ''', package_row(package) + (package['employee_id'], expected))
+        if cursor.rowcount == 0:
+            package['version'] = expected
+            raise ConcurrentUpdateError([package['employee_id']])
+
+    def _save_package_update(self, package: Dict, components: Dict, previous: Dict):
+        with self._lock, self.conn:
+            self._write_package(package)
+            self.conn.executemany('''
+                INSERT INTO package_history (package_id, employee_id, field_name, old_value, new_value,
+                                             change_reason, change_date)
+                VALUES ((SELECT id FROM employee_packages WHERE employee_id = ? ORDER BY id LIMIT 1),
+                        ?, ?, ?, ?, 'package_update', ?)
+            ''', [(package['employee_id'], package['employee_id'], key, _number(previous.get(key)), value,
+                   package['last_modified'])
+                  for key, value in components.items() if _number(previous.get(key)) != value])
+
+    def _save_package_fields(self, package: Dict, fields: tuple):
+        with self._lock, self.conn:
+            self._write_package(package)
+
+    def clear_all_packages(self):
+        """Clear all employee packages"""
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM employee_packages')
+
+    def package_statistics(self) -> Dict:
+        """Package counts and TCTC totals, read from the trigger-maintained package_stats table"""
+        return summarise(self.db.package_stat_cells([DATABASE_STATS_SOURCE]))
+
+    def rebuild_statistics(self) -> int:
+        """Recompute the package_stats table from the stored rows"""
+        return self.db.rebuild_statistics()
+
+    def get_sap_data_for_employee(self, employee_id: str) -> Optional[Dict]:
+        """Get SAP data for a specific employee from the most recent upload"""
+        try:
+            package = self.get_employee_package(employee_id)
+            if package and package.get('sap_data'):
+                return package['sap_data']
+            with self._lock:
+                row = self.conn.execute('''
+                    SELECT sap_data FROM employees
+                    WHERE employee_id = ? AND sap_data IS NOT NULL
+                    ORDER BY upload_id DESC, id LIMIT 1
+                ''', (str(employee_id),)).fetchone()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            logger.error(f"Error getting SAP data for employee {employee_id}: {str(e)}")
+            return None
+
+    # Audit trail
+    @staticmethod
+    def _row_to_audit(row) -> Dict:
+        return {
+            'employee_id': row['record_id'],
+            'action': row['action'],
+            'changes': json.loads(row['new_data']) if row['new_data'] else {},
+            'user_type': row['user_type'],
+            'admin_user': row['user_id'],
+            'timestamp': row['timestamp'],
+            'audit_id': row['id']
+        }
+
+    def _save_audit_entry(self, audit_entry: Dict):
+        with self._lock, self.conn:
+            cursor = self.conn.execute('''
+                INSERT INTO audit_log (user_id, action, table_name, record_id, new_data, user_type, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (audit_entry['admin_user'], audit_entry['action'], AUDIT_TABLE, audit_entry['employee_id'],
+                  json.dumps(audit_entry['changes'], default=str), audit_entry['user_type'],
+                  audit_entry['timestamp']))
+            audit_entry['audit_id'] = cursor.lastrowid
+
+    @property
+    def audit_trail(self) -> List[Dict]:
+        with self._lock:
+            rows = self.conn.execute('SELECT * FROM audit_log WHERE table_name = ? ORDER BY id',
+                                     (AUDIT_TABLE,)).fetchall()
+        return [self._row_to_audit(row) for row in rows]
+
+    def get_employee_audit_trail(self, employee_id: str) -> List[Dict]:
+        """Get audit trail for a specific employee"""
+        with self._lock:
+            rows = self.conn.execute('''
+                SELECT * FROM audit_log WHERE table_name = ? AND record_id = ? ORDER BY id
+            ''', (AUDIT_TABLE, employee_id)).fetchall()
+        return [self._row_to_audit(row) for row in rows]
+
+
+def package_database(manager: Optional[PackageManager] = None) -> RandwaterDatabase:
+    """The Randwater database behind the SQLite store (also used for employee search)"""
+    if isinstance(manager, SqlPackageManager):
+        return manager.db
+    return RandwaterDatabase(os.environ.get(PACKAGE_DB_ENV, PACKAGE_DB_FILE))
+
+
+def create_package_manager() -> PackageManager:
+    """PackageManager for the configured store (PACKAGE_STORE=json|sqlite)"""
+    store = os.environ.get(PACKAGE_STORE_ENV, 'json').lower()
+    if store == 'sqlite':
+        db_path = os.environ.get(PACKAGE_DB_ENV, PACKAGE_DB_FILE)
+        logger.info(f"Using SQLite package store at {db_path}")
+        return SqlPackageManager(db_path)
+    if store != 'json':
+        logger.warning(f"Unknown {PACKAGE_STORE_ENV} '{store}', using the JSON package store")
+    return PackageManager()
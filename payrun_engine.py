@@ -0,0 +1,289 @@
+"""
+Tax-year-to-date pay-run engine
+Processes one financial year's SAP uploads in period order and computes PAYE
+with the cumulative method: year-to-date taxable income is annualised, taxed,
+de-annualised, and the PAYE already withheld is subtracted. Year-to-date
+totals are checkpointed after every period, so re-running a later period
+resumes from the last checkpoint that still matches its uploads.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batch_engine import DEPENDANT_COLUMNS, MEDICAL_MEMBER_COLUMNS, calculate_columns, load_columns
+from money import from_cents, to_cents_array
+from tax_engine import get_tax_table, rebate_array
+
+logger = logging.getLogger(__name__)
+
+PAYRUN_DIR = 'payrun_checkpoints'
+
+# Pay months covered by each upload period, in processing order
+PERIOD_MONTHS = {'Q1': 3, 'Q2': 3, 'Q3': 3, 'Q4': 3, 'ANNUAL': 12}
+PERIOD_ORDER = list(PERIOD_MONTHS)
+# The annual upload covers the same twelve months as the quarters, so a year uses one or the other
+QUARTERS = ('Q1', 'Q2', 'Q3', 'Q4')
+
+# Year-to-date totals kept per employee (cents, except months)
+YTD_FIELDS = ('months', 'earnings', 'taxable', 'medical_credits', 'paye', 'bonus_tax', 'uif', 'net_pay')
+
+# Per-period figures stored alongside each checkpoint
+PERIOD_FIELDS = ('earnings', 'paye', 'bonus_tax', 'uif', 'net_pay')
+
+# Input columns describing the person rather than an amount; duplicate rows keep the first row's value
+PERSON_COLUMNS = ('age', *MEDICAL_MEMBER_COLUMNS, *DEPENDANT_COLUMNS)
+
+
+class PayRunError(ValueError):
+    """Raised when a pay run cannot be started"""
+
+
+class YTDStore:
+    """Year-to-date arrays for every employee seen so far in the tax year"""
+
+    def __init__(self, employee_ids: Optional[List[str]] = None, values: Optional[Dict[str, np.ndarray]] = None):
+        self.employee_ids = list(employee_ids or [])
+        self.values = values or {field: np.zeros(len(self.employee_ids), dtype=np.int64) for field in YTD_FIELDS}
+        self._rows = {employee_id: i for i, employee_id in enumerate(self.employee_ids)}
+
+    def __len__(self) -> int:
+        return len(self.employee_ids)
+
+    def rows(self, employee_ids: List[str]) -> np.ndarray:
+        """Row index for each employee, adding rows for new starters"""
+        new_ids = [employee_id for employee_id in dict.fromkeys(employee_ids) if employee_id not in self._rows]
+        if new_ids:
+            for employee_id in new_ids:
+                self._rows[employee_id] = len(self.employee_ids)
+                self.employee_ids.append(employee_id)
+            self.values = {field: np.concatenate([column, np.zeros(len(new_ids), dtype=np.int64)])
+                           for field, column in self.values.items()}
+        return np.fromiter((self._rows[employee_id] for employee_id in employee_ids),
+                           dtype=np.int64, count=len(employee_ids))
+
+    def row(self, employee_id: str) -> Optional[int]:
+        return self._rows.get(employee_id)
+
+
+def merge_employee_rows(employee_ids: List[str],
+                        columns: Dict[str, np.ndarray]) -> Tuple[List[str], Dict[str, np.ndarray]]:
+    """One row per employee: amounts are summed, person columns come from their first row"""
+    unique_ids, first, inverse = np.unique(np.array(employee_ids, dtype=str),
+                                           return_index=True, return_inverse=True)
+    if len(unique_ids) == len(employee_ids):
+        return employee_ids, columns
+    merged = {}
+    for field, column in columns.items():
+        if field in PERSON_COLUMNS:
+            merged[field] = column[first]
+        else:
+            merged[field] = np.zeros(len(unique_ids), dtype=column.dtype)
+            np.add.at(merged[field], inverse, column)
+    return unique_ids.tolist(), merged
+
+
+def run_period(store: YTDStore, employee_data, months: int, settings: Optional[Dict] = None) -> Dict[str, np.ndarray]:
+    """
+    Add one period to the YTD store and return that period's figures.
+
+    Each upload holds monthly amounts, which are taken to repeat for every
+    month of the period. Employees missing from the upload accrue nothing,
+    and an employee listed twice is merged into one row before PAYE.
+    """
+    settings = settings or {}
+    employee_ids = [str(row.get('EMPLOYEECODE', '')) for row in employee_data]
+    employee_ids, columns = merge_employee_rows(employee_ids, load_columns(employee_data))
+    monthly = calculate_columns(columns, settings)
+
+    # Rows are unique after the merge, so each employee accrues the period once
+    rows = store.rows(employee_ids)
+    ytd = store.values
+    ytd['months'][rows] += months
+    ytd['taxable'][rows] += to_cents_array(monthly['taxable_income_annual'] / 12 * months)
+    ytd['medical_credits'][rows] += to_cents_array(monthly['medical_credit_monthly'] * months)
+
+    # Cumulative PAYE: tax on annualised YTD income, pro-rated to the months worked
+    months_ytd = ytd['months'][rows]
+    annualised = ytd['taxable'][rows] / 100 * 12 / months_ytd
+    annual_tax = get_tax_table(settings).tax_array(annualised) - rebate_array(columns['age'], settings)
+    liability = np.maximum(annual_tax * months_ytd / 12 - ytd['medical_credits'][rows] / 100, 0)
+    paye = np.maximum(to_cents_array(liability, 'paye') - ytd['paye'][rows], 0)
+
+    bonus_tax = to_cents_array(monthly['bonus_tax_provision'] * months, 'bonus_tax')
+    uif = to_cents_array(monthly['uif_employee'] * months, 'uif')
+    earnings = to_cents_array(monthly['total_earnings'] * months)
+    # Monthly net pay already deducts annualised PAYE; swap in the cumulative figure
+    net_pay = to_cents_array((monthly['net_pay'] + monthly['tax']) * months) - paye
+
+    period = {'rows': rows, 'earnings': earnings, 'paye': paye, 'bonus_tax': bonus_tax, 'uif': uif,
+              'net_pay': net_pay}
+    for field in PERIOD_FIELDS:
+        ytd[field][rows] += period[field]
+    return period
+
+
+def period_uploads(uploads: List[Dict], financial_year) -> List[Tuple[str, Dict]]:
+    """
+    Latest upload for each period of a financial year, in processing order.
+
+    When the year has quarterly uploads its ANNUAL upload is left out, so
+    the same months are never accrued twice.
+    """
+    latest = {}
+    for upload in uploads:
+        if str(upload.get('financial_year')) != str(financial_year):
+            continue
+        period = str(upload.get('period') or '').upper()
+        if period not in PERIOD_MONTHS:
+            continue
+        if period not in latest or upload.get('upload_date', '') > latest[period].get('upload_date', ''):
+            latest[period] = upload
+    if 'ANNUAL' in latest and any(quarter in latest for quarter in QUARTERS):
+        logger.warning(f"Financial year {financial_year} has quarterly uploads; ignoring its ANNUAL upload")
+        del latest['ANNUAL']
+    return [(period, latest[period]) for period in PERIOD_ORDER if period in latest]
+
+
+def _chain(previous: str, upload: Dict, rules_version: str) -> str:
+    """Checkpoint fingerprint: this period's upload and rules on top of the previous chain"""
+    payload = json.dumps([previous, upload.get('id'), upload.get('filename'), upload.get('upload_date'),
+                          rules_version], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class PayRunEngine:
+    """Runs tax years period by period with on-disk YTD checkpoints"""
+
+    def __init__(self, checkpoint_dir: str = PAYRUN_DIR):
+        self.checkpoint_dir = checkpoint_dir
+        self._lock = threading.Lock()
+
+    def _path(self, financial_year, index: int, period: str) -> str:
+        return os.path.join(self.checkpoint_dir, str(financial_year), f'{index + 1:02d}_{period}.npz')
+
+    def _save(self, path: str, store: YTDStore, period: Dict, meta: Dict):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {f'ytd_{field}': column for field, column in store.values.items()}
+        arrays.update({f'period_{field}': period[field] for field in PERIOD_FIELDS})
+        arrays['period_rows'] = period['rows']
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)),
+                                employee_ids=np.array(store.employee_ids, dtype=str), **arrays)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _load(path: str) -> Tuple[Dict, YTDStore, Dict[str, np.ndarray]]:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            store = YTDStore(data['employee_ids'].tolist(),
+                             {field: data[f'ytd_{field}'] for field in YTD_FIELDS})
+            period = {field: data[f'period_{field}'] for field in PERIOD_FIELDS}
+            period['rows'] = data['period_rows']
+        return meta, store, period
+
+    def _checkpoint_meta(self, path: str) -> Optional[Dict]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return json.loads(str(data['meta']))
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable pay-run checkpoint {path}: {str(e)}")
+            return None
+
+    def run(self, uploads: List[Dict], financial_year, through_period: Optional[str] = None,
+            settings_for: Optional[Callable[[Dict], Dict]] = None, rules_version: str = '') -> Dict:
+        """
+        Run a financial year up to and including through_period (all periods when omitted).
+
+        settings_for(upload) returns the tax rules for an upload's period.
+        Periods whose checkpoint matches the same uploads and rules are
+        loaded instead of recomputed.
+        """
+        schedule = period_uploads(uploads, financial_year)
+        if through_period:
+            through_period = str(through_period).upper()
+            periods = [period for period, _ in schedule]
+            if through_period not in periods:
+                raise PayRunError(f"No upload for period {through_period} in financial year {financial_year}")
+            schedule = schedule[:periods.index(through_period) + 1]
+        if not schedule:
+            raise PayRunError(f"No uploads for financial year {financial_year}")
+
+        # Fingerprint every period first; the longest matching prefix is reused
+        fingerprints = []
+        previous = ''
+        for period, upload in schedule:
+            previous = _chain(previous, upload, rules_version)
+            fingerprints.append(previous)
+
+        with self._lock:
+            resume = -1
+            for index, (period, _) in enumerate(schedule):
+                meta = self._checkpoint_meta(self._path(financial_year, index, period))
+                if not meta or meta.get('fingerprint') != fingerprints[index]:
+                    break
+                resume = index
+
+            store = YTDStore()
+            if resume >= 0:
+                _, store, _ = self._load(self._path(financial_year, resume, schedule[resume][0]))
+
+            summaries = []
+            for index, (period, upload) in enumerate(schedule):
+                path = self._path(financial_year, index, period)
+                if index <= resume:
+                    summaries.append(dict(self._checkpoint_meta(path)['summary'], reused=True))
+                    continue
+
+                started = datetime.now()
+                settings = settings_for(upload) if settings_for else {}
+                figures = run_period(store, upload.get('employee_data', []), PERIOD_MONTHS[period], settings)
+                summary = {'period': period, 'upload_id': upload.get('id'), 'filename': upload.get('filename'),
+                           'employees': int(len(figures['rows']))}
+                summary.update({f'total_{field}': from_cents(int(figures[field].sum())) for field in PERIOD_FIELDS})
+                self._save(path, store, figures, {'fingerprint': fingerprints[index], 'summary': summary,
+                                                  'processed_at': datetime.now().isoformat()})
+                logger.info(f"Pay run {financial_year} {period}: {summary['employees']} employees in "
+                            f"{(datetime.now() - started).total_seconds():.2f}s")
+                summaries.append(dict(summary, reused=False))
+
+        return {
+            'financial_year': str(financial_year),
+            'periods': summaries,
+            'reused_periods': resume + 1,
+            'employees': len(store)
+        }
+
+    def employee_history(self, uploads: List[Dict], financial_year, employee_id: str,
+                         rules_version: str = '') -> Optional[List[Dict]]:
+        """Per-period and YTD figures for one employee from the current checkpoints"""
+        history = []
+        previous = ''
+        for index, (period, upload) in enumerate(period_uploads(uploads, financial_year)):
+            previous = _chain(previous, upload, rules_version)
+            path = self._path(financial_year, index, period)
+            meta = self._checkpoint_meta(path)
+            if not meta or meta.get('fingerprint') != previous:
+                break
+            meta, store, figures = self._load(path)
+            row = store.row(str(employee_id))
+            if row is None:
+                continue
+            entry = {'period': period, 'processed_at': meta.get('processed_at')}
+            position = np.flatnonzero(figures['rows'] == row)
+            for field in PERIOD_FIELDS:
+                entry[field] = from_cents(int(figures[field][position[0]])) if len(position) else 0.0
+            entry['months_ytd'] = int(store.values['months'][row])
+            for field in YTD_FIELDS[1:]:
+                entry[f'{field}_ytd'] = from_cents(int(store.values[field][row]))
+            history.append(entry)
+        return history or None
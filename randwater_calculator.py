@@ -1,5 +1,6 @@
 from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session, g, flash
 import json
+import hashlib
 import math
 import io
 from reportlab.lib.pagesizes import A4
@@ -9,8 +10,30 @@ import os
 from datetime import datetime, timedelta
 import logging
 import csv
+from itertools import islice
 from typing import Dict, List, Optional
-from models import PackageManager
+from package_store import SqlPackageManager, create_package_manager, package_database
+from database import EMPLOYEE_COLUMNS, search_employee_rows
+from tax_engine import calculate_tax, calculate_rebate, bracket_summary
+from money import from_cents, round_money, sum_money, to_cents
+from batch_engine import calculate_batch, calculate_package_batch, load_columns
+from tax_rules import TaxRulesRepository, upload_period_date
+from gross_up import GrossUpModel, net_pay_curve, solve_gross_up_batch
+from scenario_engine import ScenarioEngine, ScenarioError
+from scenario_sweep import SweepRunner, expand_grid
+from package_optimiser import OptimiserError, fixed_inputs_from_sap, optimise_package
+from option_matrix import OptionMatrixCache, matrix_fingerprint
+from payrun_engine import PayRunEngine, PayRunError
+from impact_engine import (DRAFTS_DIR, SUBMITTED_PACKAGES_FILE, diff_fingerprint, discard_preview, impact_diff,
+                           load_preview, persist_changes, save_preview, stored_packages)
+from calc_graph import CalcGraph
+from budget_rules import (BUDGET_RULES_FILE, BudgetRuleError, check_package, compile_rules, load_budget_rules,
+                          violations_report)
+from package_audit import PACKAGE_AUDIT_FILE, import_audit_file, query_package_audit, record_package_audit
+from audit_segments import AuditSegmentLog
+from system_log import SystemLog
+from package_stats import (DRAFT_SOURCE, FILE_SOURCES, SUBMITTED_SOURCE, latest_sap_rows as latest_upload_rows,
+                           rebuild_statistics, stored_package_stat_row, summarise)
 import smtplib
 from email.message import EmailMessage
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -218,26 +241,43 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Tax settings file for Rand Water
-TAX_SETTINGS_FILE = 'randwater_tax_settings.json'
+TAX_SETTINGS_FILE = 'tax_settings.json'
 
-# Initialize persistent storage for uploads
-package_builder = PackageManager()
+# Initialize persistent storage for uploads (PACKAGE_STORE selects JSON files or SQLite)
+package_builder = create_package_manager()
 
-def load_tax_settings():
-    """Load Rand Water specific tax settings"""
-    try:
-        with open(TAX_SETTINGS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {
-            "rebate_primary": 17235,
-            "rebate_secondary": 9444,
-            "rebate_tertiary": 3145,
-            "uif_ceiling": 177.12,
-            "medical_main": 364,
-            "medical_first": 364,
-            "medical_additional": 246
-        }
+# Effective-dated tax rules, reloaded only when the settings file changes
+tax_rules = TaxRulesRepository(TAX_SETTINGS_FILE)
+
+# Workforce what-if scenarios, cached by scenario hash
+scenario_engine = ScenarioEngine()
+
+# Parallel scenario sweeps (one process per core over shared-memory columns), state in scenario_sweeps/
+sweep_runner = SweepRunner()
+
+# Pension and group life options offered in the package builder
+PENSION_OPTIONS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'SAMWU']
+GROUP_LIFE_OPTIONS = ['standard', 'enhanced', 'none']
+
+# Every employee's outcome per option combination, built at SAP upload
+option_matrix_cache = OptionMatrixCache()
+
+# Cumulative (tax-year-to-date) PAYE runs with per-period checkpoints
+payrun_engine = PayRunEngine()
+
+# Package audit trail: rolling JSONL segments with a per-employee offset index
+package_audit_log = AuditSegmentLog()
+
+# Upload and configuration events: rotating JSONL segments with an in-memory tail
+system_log = SystemLog()
+
+# Per-editor package calculation graphs ((employee_id, editor) -> (tax version, graph))
+calc_graphs = {}
+CALC_GRAPH_LIMIT = 1000
+
+def load_tax_settings(period=None):
+    """Tax settings effective for a payroll period (defaults to today)"""
+    return tax_rules.get(period)
 
 class RandWaterSAPIntegration:
     """Rand Water specific SAP integration"""
@@ -512,8 +552,7 @@ def export_randwater_packages():
 def get_randwater_employee_data(employee_id):
     """Get Rand Water employee data from SAP uploads"""
     try:
-        from models import PackageManager
-        package_manager = PackageManager()
+        package_manager = create_package_manager()
         
         # Get SAP data for the employee
         sap_data = package_manager.get_sap_data_for_employee(employee_id)
@@ -611,13 +650,7 @@ def calculate_randwater():
         annual_tax = calculate_tax(taxable_income, settings)
 
         # Apply rebates
-        rebate = settings['rebate_primary']
-        if age >= 65:
-            rebate += settings['rebate_secondary']
-        if age >= 75:
-            rebate += settings['rebate_tertiary']
-
-        annual_tax -= rebate
+        annual_tax -= calculate_rebate(age, settings)
         annual_tax = max(0, annual_tax)
 
         # Medical tax credits
@@ -669,47 +702,6 @@ def parse_group(form, prefix):
         i += 1
     return result
 
-def calculate_tax(income, settings):
-    """Calculate tax using SARS brackets"""
-    try:
-        tax_brackets = json.loads(settings.get('tax_brackets', '[]'))
-        
-        if tax_brackets:
-            tax = 0
-            previous_threshold = 0
-            
-            for bracket in tax_brackets:
-                threshold = bracket['threshold']
-                rate = bracket['rate'] / 100
-                
-                if income > previous_threshold:
-                    taxable_in_bracket = min(income - previous_threshold, threshold - previous_threshold)
-                    tax += taxable_in_bracket * rate
-                
-                if income <= threshold:
-                    break
-                previous_threshold = threshold
-            
-            return tax
-    except:
-        pass
-    
-    # Fallback to default SARS brackets
-    brackets = [
-        (0, 237100, 0.18, 0),
-        (237101, 370500, 0.26, 42678),
-        (370501, 512800, 0.31, 77362),
-        (512801, 673000, 0.36, 121475),
-        (673001, 857900, 0.39, 179147),
-        (857901, 1817000, 0.41, 251258),
-        (1817001, float('inf'), 0.45, 644489),
-    ]
-    
-    for lower, upper, rate, base in brackets:
-        if income <= upper:
-            return base + (income - lower) * rate
-    return 0
-
 def save_randwater_completed_package(employee_id, package_data):
     """Save completed Rand Water package to local storage"""
     try:
@@ -795,37 +787,19 @@ def validate_package_changes(current_package, changes, fixed_ctc):
         # Calculate remaining budget for basic salary
         remaining_for_basic = fixed_ctc - fixed_components
         
+        # Band rules; basic salary takes whatever the fixed allocations leave
+        result = check_package(fixed_ctc, remaining_for_basic, car_allowance, bonus_annual, fixed_components,
+                               current_package.get('grade_band', ''))
+        
         # Auto-adjust basic salary to fit within CTC
-        if remaining_for_basic < 0:
-            return {
-                'valid': False,
-                'error': f'Car allowance and bonus exceed available budget. Available: R{fixed_ctc - (fixed_components - car_allowance - bonus_monthly):.2f}'
-            }
+        if result['errors']:
+            return {'valid': False, 'error': '; '.join(result['errors']), 'errors': result['errors']}
         
         # Update changes with calculated basic salary
         changes['basic_salary'] = remaining_for_basic
         changes['bonus'] = bonus_monthly  # Store monthly portion
         
-        # Validation warnings
-        warnings = []
-        basic_percentage = (remaining_for_basic / fixed_ctc) * 100
-        car_percentage = (car_allowance / fixed_ctc) * 100
-        bonus_percentage = (bonus_annual / fixed_ctc) * 100
-        
-        if basic_percentage < 50:
-            warnings.append(f"Basic salary auto-adjusted to {basic_percentage:.1f}% of CTC (below typical 50%)")
-        elif basic_percentage > 70:
-            warnings.append(f"Basic salary auto-adjusted to {basic_percentage:.1f}% of CTC (above typical 70%)")
-        
-        if car_allowance > 0 and car_percentage < 30:
-            warnings.append(f"Car allowance is {car_percentage:.1f}% of CTC (below 30% minimum for O to Q band)")
-        
-        if bonus_percentage < 10:
-            warnings.append(f"Annual bonus is {bonus_percentage:.1f}% of CTC (below 10% minimum)")
-        elif bonus_percentage > 70:
-            warnings.append(f"Annual bonus is {bonus_percentage:.1f}% of CTC (above 70% maximum)")
-        
-        return {'valid': True, 'warnings': warnings, 'auto_adjustments': changes}
+        return {'valid': True, 'warnings': result['warnings'], 'auto_adjustments': changes}
         
     except Exception as e:
         logger.error(f"Error validating changes: {str(e)}")
@@ -898,56 +872,6 @@ def calculate_employee_deductions(package_data):
             'total_deductions': 0
         }
 
-def load_tax_settings():
-    """Load tax settings from file"""
-    try:
-        with open('tax_settings.json', 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.warning(f"Could not load tax settings: {str(e)}")
-        # Return default tax settings
-        return {
-            "tax_brackets": [
-                {"min": 0, "max": 237100, "rate": 0.18, "cumulative": 0},
-                {"min": 237101, "max": 370500, "rate": 0.26, "cumulative": 42678},
-                {"min": 370501, "max": 512800, "rate": 0.31, "cumulative": 77362},
-                {"min": 512801, "max": 673000, "rate": 0.36, "cumulative": 121475},
-                {"min": 673001, "max": 857900, "rate": 0.39, "cumulative": 179147},
-                {"min": 857901, "max": 1817000, "rate": 0.41, "cumulative": 251258},
-                {"min": 1817001, "max": float('inf'), "rate": 0.45, "cumulative": 644489}
-            ],
-            "rebate_primary": 17235,
-            "rebate_secondary": 9444,
-            "rebate_tertiary": 3145,
-            "medical_credits_limit": 332,
-            "uif_ceiling": 177.12
-        }
-
-def calculate_tax(annual_taxable_income, tax_settings):
-    """Calculate annual tax using tax brackets"""
-    try:
-        tax_brackets = tax_settings.get('tax_brackets', [])
-        
-        for bracket in tax_brackets:
-            if annual_taxable_income <= bracket['max']:
-                # Tax = cumulative + (excess * rate)
-                excess = annual_taxable_income - bracket['min']
-                tax = bracket['cumulative'] + (excess * bracket['rate'])
-                return max(0, tax)
-        
-        # If we get here, use the highest bracket
-        if tax_brackets:
-            highest_bracket = tax_brackets[-1]
-            excess = annual_taxable_income - highest_bracket['min']
-            tax = highest_bracket['cumulative'] + (excess * highest_bracket['rate'])
-            return max(0, tax)
-        
-        return 0
-        
-    except Exception as e:
-        logger.error(f"Error calculating tax: {str(e)}")
-        return 0
-
 def get_employee_package_data(employee_id):
     """Get current employee package data for calculations"""
     try:
@@ -1020,15 +944,19 @@ def calculate_employee_deductions(package_data):
         uif_cap = 177.12  # Fixed cap as per rules
         uif_contribution = min(gross_monthly * 0.01, uif_cap)
         
-        # Total deductions
+        # Total deductions, summed from the rounded parts so they always reconcile
         medical_aid = float(package_data.get('medical_aid', 0))
         pension_monthly = float(package_data.get('pension_fund', 0))
-        total_deductions = monthly_tax + uif_contribution + medical_aid + pension_monthly
+        paye_tax = round_money(monthly_tax, 'paye')
+        uif_contribution = round_money(uif_contribution, 'uif')
+        total_deductions = sum_money([paye_tax, uif_contribution,
+                                      round_money(medical_aid, 'medical'),
+                                      round_money(pension_monthly, 'pension')])
         
         return {
-            'paye_tax': round(monthly_tax, 2),
-            'uif_contribution': round(uif_contribution, 2),
-            'total_deductions': round(total_deductions, 2)
+            'paye_tax': paye_tax,
+            'uif_contribution': uif_contribution,
+            'total_deductions': total_deductions
         }
         
     except Exception as e:
@@ -1039,15 +967,23 @@ def calculate_employee_deductions(package_data):
             'total_deductions': 0
         }
 
+def package_audit_db():
+    """Database holding the package audit trail; an existing JSON audit file is imported on first use"""
+    db = package_database(package_builder)
+    import_audit_file(db)
+    return db
+
+def record_package_audit_entries(entries_by_employee):
+    """Append audit entries to the segment log and the audit_log query index"""
+    package_audit_log.import_json(PACKAGE_AUDIT_FILE)
+    package_audit_log.append_batch(entries_by_employee)
+    record_package_audit(package_audit_db(), entries_by_employee)
+
 def get_package_audit_trail(employee_id):
     """Get audit trail for package changes"""
     try:
-        audit_file = 'randwater_package_audit.json'
-        if os.path.exists(audit_file):
-            with open(audit_file, 'r') as f:
-                all_audits = json.load(f)
-                return all_audits.get(employee_id, [])
-        return []
+        package_audit_log.import_json(PACKAGE_AUDIT_FILE)
+        return package_audit_log.read_employee(employee_id)
     except Exception as e:
         logger.error(f"Error loading audit trail for {employee_id}: {str(e)}")
         return []
@@ -1086,27 +1022,9 @@ def save_package_changes(employee_id, changes, admin_user):
                     'action': 'field_update'
                 })
         
-        # Load existing audit trail
-        audit_file = 'randwater_package_audit.json'
-        if os.path.exists(audit_file):
-            with open(audit_file, 'r') as f:
-                all_audits = json.load(f)
-        else:
-            all_audits = {}
-        
-        # Add audit entries
-        if employee_id not in all_audits:
-            all_audits[employee_id] = []
-        all_audits[employee_id].extend(audit_entries)
-        
         # Apply changes with CTC budget constraints
         updated_package = current_package.copy()
         
-        # Handle the validation and auto-adjustment from frontend
-        validation_result = validate_package_changes(current_package, changes, fixed_ctc)
-        if not validation_result['valid']:
-            return {'success': False, 'error': validation_result['error']}
-        
         # Use the auto-adjusted values from validation
         if 'auto_adjustments' in validation_result:
             updated_package.update(validation_result['auto_adjustments'])
@@ -1146,48 +1064,30 @@ def save_package_changes(employee_id, changes, admin_user):
                         'action': 'auto_calculation'
                     })
         
-        # Add all audit entries
-        all_audits[employee_id].extend(audit_entries)
-        
         # Save audit trail
-        with open(audit_file, 'w') as f:
-            json.dump(all_audits, f, indent=2)
+        record_package_audit_entries({employee_id: audit_entries})
         
         # Update the actual employee data in persistent storage
         try:
             # Get the latest SAP upload data
             if package_builder.sap_uploads:
-                recent_uploads = package_builder.sap_uploads
-                recent_uploads.sort(key=lambda x: x.get('upload_date', ''), reverse=True)
-                latest_upload = recent_uploads[0]
-                
-                if 'employee_data' in latest_upload:
-                    # Find and update the employee data
-                    for i, emp_data in enumerate(latest_upload['employee_data']):
-                        if str(emp_data.get('EMPLOYEECODE', '')) == str(employee_id):
-                            # Update all the changed fields
-                            field_mapping = {
-                                'basic_salary': 'TPE',
-                                'car_allowance': 'CAR',
-                                'medical_aid': 'MEDICAL',
-                                'housing_allowance': 'HOUSING',
-                                'transport_allowance': 'TRANSPORT',
-                                'bonus': 'BONUSPROVISION',
-                                'pension_fund': 'PENSIONCONTRIBUTIONFUND',
-                                'paye_tax': 'PAYETAX',
-                                'uif_contribution': 'UIF'
-                            }
-                            
-                            for field_name, new_value in updated_package.items():
-                                if field_name in field_mapping:
-                                    latest_upload['employee_data'][i][field_mapping[field_name]] = new_value
-                            
-                            logger.info(f"Updated employee {employee_id} data in persistent storage")
-                            break
-                    
-                    # Save the updated data back to persistent storage
-                    package_builder.save_data()
-                    logger.info(f"Saved updated employee data to persistent storage")
+                latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+                field_mapping = {
+                    'basic_salary': 'TPE',
+                    'car_allowance': 'CAR',
+                    'medical_aid': 'MEDICAL',
+                    'housing_allowance': 'HOUSING',
+                    'transport_allowance': 'TRANSPORT',
+                    'bonus': 'BONUSPROVISION',
+                    'pension_fund': 'PENSIONCONTRIBUTIONFUND',
+                    'paye_tax': 'PAYETAX',
+                    'uif_contribution': 'UIF'
+                }
+                # Journalled as one row change rather than a rewrite of the uploads
+                fields = {field_mapping[field_name]: new_value for field_name, new_value in updated_package.items()
+                          if field_name in field_mapping}
+                if package_builder.update_sap_employee(latest_upload, employee_id, fields):
+                    logger.info(f"Updated employee {employee_id} data in persistent storage")
                     
         except Exception as e:
             logger.warning(f"Could not update persistent storage: {str(e)}")
@@ -1715,42 +1615,10 @@ def get_active_randwater_employees():
 def save_system_log(log_entry):
     """Save system log entry for admin viewing"""
     try:
-        logs_file = 'system_logs.json'
-        logs = []
-        
-        # Load existing logs
-        if os.path.exists(logs_file):
-            try:
-                with open(logs_file, 'r') as f:
-                    logs = json.load(f)
-            except json.JSONDecodeError:
-                logs = []
-        
-        # Add new log entry with ID
-        log_entry['id'] = len(logs) + 1
-        logs.append(log_entry)
-        
-        # Keep only last 100 logs
-        logs = logs[-100:]
-        
-        # Save logs
-        with open(logs_file, 'w') as f:
-            json.dump(logs, f, indent=2)
+        system_log.append(log_entry)
     except Exception as e:
         logger.error(f"Error saving system log: {str(e)}")
 
-def load_system_logs():
-    """Load system logs for admin viewing"""
-    try:
-        logs_file = 'system_logs.json'
-        if os.path.exists(logs_file):
-            with open(logs_file, 'r') as f:
-                return json.load(f)
-        return []
-    except Exception as e:
-        logger.error(f"Error loading system logs: {str(e)}")
-        return []
-
 def load_sap_uploads():
     """Load SAP uploads from JSON file"""
     try:
@@ -2885,6 +2753,9 @@ def upload_sap_data_post():
                     # Create employee access records for O-Q band employees
                     create_employee_access_records(df, current_user)
                     
+                    # Precompute every option combination for the package builder
+                    start_option_matrix_build(upload_record)
+                    
                 except Exception as storage_error:
                     logger.error(f"Error storing in persistent storage: {str(storage_error)}")
                     logger.info("Continuing with session storage only")
@@ -3005,19 +2876,9 @@ def archive_current_data():
         if hasattr(package_builder, 'sap_uploads') and package_builder.sap_uploads:
             for upload in package_builder.sap_uploads:
                 if not upload.get('status', '').startswith('ARCHIVED'):
-                    upload['status'] = f"ARCHIVED_{archive_timestamp}"
+                    package_builder.set_upload_status(upload, f"ARCHIVED_{archive_timestamp}")
                     archived_count += 1
-                    
-                    # Fix Timestamp serialization in employee_data
-                    if 'employee_data' in upload and upload['employee_data']:
-                        for emp in upload['employee_data']:
-                            for key, value in emp.items():
-                                if pd.notna(value) and hasattr(value, 'isoformat'):
-                                    emp[key] = value.isoformat()
-                                elif pd.isna(value):
-                                    emp[key] = None
             
-            package_builder.save_data()
             logger.info(f"✓ Archived {archived_count} SAP upload(s)")
         else:
             logger.info("- No uploads to archive")
@@ -3082,6 +2943,7 @@ def clear_uploaded_data():
         if os.path.exists(submitted_packages_file):
             with open(submitted_packages_file, 'w') as f:
                 json.dump([], f)
+            package_database(package_builder).remove_package_stats(SUBMITTED_SOURCE)
             logger.info("✓ Cleared submitted packages")
         
         cleared_count = 0
@@ -3090,8 +2952,8 @@ def clear_uploaded_data():
             # Count current uploads before filtering
             cleared_count = len([u for u in package_builder.sap_uploads if not u.get('status', '').startswith('ARCHIVED')])
             # Keep only archived uploads
-            package_builder.sap_uploads = [u for u in package_builder.sap_uploads if u.get('status', '').startswith('ARCHIVED')]
-            package_builder.save_data()
+            package_builder.remove_sap_uploads([u.get('id') for u in package_builder.sap_uploads
+                                                if not u.get('status', '').startswith('ARCHIVED')])
             logger.info(f"✓ Cleared {cleared_count} current SAP upload(s) (preserved archived)")
         else:
             logger.info("- No current uploads to clear")
@@ -3142,15 +3004,20 @@ def clear_uploaded_data():
 
 @app.route('/api/system-logs')
 def api_system_logs():
-    """API endpoint to get system logs"""
+    """API endpoint to get system logs, newest first; ?before=<id>&limit= pages through older entries"""
     if not session.get('admin') and not session.get('isRandWaterAdmin'):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    logs = load_system_logs()
-    # Reverse to show newest first
-    logs.reverse()
-    
-    return jsonify(logs)
+    try:
+        before = request.args.get('before', type=int)
+        if before is None:
+            return jsonify(system_log.recent())
+        
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+        return jsonify(list(islice(system_log.history(before), limit)))
+    except Exception as e:
+        logger.error(f"Error loading system logs: {str(e)}")
+        return jsonify([])
 
 @app.route('/api/send-employee-credentials', methods=['POST'])
 def send_employee_credentials():
@@ -3712,11 +3579,8 @@ def package_analytics():
         return redirect(url_for('randwater_admin_login'))
     
     try:
-        # Get all submitted packages
-        submitted_packages = []
-        if os.path.exists('submitted_packages.json'):
-            with open('submitted_packages.json', 'r') as f:
-                submitted_packages = json.load(f)
+        # Draft and submitted package statistics (materialised)
+        stats = stored_package_statistics()
         
         # Get all employees with access
         employee_data = []
@@ -3724,56 +3588,16 @@ def package_analytics():
             with open('employee_access.json', 'r') as f:
                 employee_data = json.load(f)
         
-        # Get all employee packages (including drafts)
-        all_packages = []
-        draft_packages = []
-        
-        # Load submitted packages
-        for pkg in submitted_packages:
-            if pkg.get('status') == 'submitted':
-                all_packages.append(pkg)
-        
-        # Load draft packages
-        if os.path.exists('drafts'):
-            for filename in os.listdir('drafts'):
-                if filename.startswith('package_') and filename.endswith('.json'):
-                    try:
-                        with open(os.path.join('drafts', filename), 'r') as f:
-                            draft = json.load(f)
-                            draft['status'] = 'draft'
-                            draft_packages.append(draft)
-                            all_packages.append(draft)
-                    except Exception as e:
-                        logger.warning(f"Could not load draft {filename}: {e}")
-        
         # Calculate analytics
-        total_packages = len(all_packages)
-        submitted_count = len([p for p in all_packages if p.get('status') == 'submitted'])
-        draft_count = len([p for p in all_packages if p.get('status') == 'draft'])
+        total_packages = stats['packages']
+        submitted_count = stats['by_source'].get(SUBMITTED_SOURCE, {}).get('packages', 0)
+        draft_count = stats['by_source'].get(DRAFT_SOURCE, {}).get('packages', 0)
         pending_count = len(employee_data) - total_packages
         
         # TCTC statistics
-        tctc_values = []
-        for pkg in all_packages:
-            components = pkg.get('package_components', {})
-            if components:
-                tctc = (
-                    float(components.get('tpe', 0)) +
-                    float(components.get('car_allowance', 0)) +
-                    float(components.get('housing_allowance', 0)) +
-                    float(components.get('cellphone_allowance', 0)) +
-                    float(components.get('data_service_allowance', 0)) +
-                    float(components.get('cash_component', 0)) +
-                    float(components.get('bonus', 0)) +
-                    float(components.get('pension_er', 0)) +
-                    float(components.get('medical_er', 0)) +
-                    float(components.get('group_life_er', 0))
-                )
-                tctc_values.append(tctc)
-        
-        avg_tctc = sum(tctc_values) / len(tctc_values) if tctc_values else 0
-        min_tctc = min(tctc_values) if tctc_values else 0
-        max_tctc = max(tctc_values) if tctc_values else 0
+        avg_tctc = stats['avg_tctc']
+        min_tctc = stats['min_tctc']
+        max_tctc = stats['max_tctc']
         
         # Grade band distribution
         grade_counts = {}
@@ -3802,7 +3626,8 @@ def package_analytics():
             },
             'grade_distribution': grade_counts,
             'department_distribution': dept_counts,
-            'tctc_values': tctc_values
+            'tctc_by_band': stats['by_band'],
+            'tctc_by_department': stats['by_department']
         }
         
         return render_template('package_analytics.html', 
@@ -3826,6 +3651,21 @@ def package_analytics():
         </html>
         """
 
+@app.route('/api/analytics/rebuild', methods=['POST'])
+def rebuild_package_statistics():
+    """Super Admin - Recompute the materialised package statistics to repair drift"""
+    if not session.get('isSuperAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        manager_cells = package_builder.rebuild_statistics()
+        stored_cells = rebuild_statistics(package_database(package_builder), stored_packages(), latest_sap_rows())
+        logger.info(f"Package statistics rebuilt by {session.get('username', 'superadmin')}")
+        return jsonify({'success': True, 'package_cells': manager_cells, 'stored_cells': stored_cells})
+    except Exception as e:
+        logger.error(f"Error rebuilding package statistics: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ============================================================================
 # REPORTING ROUTES
 # ============================================================================
@@ -3885,6 +3725,31 @@ def tax_reports():
         logger.error(f"Error loading tax reports: {e}")
         return f"Error: {str(e)}"
 
+@app.route('/api/tax_reports/net_pay')
+def tax_reports_net_pay():
+    """Net pay, PAYE and UIF for every employee in the latest SAP upload"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        if not package_builder.sap_uploads:
+            return jsonify({'success': True, 'employees': [], 'totals': {}, 'count': 0})
+        
+        latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+        period = upload_period_date(latest_upload.get('financial_year'), latest_upload.get('period'))
+        result = calculate_batch(latest_upload.get('employee_data', []), load_tax_settings(period))
+        
+        return jsonify({
+            'success': True,
+            'upload': latest_upload.get('filename', ''),
+            'count': len(result),
+            'employees': result.to_records(),
+            'totals': result.totals()
+        })
+    except Exception as e:
+        logger.error(f"Error calculating batch net pay: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/variance_dashboard')
 def variance_dashboard():
     """Variance Dashboard - Compare package changes"""
@@ -3905,22 +3770,47 @@ def audit_trail():
         return redirect(url_for('randwater_admin_login'))
     
     try:
-        # Load audit log
-        audit_logs = []
-        if os.path.exists('randwater_package_audit.json'):
-            with open('randwater_package_audit.json', 'r') as f:
-                audit_logs = json.load(f)
-        
-        # Sort by timestamp (newest first)
-        audit_logs.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        # First page of the audit log (newest first); the page fetches the rest from /api/audit
+        page = query_package_audit(package_audit_db())
         
         return render_template('audit_trail.html',
-                             audit_logs=audit_logs,
+                             audit_logs=page['entries'],
+                             next_cursor=page['next'],
                              config=RANDWATER_CONFIG)
     except Exception as e:
         logger.error(f"Error loading audit trail: {e}")
         return f"Error: {str(e)}"
 
+@app.route('/api/audit')
+def query_audit_trail():
+    """Package audit entries, newest first, filtered and keyset paginated"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit must be a number'}), 400
+    
+    try:
+        page = query_package_audit(
+            package_audit_db(),
+            employee_id=request.args.get('employee_id') or None,
+            start=request.args.get('from') or None,
+            end=request.args.get('to') or None,
+            action=request.args.get('action') or None,
+            user=request.args.get('user') or None,
+            after=request.args.get('after') or None,
+            limit=limit
+        )
+        return jsonify({'success': True, 'entries': page['entries'], 'count': len(page['entries']),
+                        'next': page['next']})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error querying audit trail: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/system_config_report')
 def system_config_report():
     """System Configuration Report - View Only"""
@@ -4099,27 +3989,28 @@ def export_audit_trail_csv():
         import io
         import csv
         
-        # Load audit log
-        audit_logs = []
-        if os.path.exists('randwater_package_audit.json'):
-            with open('randwater_package_audit.json', 'r') as f:
-                audit_logs = json.load(f)
-        
+        db = package_audit_db()
         output = io.StringIO()
         writer = csv.writer(output)
         
         # Write headers
         writer.writerow(['Timestamp', 'User', 'Action', 'Employee ID', 'Description'])
         
-        # Write data
-        for log in audit_logs:
-            writer.writerow([
-                log.get('timestamp', ''),
-                log.get('admin_username', 'System'),
-                log.get('action', ''),
-                log.get('employee_id', ''),
-                log.get('description', '')
-            ])
+        # Write data, a page at a time
+        after = None
+        while True:
+            page = query_package_audit(db, after=after, limit=1000)
+            for log in page['entries']:
+                writer.writerow([
+                    log.get('timestamp', ''),
+                    log.get('admin_username') or log.get('admin_user') or 'System',
+                    log.get('action', ''),
+                    log.get('employee_id', ''),
+                    log.get('description') or log.get('field_name') or log.get('changes', '')
+                ])
+            after = page['next']
+            if after is None:
+                break
         
         output.seek(0)
         
@@ -4168,6 +4059,121 @@ def save_simulation():
         logger.error(f"Error saving simulation: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/scenarios/run', methods=['POST'])
+def run_workforce_scenario():
+    """Apply what-if rules to the latest SAP upload and return cost, PAYE and net pay deltas"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        if not package_builder.sap_uploads:
+            return jsonify({'success': False, 'error': 'No SAP data uploaded'}), 404
+        
+        latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+        period = upload_period_date(latest_upload.get('financial_year'), latest_upload.get('period'))
+        result = scenario_engine.run(latest_upload, data.get('rules'),
+                                     load_tax_settings(period), tax_rules.version)
+        
+        if data.get('save'):
+            simulations_file = 'salary_simulations.json'
+            simulations = []
+            if os.path.exists(simulations_file):
+                with open(simulations_file, 'r') as f:
+                    simulations = json.load(f)
+            simulations = [s for s in simulations if s.get('id') != result['scenario_hash']]
+            simulations.append({
+                'id': result['scenario_hash'],
+                'type': 'workforce_scenario',
+                'name': data.get('name', 'Workforce scenario'),
+                'rules': result['rules'],
+                'upload': latest_upload.get('filename', ''),
+                'totals': result['totals'],
+                'saved_by': session.get('username', 'Unknown User'),
+                'saved_at': datetime.now().isoformat()
+            })
+            with open(simulations_file, 'w') as f:
+                json.dump(simulations, f, indent=2)
+            logger.info(f"Saved workforce scenario: {result['scenario_hash']}")
+        
+        return jsonify(dict(result, success=True, upload=latest_upload.get('filename', '')))
+    except ScenarioError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error running workforce scenario: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def sweep_dimensions(data):
+    """Build sweep dimensions from the request, expanding the shorthand lists"""
+    dimensions = list(data.get('dimensions') or [])
+    if data.get('increase_percent'):
+        dimensions.append({'name': 'increase_percent', 'options': [
+            {'label': value, 'rules': [{'action': 'increase', 'component': 'tpe', 'percent': value}]}
+            for value in data['increase_percent']
+        ]})
+    if data.get('pension_option'):
+        options = []
+        for option in data['pension_option']:
+            employee_rate, employer_rate = package_builder._get_pension_rates(str(option))
+            options.append({'label': option, 'rules': [{
+                'action': 'pension_rates', 'employee_percent': employee_rate, 'employer_percent': employer_rate
+            }]})
+        dimensions.append({'name': 'pension_option', 'options': options})
+    if data.get('bonus_percent'):
+        dimensions.append({'name': 'bonus_percent', 'options': [
+            {'label': value, 'rules': [{'action': 'increase', 'component': 'bonus', 'percent': value}]}
+            for value in data['bonus_percent']
+        ]})
+    return dimensions
+
+@app.route('/api/scenarios/sweep', methods=['POST'])
+def start_scenario_sweep():
+    """Start a parallel sweep over a grid of scenarios on the latest SAP upload"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        if not package_builder.sap_uploads:
+            return jsonify({'success': False, 'error': 'No SAP data uploaded'}), 404
+        
+        points = expand_grid(data.get('rules') or [], sweep_dimensions(data))
+        latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+        period = upload_period_date(latest_upload.get('financial_year'), latest_upload.get('period'))
+        job = sweep_runner.start(scenario_engine.workforce(latest_upload), points,
+                                 load_tax_settings(period), session.get('username', 'Unknown User'))
+        logger.info(f"Started scenario sweep {job.job_id} with {len(points)} grid points")
+        return jsonify(dict(job.to_dict(include_results=False), success=True,
+                            upload=latest_upload.get('filename', '')))
+    except ScenarioError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error starting scenario sweep: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/scenarios/sweep/<job_id>')
+def get_scenario_sweep(job_id):
+    """Progress and (partial) results of a scenario sweep"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    job = sweep_runner.status(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Sweep not found'}), 404
+    return jsonify(dict(job, success=True))
+
+@app.route('/api/scenarios/sweep/<job_id>/cancel', methods=['POST'])
+def cancel_scenario_sweep(job_id):
+    """Cancel a running scenario sweep; finished grid points are kept"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    job = sweep_runner.cancel(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Sweep not found'}), 404
+    logger.info(f"Cancel requested for scenario sweep {job_id}")
+    return jsonify(dict(job, success=True))
+
 @app.route('/get_saved_simulations')
 def get_saved_simulations():
     """Get all saved simulations"""
@@ -4508,7 +4514,7 @@ def employee_payslip(employee_id):
             payslip_data['payslip']['cellphone_allowance'] +
             payslip_data['payslip']['data_service_allowance']
         )
-        payslip_data['payslip']['total_earnings'] = round(total_earnings, 2)
+        payslip_data['payslip']['total_earnings'] = round_money(total_earnings)
         
         # Use saved UIF if available from package_components, otherwise calculate
         if 'uif' in package_components and package_components['uif'] > 0:
@@ -4516,7 +4522,7 @@ def employee_payslip(employee_id):
         elif not payslip_data['payslip']['uif_employee'] or payslip_data['payslip']['uif_employee'] == 0:
             uif_rate = 0.01  # 1%
             uif_amount = min(total_earnings * uif_rate, 177.12)
-            payslip_data['payslip']['uif_employee'] = round(uif_amount, 2)
+            payslip_data['payslip']['uif_employee'] = round_money(uif_amount, 'uif')
         
         # If we have a saved tax value from package_components, use it directly
         if 'tax' in package_components and package_components['tax'] > 0:
@@ -4559,19 +4565,7 @@ def employee_payslip(employee_id):
             # 5. Apply Primary Rebate (Age-based)
             # Get employee age if available, default to 0 if not provided
             employee_age = safe_float(employee_row.get('AGE', 0))
-            
-            primary_rebate = settings.get('rebate_primary', 17235)
-            
-            # Age-based rebates
-            secondary_rebate = 0
-            tertiary_rebate = 0
-            if employee_age >= 75:
-                tertiary_rebate = settings.get('rebate_tertiary', 3145)
-                secondary_rebate = settings.get('rebate_secondary', 9444)
-            elif employee_age >= 65:
-                secondary_rebate = settings.get('rebate_secondary', 9444)
-            
-            total_rebate = primary_rebate + secondary_rebate + tertiary_rebate
+            total_rebate = calculate_rebate(employee_age, settings)
             
             # 6. Apply Medical Tax Credit (MTC)
             medical_credit_annual = 0
@@ -4591,34 +4585,34 @@ def employee_payslip(employee_id):
             annual_tax = max(0, annual_tax)
             
             # 8. Calculate Monthly Tax
-            monthly_tax = round(annual_tax / 12, 2)
+            monthly_tax = round_money(annual_tax / 12, 'paye')
             payslip_data['payslip']['tax'] = monthly_tax
             
             # 9. Calculate Tax on Bonus
             bonus_annual = payslip_data['payslip']['bonus']
             bonus_tax_rate = 0.18
             bonus_tax_annual = bonus_annual * bonus_tax_rate
-            bonus_tax_monthly_provision = round(bonus_tax_annual / 12, 2)
+            bonus_tax_monthly_provision = round_money(bonus_tax_annual / 12, 'bonus_tax')
             payslip_data['payslip']['bonus_tax_provision'] = bonus_tax_monthly_provision
             
             # 10. Calculate Total Tax (Monthly Tax + Bonus Tax Provision)
-            total_tax_monthly = monthly_tax + bonus_tax_monthly_provision
-            payslip_data['payslip']['total_tax'] = round(total_tax_monthly, 2)
+            total_tax_monthly = sum_money([monthly_tax, bonus_tax_monthly_provision])
+            payslip_data['payslip']['total_tax'] = total_tax_monthly
             
             logger.info(f"CALCULATED tax for {employee_id}: R{total_tax_monthly:.2f}")
         
-        # Calculate total deductions
-        total_deductions = (
-            payslip_data['payslip']['pension_employee'] + 
-            payslip_data['payslip']['medical_employee'] + 
-            payslip_data['payslip']['group_life_employee'] + 
-            payslip_data['payslip']['uif_employee'] + 
+        # Calculate total deductions (summed in cents so they match the batch engine)
+        total_deductions = sum_money([
+            payslip_data['payslip']['pension_employee'],
+            payslip_data['payslip']['medical_employee'],
+            payslip_data['payslip']['group_life_employee'],
+            payslip_data['payslip']['uif_employee'],
             payslip_data['payslip']['total_tax']  # Use total_tax instead of separate tax + bonus_tax_provision
-        )
-        payslip_data['payslip']['total_deductions'] = round(total_deductions, 2)
+        ])
+        payslip_data['payslip']['total_deductions'] = total_deductions
         
         # Calculate net pay
-        payslip_data['payslip']['net_pay'] = round(payslip_data['payslip']['total_earnings'] - total_deductions, 2)
+        payslip_data['payslip']['net_pay'] = from_cents(to_cents(payslip_data['payslip']['total_earnings']) - to_cents(total_deductions))
         
         # Add package breakdown information for Rand Water format
         payslip_data['payslip']['package_breakdown'] = {
@@ -4754,6 +4748,835 @@ def net_pay_calculate():
         logger.error(f"Error calculating net pay: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+BATCH_NET_PAY_LIMIT = 50000
+
+def parse_batch_packages(raw_body, content_type):
+    """Parse a JSON array or NDJSON body into (packages, row errors)"""
+    text = raw_body.decode('utf-8-sig').strip()
+    if not text:
+        return [], {}
+    
+    if 'ndjson' not in content_type and text[0] in '[{':
+        try:
+            payload = json.loads(text)
+            if isinstance(payload, dict):
+                payload = payload['packages'] if 'packages' in payload else [payload]
+            if isinstance(payload, list):
+                return payload, {}
+        except ValueError:
+            if text[0] == '[':
+                raise
+    
+    # NDJSON: one package per line; a malformed line only fails that row
+    packages = []
+    errors = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            packages.append(json.loads(line))
+        except ValueError as e:
+            errors[len(packages)] = f"Invalid JSON: {str(e)}"
+            packages.append(None)
+    return packages, errors
+
+@app.route('/api/batch/net_pay', methods=['POST'])
+def batch_net_pay():
+    """Calculate net pay for an array (JSON or NDJSON) of packages in one request"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        packages, parse_errors = parse_batch_packages(request.get_data(), request.content_type or '')
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Invalid JSON: {str(e)}'}), 400
+    
+    if not packages:
+        return jsonify({'success': False, 'error': 'No packages supplied'}), 400
+    if len(packages) > BATCH_NET_PAY_LIMIT:
+        return jsonify({'success': False, 'error': f'A batch may contain at most {BATCH_NET_PAY_LIMIT} packages'}), 413
+    
+    try:
+        settings = load_tax_settings(request.args.get('period'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        result, errors = calculate_package_batch(packages, settings)
+        errors.update(parse_errors)
+        
+        results = []
+        for index, record in enumerate(result.to_records()):
+            if index in errors:
+                results.append({'index': index, 'success': False,
+                                'employee_id': record['employee_id'], 'error': errors[index]})
+            else:
+                results.append(dict(record, index=index, success=True))
+        
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'failed': len(errors),
+            'results': results
+        })
+    except Exception as e:
+        logger.error(f"Error calculating batch net pay: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def gross_up_rates(target, option_rates):
+    """Pension and group life rates (fractions of TPE) for a gross-up row"""
+    options = (str(target.get('pension_option', 'B')), str(target.get('group_life_option', 'standard')))
+    if options not in option_rates:
+        # Option lookups read pension_config.json, so resolve each pair once per request
+        pension_ee, pension_er = package_builder._get_pension_rates(options[0])
+        group_life = package_builder._get_group_life_rates(options[1])
+        option_rates[options] = (pension_ee, pension_er, group_life['employee'], group_life['employer'])
+    pension_ee, pension_er, group_life_ee, group_life_er = option_rates[options]
+    return {
+        'pension_employee': float(target.get('pension_employee_rate', pension_ee)) / 100,
+        'pension_employer': float(target.get('pension_employer_rate', pension_er)) / 100,
+        'group_life_employee': float(target.get('group_life_employee_rate', group_life_ee)) / 100,
+        'group_life_employer': float(target.get('group_life_employer_rate', group_life_er)) / 100
+    }
+
+@app.route('/api/gross_up', methods=['POST'])
+def gross_up():
+    """Solve the monthly cash salary that gives a target take-home (single target or batch)"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and 'targets' in data:
+        targets = data['targets']
+    elif isinstance(data, dict):
+        targets = [data]
+    else:
+        targets = data
+    
+    if not isinstance(targets, list) or not targets:
+        return jsonify({'success': False, 'error': 'No targets supplied'}), 400
+    if len(targets) > BATCH_NET_PAY_LIMIT:
+        return jsonify({'success': False, 'error': f'A batch may contain at most {BATCH_NET_PAY_LIMIT} targets'}), 413
+    
+    try:
+        settings = load_tax_settings(request.args.get('period'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        rates = []
+        rate_errors = {}
+        option_rates = {}
+        for index, target in enumerate(targets):
+            try:
+                rates.append(gross_up_rates(target if isinstance(target, dict) else {}, option_rates))
+            except (TypeError, ValueError):
+                rate_errors[index] = 'Pension and group life rates must be numbers'
+                rates.append(gross_up_rates({}, option_rates))
+        
+        results, errors = solve_gross_up_batch(targets, rates, settings)
+        for index, message in rate_errors.items():
+            if results[index]['success']:
+                results[index] = {'index': index, 'employee_id': results[index]['employee_id'],
+                                  'success': False, 'error': message}
+                errors[index] = message
+        
+        if isinstance(data, dict) and 'targets' not in data:
+            result = results[0]
+            return jsonify(dict(result, success=result['success'])), (200 if result['success'] else 400)
+        
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'failed': len(errors),
+            'results': results
+        })
+    except Exception as e:
+        logger.error(f"Error solving gross-up: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Package component keys (drafts/submitted packages) -> SAP columns
+PACKAGE_COMPONENT_COLUMNS = {
+    'tpe': 'TPE',
+    'car_allowance': 'CAR',
+    'housing_allowance': 'HOUSING',
+    'cellphone_allowance': 'CELLPHONEALLOWANCE',
+    'data_service_allowance': 'DATASERVICEALLOWANCE',
+    'bonus': 'BONUSPROVISION',
+    'pension_ee': 'PENSIONEECONTRIBUTION',
+    'pension_er': 'PENSIONERCONTRIBUTION',
+    'medical_ee': 'MEDICALEECONTRIBUTION',
+    'medical_er': 'MEDICALERCONTRIBUTION',
+    'group_life_ee': 'GROUPLIFEEECONTRIBUTION',
+    'group_life_er': 'GROUPLIFEERCONTRIBUTION'
+}
+
+# Net pay curve responses, least recently used first (employee_id -> (input stamp, payload))
+net_pay_curves = {}
+NET_PAY_CURVE_LIMIT = 1000
+
+def get_latest_sap_employee(employee_id):
+    """Employee row from the most recent SAP upload, or None"""
+    if not package_builder.sap_uploads:
+        return None
+    latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+    for emp_data in latest_upload.get('employee_data', []):
+        if str(emp_data.get('EMPLOYEECODE', '')) == str(employee_id):
+            return emp_data
+    return None
+
+def get_current_package_components(employee_id):
+    """Package components from the employee's draft, else their submitted package"""
+    draft_file = f'drafts/package_{employee_id}.json'
+    if os.path.exists(draft_file):
+        try:
+            with open(draft_file, 'r') as f:
+                components = json.load(f).get('package_components', {})
+            if components:
+                return components
+        except Exception as e:
+            logger.warning(f"Could not load draft for {employee_id}: {e}")
+    
+    if os.path.exists('submitted_packages.json'):
+        try:
+            with open('submitted_packages.json', 'r') as f:
+                for pkg in json.load(f):
+                    if pkg.get('employee_id') == employee_id and pkg.get('status') == 'submitted':
+                        return pkg.get('package_components', {})
+        except Exception as e:
+            logger.warning(f"Could not load submitted packages: {e}")
+    return {}
+
+def net_pay_curve_stamp(employee_id):
+    """What the employee's curve depends on, from file stats rather than file contents"""
+    stamp = [tax_rules.version]
+    for path in (os.path.join(DRAFTS_DIR, f'package_{employee_id}.json'), SUBMITTED_PACKAGES_FILE):
+        try:
+            st = os.stat(path)
+            stamp.append([st.st_mtime_ns, st.st_size])
+        except OSError:
+            stamp.append(None)
+    if package_builder.sap_uploads:
+        latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+        stamp.append([latest_upload.get('id'), latest_upload.get('upload_date'), len(package_builder.sap_uploads)])
+    return json.dumps(stamp, default=str)
+
+def build_net_pay_curve(employee_id):
+    """
+    Curve payload for an employee's current package. LookupError when the
+    employee is not in the SAP data, ValueError when the package cannot be
+    modelled.
+    """
+    employee_row = get_latest_sap_employee(employee_id)
+    if employee_row is None:
+        raise LookupError(f'Employee {employee_id} not found in uploaded SAP data')
+    
+    # Current package values win over the original SAP figures
+    components = get_current_package_components(employee_id)
+    package_row = dict(employee_row)
+    for component, column in PACKAGE_COMPONENT_COLUMNS.items():
+        if component in components:
+            package_row[column] = components[component]
+    row = {field: float(column[0]) for field, column in load_columns([package_row]).items()}
+    
+    try:
+        ctc = float(employee_row.get('CTC') or employee_row.get('TCTC') or 0)
+    except (TypeError, ValueError):
+        ctc = 0.0
+    if ctc <= 0:
+        raise ValueError(f'Employee {employee_id} has no CTC in the SAP data')
+    
+    tpe = row['tpe']
+    if tpe > 0:
+        rates = {
+            'pension_employee': row['pension_employee'] / tpe,
+            'pension_employer': row['pension_employer'] / tpe,
+            'group_life_employee': row['group_life_employee'] / tpe,
+            'group_life_employer': row['group_life_employer'] / tpe
+        }
+    else:
+        rates = gross_up_rates({}, {})
+    
+    # TPE only drives pension; cash is what the CTC leaves, as on the package edit page
+    model = GrossUpModel.for_tpe(row, rates, ctc, load_tax_settings())
+    fingerprint = hashlib.sha256(
+        json.dumps([row, rates, ctc, tax_rules.version], sort_keys=True).encode('utf-8')
+    ).hexdigest()[:16]
+    return {
+        'success': True,
+        'employee_id': employee_id,
+        'version': fingerprint,
+        'ctc': round(ctc, 2),
+        'current_tpe': round(tpe, 2),
+        'current_cash': round(model.cash_at(tpe), 2),
+        'current_net_pay': round(model.net_pay(tpe), 2),
+        'rates': rates,
+        'curve': net_pay_curve(model)
+    }
+
+@app.route('/api/employee/<employee_id>/net_pay_curve')
+def employee_net_pay_curve(employee_id):
+    """Piecewise-linear take-home curve over TPE for the simulator sliders"""
+    is_admin = session.get('admin') or session.get('isRandWaterAdmin')
+    is_employee = session.get('employee_id') == employee_id
+    if not is_admin and not is_employee:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        stamp = net_pay_curve_stamp(employee_id)
+        cached = net_pay_curves.pop(employee_id, None)
+        if cached and cached[0] == stamp:
+            payload = cached[1]
+        else:
+            payload = build_net_pay_curve(employee_id)
+        net_pay_curves[employee_id] = (stamp, payload)
+        while len(net_pay_curves) > NET_PAY_CURVE_LIMIT:
+            net_pay_curves.pop(next(iter(net_pay_curves)))
+        
+        response = jsonify(payload)
+        response.set_etag(payload['version'])
+        return response.make_conditional(request)
+    except LookupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error building net pay curve for {employee_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/employee/<employee_id>/optimise_package', methods=['POST'])
+def optimise_employee_package(employee_id):
+    """TPE / car / bonus / pension option split that maximises take-home within the CTC"""
+    is_admin = session.get('admin') or session.get('isRandWaterAdmin')
+    is_employee = session.get('employee_id') == employee_id
+    if not is_admin and not is_employee:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        employee = get_latest_sap_employee(employee_id)
+        if employee is None:
+            return jsonify({'success': False, 'error': 'Employee not found in SAP data'}), 404
+        
+        ctc = float(data.get('tctc') or get_employee_fixed_ctc(employee_id) or 0)
+        fixed = fixed_inputs_from_sap(employee, get_current_package_components(employee_id))
+        group_life_option = str(data.get('group_life_option', 'standard'))
+        group_life = package_builder._get_group_life_rates(group_life_option)
+        
+        pension_options = data.get('pension_options') or PENSION_OPTIONS
+        if not isinstance(pension_options, list):
+            return jsonify({'success': False, 'error': 'pension_options must be a list'}), 400
+        pension_options = list(dict.fromkeys(str(option).upper() for option in pension_options))
+        unknown = [option for option in pension_options if option not in PENSION_OPTIONS]
+        if unknown:
+            return jsonify({'success': False, 'error': f"Unknown pension option(s): {', '.join(unknown)}"}), 400
+        
+        options = []
+        for pension_option in pension_options:
+            pension_ee, pension_er = package_builder._get_pension_rates(pension_option)
+            options.append({
+                'pension_option': pension_option,
+                'group_life_option': group_life_option,
+                'pension_employee': pension_ee / 100,
+                'pension_employer': pension_er / 100,
+                'group_life_employee': group_life['employee'] / 100,
+                'group_life_employer': group_life['employer'] / 100
+            })
+        
+        result = optimise_package(ctc, fixed, options, load_tax_settings(),
+                                  objective=data.get('objective', 'annual'),
+                                  top_n=data.get('top_n', 5),
+                                  step_percent=data.get('step_percent', 1.0))
+        if result['best'] is None:
+            return jsonify(dict(result, success=False, employee_id=employee_id, tctc=ctc,
+                                error='No package split satisfies the O-Q band rules for this CTC')), 422
+        return jsonify(dict(result, success=True, employee_id=employee_id, tctc=ctc))
+    except (OptimiserError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error optimising package for {employee_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def config_file_version(path):
+    """Modification marker for a rates file ('' when it does not exist)"""
+    try:
+        st = os.stat(path)
+        return f"{st.st_mtime_ns}-{st.st_size}"
+    except OSError:
+        return ''
+
+def option_matrix_key(upload):
+    """Fingerprint of an upload and the tax/pension/medical rates applied to it"""
+    return matrix_fingerprint(upload, tax_rules.version, config_file_version('pension_config.json'),
+                              config_file_version('medical_aid_rates.json'))
+
+def start_option_matrix_build(upload):
+    """Build the option matrix for an upload in the background"""
+    pension_rates = {option: package_builder._get_pension_rates(option) for option in PENSION_OPTIONS}
+    group_life_rates = {option: package_builder._get_group_life_rates(option) for option in GROUP_LIFE_OPTIONS}
+    period = upload_period_date(upload.get('financial_year'), upload.get('period'))
+    return option_matrix_cache.build_async(upload, option_matrix_key(upload), pension_rates, group_life_rates,
+                                           load_medical_aid_rates(), load_tax_settings(period))
+
+@app.route('/api/employee/<employee_id>/option_matrix')
+def employee_option_matrix(employee_id):
+    """Precomputed take-home for every pension, group life and medical option"""
+    is_admin = session.get('admin') or session.get('isRandWaterAdmin')
+    is_employee = session.get('employee_id') == employee_id
+    if not is_admin and not is_employee:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        if not package_builder.sap_uploads:
+            return jsonify({'success': False, 'error': 'No SAP data uploaded'}), 404
+        
+        latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+        key = option_matrix_key(latest_upload)
+        matrix = option_matrix_cache.get(latest_upload, key)
+        if matrix is None:
+            # Missing or built from older rates: rebuild and ask the client to retry
+            start_option_matrix_build(latest_upload)
+            return jsonify(dict(option_matrix_cache.status(latest_upload), success=False,
+                                error='Option matrix is being built, please retry shortly')), 202
+        
+        options = matrix.lookup(employee_id)
+        if options is None:
+            return jsonify({'success': False, 'error': 'Employee not found in SAP data'}), 404
+        
+        response = jsonify({
+            'success': True,
+            'employee_id': employee_id,
+            'upload_id': latest_upload.get('id'),
+            'version': key,
+            'pension_options': matrix.pension_options,
+            'group_life_options': matrix.group_life_options,
+            'medical_options': matrix.medical_options,
+            'options': options
+        })
+        response.set_etag(f"{key}-{employee_id}")
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.error(f"Error loading option matrix for {employee_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/option_matrix/status')
+def option_matrix_status():
+    """Build status of the option matrix for the latest SAP upload"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if not package_builder.sap_uploads:
+        return jsonify({'success': False, 'error': 'No SAP data uploaded'}), 404
+    latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''))
+    status = option_matrix_cache.status(latest_upload)
+    status['current'] = option_matrix_cache.get(latest_upload, option_matrix_key(latest_upload)) is not None
+    return jsonify(dict(status, success=True))
+
+def upload_tax_settings(upload):
+    """Tax settings effective for a SAP upload's financial year and period"""
+    return load_tax_settings(upload_period_date(upload.get('financial_year'), upload.get('period')))
+
+@app.route('/api/payrun/run', methods=['POST'])
+def run_payrun():
+    """Run cumulative PAYE for a financial year's uploads, resuming from checkpoints"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        financial_year = data.get('financial_year')
+        if not financial_year:
+            return jsonify({'success': False, 'error': 'financial_year is required'}), 400
+        
+        result = payrun_engine.run(package_builder.sap_uploads, financial_year, data.get('period'),
+                                   settings_for=upload_tax_settings, rules_version=tax_rules.version)
+        return jsonify(dict(result, success=True))
+    except PayRunError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error running pay run: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/payrun/<financial_year>/employee/<employee_id>')
+def employee_payrun_history(financial_year, employee_id):
+    """Per-period and year-to-date PAYE, UIF and net pay for one employee"""
+    is_admin = session.get('admin') or session.get('isRandWaterAdmin')
+    is_employee = session.get('employee_id') == employee_id
+    if not is_admin and not is_employee:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        history = payrun_engine.employee_history(package_builder.sap_uploads, financial_year, employee_id,
+                                                 rules_version=tax_rules.version)
+        if history is None:
+            return jsonify({'success': False, 'error': 'No pay run found for this employee and year'}), 404
+        return jsonify({'success': True, 'financial_year': financial_year, 'employee_id': employee_id,
+                        'periods': history})
+    except Exception as e:
+        logger.error(f"Error loading pay run history for {employee_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def impact_config(proposal=None):
+    """Tax, pension, group life and medical rates, with any proposed replacements applied"""
+    proposal = proposal or {}
+    if proposal.get('tax_settings') is not None:
+        tax = tax_rules.preview(proposal['tax_settings'])
+    else:
+        tax = load_tax_settings()
+    
+    pension = {option: package_builder._get_pension_rates(option) for option in PENSION_OPTIONS}
+    group_life = {option: package_builder._get_group_life_rates(option) for option in GROUP_LIFE_OPTIONS}
+    pension_config = proposal.get('pension_config')
+    if pension_config is not None:
+        # Options the proposal leaves out keep their current rates
+        for option, rates in pension_config.get('pension_rates', {}).get('options', {}).items():
+            if option.upper() in pension:
+                pension[option.upper()] = (rates.get('employee_rate', 8.67), rates.get('employer_rate', 17.19))
+        for option, rates in pension_config.get('group_life_rates', {}).get('options', {}).items():
+            if option.lower() in group_life:
+                group_life[option.lower()] = {'employee': rates.get('employee_rate', 0.2),
+                                              'employer': rates.get('employer_rate', 0.5)}
+    
+    medical = proposal.get('medical_aid_rates')
+    return {
+        'tax': tax,
+        'pension': pension,
+        'group_life': group_life,
+        'medical': medical if medical is not None else load_medical_aid_rates()
+    }
+
+# Latest SAP upload's rows by employee code ({'upload': upload, 'count': rows, 'rows': {...}})
+latest_sap_rows_cache = {}
+
+def latest_sap_rows():
+    """Employee code -> row of the most recent SAP upload, rebuilt only when that upload changes"""
+    uploads = package_builder.sap_uploads
+    latest_upload = max(uploads, key=lambda x: x.get('upload_date', ''), default=None)
+    count = len(latest_upload.get('employee_data', [])) if latest_upload else 0
+    # The same upload object holds rows edited in place; a reload (SQLite store) brings a new one
+    cache = latest_sap_rows_cache
+    if cache.get('upload') is not latest_upload or cache.get('count') != count:
+        cache.update(upload=latest_upload, count=count, rows=latest_upload_rows(uploads))
+    return cache['rows']
+
+def record_package_stats(source, employee_id, package_components):
+    """Keep the materialised draft/submitted statistics in step with a package file write"""
+    try:
+        sap_row = latest_sap_rows().get(str(employee_id))
+        package_database(package_builder).record_package_stats(
+            source, [stored_package_stat_row(source, employee_id, package_components, sap_row)])
+    except Exception as e:
+        # The package itself is saved; /api/analytics/rebuild repairs the statistics
+        logger.error(f"Could not record package statistics for {employee_id}: {str(e)}")
+
+def stored_package_statistics():
+    """Draft and submitted package statistics, built from the files the first time they are read"""
+    db = package_database(package_builder)
+    cells = db.package_stat_cells(list(FILE_SOURCES))
+    if not cells and (os.path.isdir(DRAFTS_DIR) or os.path.exists(SUBMITTED_PACKAGES_FILE)):
+        rebuild_statistics(db, stored_packages(), latest_sap_rows())
+        cells = db.package_stat_cells(list(FILE_SOURCES))
+    return summarise(cells)
+
+def run_impact_diff(proposal):
+    """Dry-run diff of a proposal over every stored draft and submitted package"""
+    return impact_diff(stored_packages(), latest_sap_rows(), impact_config(), impact_config(proposal))
+
+@app.route('/api/impact/preview', methods=['POST'])
+def preview_config_impact():
+    """Dry run: which stored packages a tax/pension/medical change affects, and how"""
+    if not session.get('isSuperAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        proposal = request.get_json(silent=True) or {}
+        proposal = {key: proposal[key] for key in ('tax_settings', 'pension_config', 'medical_aid_rates')
+                    if proposal.get(key) is not None}
+        if not proposal:
+            return jsonify({'success': False,
+                            'error': 'Provide tax_settings, pension_config or medical_aid_rates'}), 400
+        
+        diff = run_impact_diff(proposal)
+        preview_id = diff_fingerprint(diff) + hashlib.sha256(
+            json.dumps(proposal, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        save_preview(preview_id, {
+            'proposal': proposal,
+            'fingerprint': diff_fingerprint(diff),
+            'created_by': session.get('username', 'superadmin'),
+            'created_at': datetime.now().isoformat()
+        })
+        
+        return jsonify(dict(diff, success=True, preview_id=preview_id))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error previewing config impact: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/impact/apply', methods=['POST'])
+def apply_config_impact():
+    """Save a previewed config change and persist the recomputed packages"""
+    if not session.get('isSuperAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        preview = load_preview(data.get('preview_id'))
+        if not preview:
+            return jsonify({'success': False, 'error': 'Preview not found, please run the preview again'}), 404
+        
+        # Packages or rates may have moved on since the preview was reviewed
+        diff = run_impact_diff(preview['proposal'])
+        if diff_fingerprint(diff) != preview['fingerprint']:
+            return jsonify({'success': False,
+                            'error': 'Packages changed since the preview, please run the preview again'}), 409
+        
+        current_user = session.get('username', 'superadmin')
+        proposal = preview['proposal']
+        if 'tax_settings' in proposal:
+            with open(TAX_SETTINGS_FILE, 'w') as f:
+                json.dump(proposal['tax_settings'], f, indent=2)
+        if 'pension_config' in proposal:
+            pension_config = dict(proposal['pension_config'], last_updated=datetime.now().isoformat(),
+                                  updated_by=current_user)
+            with open('pension_config.json', 'w') as f:
+                json.dump(pension_config, f, indent=2)
+        if 'medical_aid_rates' in proposal:
+            with open('medical_aid_rates.json', 'w') as f:
+                json.dump(proposal['medical_aid_rates'], f, indent=2)
+        
+        written = persist_changes(diff['changes'])
+        rebuild_statistics(package_database(package_builder), stored_packages(), latest_sap_rows())
+        
+        # Audit each recalculated field
+        timestamp = datetime.now().isoformat()
+        all_audits = {}
+        for change in diff['changes']:
+            entries = [{
+                'timestamp': timestamp,
+                'admin_user': 'SYSTEM',
+                'field_name': field_name,
+                'old_value': values['old'],
+                'new_value': values['new'],
+                'action': 'config_recalculation',
+                'reasons': change['reasons']
+            } for field_name, values in change['changes'].items()]
+            all_audits.setdefault(change['employee_id'], []).extend(entries)
+        record_package_audit_entries(all_audits)
+        
+        save_system_log({
+            'action': 'CONFIG_RECALCULATION',
+            'user': current_user,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'details': {
+                'config': list(proposal),
+                'checked': diff['checked'],
+                'affected': diff['affected'],
+                'changed': diff['changed'],
+                'reasons': diff['reasons']
+            }
+        })
+        discard_preview(data.get('preview_id'))
+        logger.info(f"Config change applied by {current_user}: {written} packages recalculated")
+        return jsonify({'success': True, 'packages_updated': written, 'changed': diff['changed'],
+                        'affected': diff['affected'], 'reasons': diff['reasons']})
+    except Exception as e:
+        logger.error(f"Error applying config impact: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def package_graph_inputs(employee_id):
+    """Calculation graph inputs from the employee's current package, falling back to SAP"""
+    employee = get_latest_sap_employee(employee_id) or {}
+    components = get_current_package_components(employee_id)
+    sap_fields = {
+        'tpe': 'TPE',
+        'car_allowance': 'CAR',
+        'housing_allowance': 'HOUSING',
+        'cellphone_allowance': 'CELLPHONEALLOWANCE',
+        'data_service_allowance': 'DATASERVICEALLOWANCE',
+        'bonus': 'BONUSPROVISION',
+        'medical_ee': 'MEDICALEECONTRIBUTION',
+        'medical_er': 'MEDICALERCONTRIBUTION',
+        'age': 'AGE',
+        'main_members': 'MEDICALMAINMEMBER',
+        'first_dependants': 'MEDICALFIRSTDEPENDENT',
+        'additional_dependants': 'MEDICALADDITIONAL'
+    }
+    inputs = {}
+    for name, column in sap_fields.items():
+        value = components.get(name, employee.get(column))
+        if value not in (None, ''):
+            try:
+                inputs[name] = float(value)
+            except (TypeError, ValueError):
+                continue
+    inputs['ctc'] = get_employee_fixed_ctc(employee_id) or 0
+    inputs['pension_option'] = components.get('pension_option', 'B')
+    inputs['group_life_option'] = components.get('group_life_option', 'standard')
+    return inputs
+
+@app.route('/api/employee/<employee_id>/package_graph', methods=['POST'])
+def package_graph_update(employee_id):
+    """Incremental package recalculation: returns only the outputs an edit changed"""
+    is_admin = session.get('admin') or session.get('isRandWaterAdmin')
+    is_employee = session.get('employee_id') == employee_id
+    if not is_admin and not is_employee:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        changes = data.get('changes') or {}
+        key = (employee_id, session.get('username') or session.get('employee_id'))
+        cached = calc_graphs.pop(key, None)
+        
+        # Rebuild on first use, on request, after a tax rule change or if the client lost track
+        if (cached is None or data.get('reset') or cached[0] != tax_rules.version
+                or ('version' in data and data['version'] != cached[1].version)):
+            graph = CalcGraph(
+                package_graph_inputs(employee_id),
+                load_tax_settings(),
+                pension_rates=package_builder._get_pension_rates,
+                group_life_rates=package_builder._get_group_life_rates
+            )
+            graph.update(changes)
+            response = {'success': True, 'full': True, 'version': graph.version, 'values': graph.outputs()}
+        else:
+            graph = cached[1]
+            changed, recomputed = graph.update(changes)
+            response = {'success': True, 'full': False, 'version': graph.version, 'changed': changed,
+                        'recomputed': len(recomputed)}
+        
+        calc_graphs[key] = (tax_rules.version, graph)
+        while len(calc_graphs) > CALC_GRAPH_LIMIT:
+            calc_graphs.pop(next(iter(calc_graphs)))
+        return jsonify(response)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error updating package graph for {employee_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/budget_rules', methods=['GET'])
+def get_budget_rules():
+    """Band rules the package pages and validators apply"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin') and not session.get('employee_id'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'success': True, 'rules': [rule.to_dict() for rule in load_budget_rules()]})
+
+@app.route('/api/budget_rules', methods=['POST'])
+def save_budget_rules():
+    """Replace the band rules (super admin)"""
+    if not session.get('isSuperAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        rules = [rule.to_dict() for rule in compile_rules(data.get('rules'))]
+        with open(BUDGET_RULES_FILE, 'w') as f:
+            json.dump({'rules': rules, 'last_updated': datetime.now().isoformat(),
+                       'updated_by': session.get('username', 'superadmin')}, f, indent=2)
+        
+        save_system_log({
+            'action': 'budget_rules_updated',
+            'user': session.get('username', 'superadmin'),
+            'timestamp': datetime.now().isoformat(),
+            'details': f"Saved {len(rules)} budget rule(s)"
+        })
+        return jsonify({'success': True, 'rules': rules})
+    except BudgetRuleError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error saving budget rules: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/packages/violations')
+def package_violations():
+    """Budget rule violations across every draft and submitted package, by band and department"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        report = violations_report(stored_packages(), latest_sap_rows())
+        severity = request.args.get('severity')
+        if severity:
+            report['violations'] = [v for v in report['violations'] if v['severity'] == severity]
+        return jsonify(dict(report, success=True))
+    except Exception as e:
+        logger.error(f"Error building violations report: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Employee search rows for the JSON store ({'key': latest upload and access file stamp, 'rows': [...]})
+employee_search_cache = {}
+EMPLOYEE_SEARCH_FIELDS = ('title', 'firstname', 'surname', 'band', 'department', 'position', 'cost_center')
+
+def employee_search_rows():
+    """
+    Search rows for the employees the access page lists: the latest SAP
+    upload, with names and band from employee_access.json, plus employees
+    who only have an access record
+    """
+    try:
+        st = os.stat('employee_access.json')
+        access_stamp = [st.st_mtime_ns, st.st_size]
+    except OSError:
+        access_stamp = None
+    latest_upload = max(package_builder.sap_uploads, key=lambda x: x.get('upload_date', ''),
+                        default={})
+    key = [latest_upload.get('id'), latest_upload.get('upload_date'),
+           len(latest_upload.get('employee_data', [])), access_stamp]
+    if employee_search_cache.get('key') == key:
+        return employee_search_cache['rows']
+    
+    rows = {}
+    for emp in latest_upload.get('employee_data', []):
+        employee_id = str(emp.get('EMPLOYEECODE') or emp.get('EMPLOYEE') or '')
+        row = {field: str(emp.get(EMPLOYEE_COLUMNS[field]) or '') for field in EMPLOYEE_SEARCH_FIELDS}
+        rows[employee_id] = dict(row, id=None, employee_id=employee_id, upload_id=latest_upload.get('id'))
+    if access_stamp:
+        try:
+            with open('employee_access.json', 'r') as f:
+                access_records = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load employee access for search: {e}")
+            access_records = []
+        for record in access_records:
+            employee_id = str(record.get('employee_id', ''))
+            row = rows.setdefault(employee_id, dict({field: '' for field in EMPLOYEE_SEARCH_FIELDS}, id=None,
+                                                    employee_id=employee_id, upload_id=None))
+            row['firstname'] = record.get('first_name') or row['firstname']
+            row['surname'] = record.get('surname') or row['surname']
+            row['band'] = record.get('band') or row['band']
+    
+    rows = [row for employee_id, row in rows.items() if employee_id]
+    employee_search_cache.update(key=key, rows=rows)
+    return rows
+
+@app.route('/api/employees/search')
+def search_employees():
+    """Ranked prefix search over employee number, names, department and position"""
+    if not session.get('admin') and not session.get('isRandWaterAdmin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 200)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit must be a number'}), 400
+    
+    try:
+        if not query:
+            results = []
+        elif isinstance(package_builder, SqlPackageManager):
+            results = package_database(package_builder).search_employees(query, limit)
+        else:
+            # The JSON store does not load the employees table; search the employees the page lists
+            results = search_employee_rows(employee_search_rows(), query, limit)
+        return jsonify({'success': True, 'query': query, 'count': len(results), 'results': results})
+    except Exception as e:
+        logger.error(f"Error searching employees for '{query}': {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 def calculate_medical_aid_cost(provider, option, band_range, sub_adults, sub_children, unsub_adults, unsub_children):
     """Calculate medical aid cost based on provider, option, and members"""
     try:
@@ -5270,6 +6093,7 @@ def save_package_draft(employee_id):
         
         with open(draft_file, 'w') as f:
             json.dump(draft_data, f, indent=2)
+        record_package_stats(DRAFT_SOURCE, employee_id, package_components)
         
         # If admin saved the draft, create audit entry and notification
         if is_admin:
@@ -5282,20 +6106,7 @@ def save_package_draft(employee_id):
                 'details': f"TPE: R{package_components.get('tpe', 0)}, Car: R{package_components.get('car_allowance', 0)}"
             }
             
-            # Load and update audit trail
-            audit_file = 'randwater_package_audit.json'
-            if os.path.exists(audit_file):
-                with open(audit_file, 'r') as f:
-                    all_audits = json.load(f)
-            else:
-                all_audits = {}
-            
-            if employee_id not in all_audits:
-                all_audits[employee_id] = []
-            all_audits[employee_id].append(audit_entry)
-            
-            with open(audit_file, 'w') as f:
-                json.dump(all_audits, f, indent=2)
+            record_package_audit_entries({employee_id: [audit_entry]})
             
             # Create employee notification
             create_employee_notification(
@@ -5387,6 +6198,7 @@ def submit_package_final(employee_id):
         
         with open(submitted_file, 'w') as f:
             json.dump(submitted, f, indent=2)
+        record_package_stats(SUBMITTED_SOURCE, employee_id, package_components)
         
         logger.info(f"Package submitted for {employee_id}")
         return jsonify({'success': True, 'message': 'Package submitted successfully'})
@@ -5860,32 +6672,12 @@ def generate_tax_report():
         elements.append(Paragraph("STEP 4: TAX CALCULATION", heading_style))
         
         # Calculate which bracket applies
-        gross_tax = 0
-        bracket_info = ""
-        if net_taxable <= 237100:
-            gross_tax = net_taxable * 0.18
-            bracket_info = "18% bracket"
-        elif net_taxable <= 370500:
-            gross_tax = 42678 + (net_taxable - 237100) * 0.26
-            bracket_info = "26% bracket"
-        elif net_taxable <= 512800:
-            gross_tax = 77362 + (net_taxable - 370500) * 0.31
-            bracket_info = "31% bracket"
-        elif net_taxable <= 673000:
-            gross_tax = 121475 + (net_taxable - 512800) * 0.36
-            bracket_info = "36% bracket"
-        elif net_taxable <= 857900:
-            gross_tax = 179147 + (net_taxable - 673000) * 0.39
-            bracket_info = "39% bracket"
-        elif net_taxable <= 1817000:
-            gross_tax = 251258 + (net_taxable - 857900) * 0.41
-            bracket_info = "41% bracket"
-        else:
-            gross_tax = 644489 + (net_taxable - 1817000) * 0.45
-            bracket_info = "45% bracket"
+        tax_settings = load_tax_settings()
+        gross_tax, marginal_rate = bracket_summary(net_taxable, tax_settings)
+        bracket_info = f"{marginal_rate * 100:g}% bracket"
         
         # Rebates and Credits
-        primary_rebate = 17235
+        primary_rebate = tax_settings.get('rebate_primary', 17235)
         medical_dependents = data.get('medical_dependents', 4)
         first_two = min(medical_dependents, 2)
         additional = max(0, medical_dependents - 2)
@@ -18,8 +18,11 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 # Import our models
-from models import (PackageManager, EmployeeAccess, NotificationManager, 
+from models import (EmployeeAccess, NotificationManager, 
                     email_logger, smtp_config)
+from package_store import create_package_manager
+from tax_engine import calculate_tax
+from tax_rules import TaxRulesRepository
 
 app = Flask(__name__)
 app.secret_key = 'randwater-super-secret-key-2024'  # Change this in production
@@ -47,7 +50,7 @@ logger = logging.getLogger(__name__)
 
 # Initialize managers
 employee_access = EmployeeAccess()
-package_manager = PackageManager()
+package_manager = create_package_manager()
 
 # Dynamic user credentials storage (DEPRECATED - kept for backward compatibility)
 # Now using system_users.json instead
@@ -118,21 +121,12 @@ def strptime_filter(date_string, format_string):
 # Tax settings file for Rand Water
 TAX_SETTINGS_FILE = 'randwater_tax_settings.json'
 
-def load_tax_settings():
-    """Load Rand Water specific tax settings"""
-    try:
-        with open(TAX_SETTINGS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {
-            "rebate_primary": 17235,
-            "rebate_secondary": 9444,
-            "rebate_tertiary": 3145,
-            "uif_ceiling": 177.12,
-            "medical_main": 364,
-            "medical_first": 364,
-            "medical_additional": 246
-        }
+# Effective-dated tax rules, reloaded only when the settings file changes
+tax_rules = TaxRulesRepository(TAX_SETTINGS_FILE)
+
+def load_tax_settings(period=None):
+    """Rand Water tax settings effective for a payroll period (defaults to today)"""
+    return tax_rules.get(period)
 
 def safe_float_conversion(value, default=0.0):
     """Safely convert value to float, returning default if conversion fails"""
@@ -1248,47 +1242,6 @@ def calculate_randwater_net_pay(package_data: Dict) -> Dict:
         logger.error(f"Error calculating net pay: {str(e)}")
         return {"error": str(e)}
 
-def calculate_tax(income, settings):
-    """Calculate tax using SARS brackets"""
-    try:
-        tax_brackets = json.loads(settings.get('tax_brackets', '[]'))
-        
-        if tax_brackets:
-            tax = 0
-            previous_threshold = 0
-            
-            for bracket in tax_brackets:
-                threshold = bracket['threshold']
-                rate = bracket['rate'] / 100
-                
-                if income > previous_threshold:
-                    taxable_in_bracket = min(income - previous_threshold, threshold - previous_threshold)
-                    tax += taxable_in_bracket * rate
-                
-                if income <= threshold:
-                    break
-                previous_threshold = threshold
-            
-            return tax
-    except:
-        pass
-    
-    # Fallback to default SARS brackets
-    brackets = [
-        (0, 237100, 0.18, 0),
-        (237101, 370500, 0.26, 42678),
-        (370501, 512800, 0.31, 77362),
-        (512801, 673000, 0.36, 121475),
-        (673001, 857900, 0.39, 179147),
-        (857901, 1817000, 0.41, 251258),
-        (1817001, float('inf'), 0.45, 644489),
-    ]
-    
-    for lower, upper, rate, base in brackets:
-        if income <= upper:
-            return base + (income - lower) * rate
-    return 0
-
 def send_email(recipients: List[str], subject: str, body: str, operation_type: str = "notification") -> Dict[str, any]:
     """Send email using configured SMTP settings"""
     if not smtp_config.config['enabled']:
@@ -1647,18 +1600,14 @@ def package_analytics():
         return redirect(url_for('randwater_admin_login'))
     
     try:
-        # Get all packages for analytics
-        packages = package_manager.get_all_packages()
+        # Materialised package statistics
+        stats = package_manager.package_statistics()
         
         # Calculate analytics
-        total_packages = len(packages)
-        submitted_packages = len([p for p in packages if p.get('status') == 'SUBMITTED'])
+        total_packages = stats['packages']
+        submitted_packages = stats['by_status'].get('SUBMITTED', {}).get('packages', 0)
         pending_packages = total_packages - submitted_packages
         
-        # TCTC distribution
-        tctc_values = [package_manager._calculate_tctc(p['package_components']) for p in packages]
-        avg_tctc = sum(tctc_values) / len(tctc_values) if tctc_values else 0
-        
         # Grade band distribution
         all_access = employee_access.get_all_employees()
         grade_counts = {}
@@ -1670,11 +1619,11 @@ def package_analytics():
             'total_packages': total_packages,
             'submitted_packages': submitted_packages,
             'pending_packages': pending_packages,
-            'avg_tctc': avg_tctc,
+            'avg_tctc': stats['avg_tctc'],
             'grade_distribution': grade_counts,
             'tctc_range': {
-                'min': min(tctc_values) if tctc_values else 0,
-                'max': max(tctc_values) if tctc_values else 0
+                'min': stats['min_tctc'],
+                'max': stats['max_tctc']
             }
         }
         
@@ -2252,14 +2201,14 @@ def get_system_analytics():
     try:
         # Get current data
         all_employees = employee_access.get_all_employees()
-        all_packages = package_manager.get_all_packages()
+        stats = package_manager.package_statistics()
         
         # Calculate analytics
         analytics = {
             'user_stats': {
                 'total_users': len(all_employees),
-                'active_packages': len(all_packages),
-                'completion_rate': round((len(all_packages) / max(len(all_employees), 1)) * 100, 1) if all_employees else 0
+                'active_packages': stats['packages'],
+                'completion_rate': round((stats['packages'] / max(len(all_employees), 1)) * 100, 1) if all_employees else 0
             },
             'system_stats': {
                 'uptime_days': 30,  # This would be calculated from actual system start time
@@ -2269,7 +2218,7 @@ def get_system_analytics():
                 'server_status': 'Running',
                 'last_backup': get_last_backup_date()
             },
-            'package_stats': calculate_package_statistics(all_packages),
+            'package_stats': calculate_package_statistics(stats),
             'monthly_trends': get_monthly_trends()
         }
         return analytics
@@ -2282,9 +2231,9 @@ def get_system_analytics():
             'monthly_trends': []
         }
 
-def calculate_package_statistics(packages):
-    """Calculate package-related statistics"""
-    if not packages:
+def calculate_package_statistics(stats):
+    """Package-related statistics from PackageManager.package_statistics()"""
+    if not stats['packages']:
         return {
             'total_packages': 0,
             'avg_tctc': 0,
@@ -2294,15 +2243,15 @@ def calculate_package_statistics(packages):
             'most_common_benefits': []
         }
     
-    tctc_values = [float(p.get('tctc', 0)) for p in packages if p.get('tctc')]
-    
     return {
-        'total_packages': len(packages),
-        'avg_tctc': round(sum(tctc_values) / len(tctc_values), 2) if tctc_values else 0,
-        'highest_tctc': max(tctc_values) if tctc_values else 0,
-        'lowest_tctc': min(tctc_values) if tctc_values else 0,
-        'avg_deductions': round(sum([float(p.get('total_deductions', 0)) for p in packages]) / len(packages), 2),
-        'most_common_benefits': ['Medical Aid', 'Provident Fund', 'Car Allowance']  # This would be calculated from actual data
+        'total_packages': stats['packages'],
+        'avg_tctc': stats['avg_tctc'],
+        'highest_tctc': stats['max_tctc'],
+        'lowest_tctc': stats['min_tctc'],
+        'avg_deductions': 0,  # Stored packages carry no deduction totals
+        'most_common_benefits': ['Medical Aid', 'Provident Fund', 'Car Allowance'],  # This would be calculated from actual data
+        'by_band': stats['by_band'],
+        'by_department': stats['by_department']
     }
 
 def get_last_backup_date():
@@ -0,0 +1,328 @@
+"""
+Workforce what-if scenarios for the salary simulator
+Applies adjustment rules to every employee in a SAP upload in one vectorised
+pass and reports employer cost, PAYE and net pay deltas by band, department
+and cost centre
+
+A scenario is a list of rules applied in order, for example:
+
+    {"action": "increase", "component": "tpe", "percent": 6, "where": {"band": "O"}}
+    {"action": "increase", "component": "tpe", "percent": 4, "where": {"band": ["P"]}}
+    {"action": "cap", "component": "car", "percent": 35, "of": "ctc"}
+    {"action": "pension_rates", "employee_percent": 8.67, "employer_percent": 9.45}
+
+TPE increases are paid through cash and carry pension and group life with
+them at each employee's current rates. Amounts removed by a cap move to cash
+unless the rule sets "move_excess_to": null.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from batch_engine import calculate_columns, load_columns, sap_column
+from money import from_cents, to_cents_array
+
+logger = logging.getLogger(__name__)
+
+# Scenario component -> batch engine column
+COMPONENTS = {
+    'tpe': 'tpe',
+    'cash': 'cash',
+    'car': 'car',
+    'housing': 'housing',
+    'cellphone': 'cellphone',
+    'data_service': 'data_service',
+    'bonus': 'bonus',
+}
+
+# Grouping dimension -> SAP column
+GROUP_COLUMNS = {
+    'band': 'BAND',
+    'department': 'DEPARTMENT',
+    'cost_centre': 'CostCenter',
+}
+
+ACTIONS = ('increase', 'cap', 'pension_rates')
+SCENARIO_CACHE_LIMIT = 64
+
+
+class ScenarioError(ValueError):
+    """Raised when a scenario definition is invalid"""
+
+
+def _number(rule: Dict, key: str) -> Optional[float]:
+    if rule.get(key) is None:
+        return None
+    try:
+        return float(rule[key])
+    except (TypeError, ValueError):
+        raise ScenarioError(f"'{key}' must be a number")
+
+
+def _normalise_where(rule: Dict, position: int) -> Dict[str, List[str]]:
+    where = {}
+    for dimension, values in (rule.get('where') or {}).items():
+        if dimension not in GROUP_COLUMNS:
+            raise ScenarioError(f"Rule {position}: cannot filter on '{dimension}'")
+        values = values if isinstance(values, list) else [values]
+        where[dimension] = sorted(str(value) for value in values)
+    return where
+
+
+def normalise_rules(rules) -> List[Dict]:
+    """Validate scenario rules and return them in canonical form"""
+    if not isinstance(rules, list) or not rules:
+        raise ScenarioError("A scenario needs at least one rule")
+
+    normalised = []
+    for position, rule in enumerate(rules, start=1):
+        if not isinstance(rule, dict):
+            raise ScenarioError(f"Rule {position} must be an object")
+        action = rule.get('action')
+        if action not in ACTIONS:
+            raise ScenarioError(f"Rule {position}: action must be one of {', '.join(ACTIONS)}")
+        where = _normalise_where(rule, position)
+
+        if action == 'pension_rates':
+            employee_percent = _number(rule, 'employee_percent')
+            employer_percent = _number(rule, 'employer_percent')
+            if employee_percent is None or employer_percent is None:
+                raise ScenarioError(f"Rule {position}: give 'employee_percent' and 'employer_percent'")
+            normalised.append({'action': action, 'employee_percent': employee_percent,
+                               'employer_percent': employer_percent, 'where': where})
+            continue
+
+        component = rule.get('component')
+        if component not in COMPONENTS:
+            raise ScenarioError(f"Rule {position}: unknown component '{component}'")
+
+        percent = _number(rule, 'percent')
+        amount = _number(rule, 'amount')
+        if (percent is None) == (amount is None):
+            raise ScenarioError(f"Rule {position}: give exactly one of 'percent' or 'amount'")
+
+        canonical = {'action': action, 'component': component, 'where': where}
+        if percent is not None:
+            canonical['percent'] = percent
+        else:
+            canonical['amount'] = amount
+        if action == 'cap':
+            if percent is not None and rule.get('of', 'ctc') != 'ctc':
+                raise ScenarioError(f"Rule {position}: percentage caps are measured against 'ctc'")
+            move_to = rule.get('move_excess_to', 'cash')
+            if move_to is not None and move_to not in COMPONENTS:
+                raise ScenarioError(f"Rule {position}: unknown component '{move_to}'")
+            canonical['move_excess_to'] = move_to
+        normalised.append(canonical)
+    return normalised
+
+
+def scenario_hash(rules: List[Dict], *context) -> str:
+    """Stable hash of canonical rules plus the data/rule versions they ran against"""
+    payload = json.dumps([rules, list(context)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _group_label(value) -> str:
+    if value is None or value != value or str(value).strip() == '':
+        return 'Unassigned'
+    return str(value).strip()
+
+
+class Workforce:
+    """Column arrays for one SAP upload"""
+
+    def __init__(self, employee_data):
+        self.columns = load_columns(employee_data)
+        self.ctc = sap_column(employee_data, 'TCTC')
+        self.groups = {}
+        for dimension, key in GROUP_COLUMNS.items():
+            if hasattr(employee_data, 'columns'):
+                values = employee_data[key].tolist() if key in employee_data.columns else [None] * len(self)
+            else:
+                values = [row.get(key) for row in employee_data]
+            self.groups[dimension] = np.array([_group_label(value) for value in values], dtype=object)
+
+    @classmethod
+    def from_arrays(cls, columns: Dict[str, np.ndarray], ctc: np.ndarray, groups: Dict[str, np.ndarray]) -> 'Workforce':
+        """Wrap existing arrays (e.g. shared-memory views) without copying them"""
+        workforce = cls.__new__(cls)
+        workforce.columns = columns
+        workforce.ctc = ctc
+        workforce.groups = groups
+        return workforce
+
+    def __len__(self) -> int:
+        return len(self.ctc)
+
+    def mask(self, where: Dict[str, List[str]]) -> np.ndarray:
+        """Employees matching every filter in a rule"""
+        selected = np.ones(len(self), dtype=bool)
+        for dimension, values in where.items():
+            selected &= np.isin(self.groups[dimension], values)
+        return selected
+
+
+def baseline_employer_cost(workforce: Workforce) -> np.ndarray:
+    """Monthly cost to company: SAP TCTC, or the sum of its components when TCTC is missing"""
+    columns = workforce.columns
+    components = (columns['tpe'] + columns['car'] + columns['housing'] + columns['cellphone']
+                  + columns['data_service'] + columns['pension_employer'] + columns['group_life_employer']
+                  + columns['medical_employer'] + columns['bonus'] / 12)
+    return np.where(workforce.ctc > 0, workforce.ctc, components)
+
+
+def _cost_weight(field: str) -> float:
+    """Share of a component change that reaches monthly employer cost"""
+    return 1 / 12 if field == 'bonus' else 1.0
+
+
+def apply_rules(workforce: Workforce, rules: List[Dict]):
+    """Return (adjusted input columns, employer cost change, mask of employees any rule changed)"""
+    columns = {field: values.copy() for field, values in workforce.columns.items()}
+    tpe_before = workforce.columns['tpe']
+    ctc = baseline_employer_cost(workforce)
+    cost_delta = np.zeros(len(workforce))
+    affected = np.zeros(len(workforce), dtype=bool)
+
+    pension_rules = []
+
+    for rule in rules:
+        selected = workforce.mask(rule['where'])
+        if rule['action'] == 'pension_rates':
+            pension_rules.append((selected, rule))
+            continue
+        field = COMPONENTS[rule['component']]
+        current = columns[field]
+
+        if rule['action'] == 'increase':
+            if 'percent' in rule:
+                delta = current * rule['percent'] / 100
+            else:
+                delta = np.full(len(workforce), rule['amount'])
+            delta = np.where(selected, delta, 0.0)
+            columns[field] = current + delta
+            if field == 'tpe':
+                # TPE is paid through cash
+                columns['cash'] = columns['cash'] + delta
+            cost_delta += delta * _cost_weight(field)
+        else:
+            limit = ctc * rule['percent'] / 100 if 'percent' in rule else np.full(len(workforce), rule['amount'])
+            delta = np.where(selected, np.maximum(current - limit, 0), 0.0)
+            columns[field] = current - delta
+            cost_delta -= delta * _cost_weight(field)
+            if rule['move_excess_to']:
+                # Restructuring within the package
+                target = COMPONENTS[rule['move_excess_to']]
+                columns[target] = columns[target] + delta
+                cost_delta += delta * _cost_weight(target)
+
+        affected |= delta != 0
+
+    # Contributions that are a percentage of TPE follow the new TPE
+    scale = np.divide(columns['tpe'], tpe_before, out=np.ones_like(tpe_before), where=tpe_before > 0)
+    for field in ('pension_employee', 'pension_employer', 'group_life_employee', 'group_life_employer'):
+        columns[field] = columns[field] * scale
+
+    # Pension option changes replace the contribution rates on the new TPE
+    for selected, rule in pension_rules:
+        for field, percent in (('pension_employee', rule['employee_percent']),
+                               ('pension_employer', rule['employer_percent'])):
+            updated = np.where(selected, columns['tpe'] * percent / 100, columns[field])
+            affected |= updated != columns[field]
+            columns[field] = updated
+
+    cost_delta += (columns['pension_employer'] - workforce.columns['pension_employer']
+                   + columns['group_life_employer'] - workforce.columns['group_life_employer'])
+    return columns, cost_delta, affected
+
+
+def _group_totals(groups: np.ndarray, values: Dict[str, np.ndarray], affected: np.ndarray) -> List[Dict]:
+    """Sum each measure per group, in cents"""
+    labels, inverse = np.unique(groups, return_inverse=True)
+    summary = []
+    sums = {name: np.bincount(inverse, weights=to_cents_array(column), minlength=len(labels))
+            for name, column in values.items()}
+    counts = np.bincount(inverse, minlength=len(labels))
+    changed = np.bincount(inverse, weights=affected, minlength=len(labels))
+    for i, label in enumerate(labels):
+        entry = {'group': str(label), 'employees': int(counts[i]), 'affected': int(changed[i])}
+        entry.update({name: from_cents(int(total[i])) for name, total in sums.items()})
+        summary.append(entry)
+    return summary
+
+
+def run_scenario(workforce: Workforce, rules: List[Dict], settings: Optional[Dict] = None) -> Dict:
+    """Baseline vs scenario totals and deltas for the whole workforce"""
+    scenario_inputs, cost_delta, affected = apply_rules(workforce, rules)
+    baseline = calculate_columns(workforce.columns, settings)
+    scenario = calculate_columns(scenario_inputs, settings)
+    cost_before = baseline_employer_cost(workforce)
+
+    measures = {
+        'employer_cost': (cost_before, cost_before + cost_delta),
+        'paye': (baseline['total_tax'], scenario['total_tax']),
+        'net_pay': (baseline['net_pay'], scenario['net_pay']),
+    }
+    values = {}
+    for name, (before, after) in measures.items():
+        values[f'{name}_before'] = before
+        values[f'{name}_after'] = after
+        values[f'{name}_delta'] = after - before
+
+    everyone = np.full(len(workforce), 'All', dtype=object)
+    return {
+        'employees': len(workforce),
+        'affected': int(affected.sum()),
+        'totals': _group_totals(everyone, values, affected)[0] if len(workforce) else {},
+        'by_band': _group_totals(workforce.groups['band'], values, affected),
+        'by_department': _group_totals(workforce.groups['department'], values, affected),
+        'by_cost_centre': _group_totals(workforce.groups['cost_centre'], values, affected),
+    }
+
+
+class ScenarioEngine:
+    """Runs scenarios against SAP uploads and caches results by scenario hash"""
+
+    def __init__(self, cache_limit: int = SCENARIO_CACHE_LIMIT):
+        self.cache_limit = cache_limit
+        self._results = OrderedDict()
+        self._workforce = None
+        self._workforce_key = None
+        self._lock = threading.Lock()
+
+    def workforce(self, upload: Dict) -> Workforce:
+        """Column arrays for an upload, rebuilt only when the upload changes"""
+        key = (upload.get('filename'), upload.get('upload_date'), len(upload.get('employee_data', [])))
+        with self._lock:
+            if self._workforce_key != key:
+                self._workforce = Workforce(upload.get('employee_data', []))
+                self._workforce_key = key
+            return self._workforce
+
+    def run(self, upload: Dict, rules, settings: Optional[Dict] = None, rules_version: str = '') -> Dict:
+        """Run (or fetch from cache) a scenario against an upload"""
+        rules = normalise_rules(rules)
+        key = scenario_hash(rules, upload.get('filename'), upload.get('upload_date'), rules_version)
+
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None:
+                self._results.move_to_end(key)
+                return dict(cached, scenario_hash=key, cached=True)
+
+        result = run_scenario(self.workforce(upload), rules, settings)
+        result['rules'] = rules
+        logger.info(f"Scenario {key} run for {result['employees']} employees ({result['affected']} affected)")
+
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.cache_limit:
+                self._results.popitem(last=False)
+        return dict(result, scenario_hash=key, cached=False)
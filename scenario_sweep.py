@@ -0,0 +1,299 @@
+"""
+Parallel scenario sweeps for the salary simulator
+Runs a grid of workforce scenarios (e.g. increase % x pension option x bonus
+structure) across all cores. Workforce columns are placed once in a
+multiprocessing.shared_memory block that every worker maps directly, so only
+the small rule sets and aggregate results cross process boundaries.
+
+Job progress, results and cancel requests are kept in SWEEP_JOB_DIR, so any
+web worker can poll or cancel a sweep started by another.
+"""
+
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from multiprocessing import get_context, shared_memory
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from scenario_engine import GROUP_COLUMNS, ScenarioError, Workforce, normalise_rules, run_scenario
+
+logger = logging.getLogger(__name__)
+
+SWEEP_POINT_LIMIT = 2000
+SWEEP_JOB_LIMIT = 20
+SWEEP_JOB_DIR = 'scenario_sweeps'
+# Minimum seconds between progress writes while a sweep runs
+SWEEP_SAVE_INTERVAL = 0.5
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{12}$')
+
+# Worker-process state, set once by _attach_worker
+_worker_shm = None
+_worker_workforce = None
+_worker_settings = None
+
+
+def expand_grid(base_rules: List[Dict], dimensions: List[Dict]) -> List[Dict]:
+    """
+    Cartesian product of sweep dimensions.
+
+    Each dimension is {"name": ..., "options": [{"label": ..., "rules": [...]}]};
+    a grid point's rules are the base rules followed by one option per dimension.
+    """
+    if not dimensions:
+        raise ScenarioError("A sweep needs at least one dimension")
+    for dimension in dimensions:
+        if not dimension.get('name') or not dimension.get('options'):
+            raise ScenarioError("Each sweep dimension needs a name and options")
+
+    total = 1
+    for dimension in dimensions:
+        total *= len(dimension['options'])
+    if total > SWEEP_POINT_LIMIT:
+        raise ScenarioError(f"A sweep may contain at most {SWEEP_POINT_LIMIT} grid points ({total} requested)")
+
+    points = []
+    for combination in itertools.product(*(dimension['options'] for dimension in dimensions)):
+        rules = list(base_rules or [])
+        labels = {}
+        for dimension, option in zip(dimensions, combination):
+            labels[dimension['name']] = option.get('label')
+            rules.extend(option.get('rules') or [])
+        points.append({'labels': labels, 'rules': normalise_rules(rules)})
+    return points
+
+
+def share_workforce(workforce: Workforce):
+    """Copy workforce arrays into one shared-memory block; returns (shm, layout)"""
+    fields = sorted(workforce.columns)
+    group_labels = {}
+    group_codes = []
+    for dimension in GROUP_COLUMNS:
+        labels, codes = np.unique(workforce.groups[dimension], return_inverse=True)
+        group_labels[dimension] = labels.tolist()
+        group_codes.append(codes)
+
+    rows = len(fields) + 1 + len(group_codes)
+    shape = (rows, len(workforce))
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 8))
+    block = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    for i, field in enumerate(fields):
+        block[i] = workforce.columns[field]
+    block[len(fields)] = workforce.ctc
+    for i, codes in enumerate(group_codes):
+        block[len(fields) + 1 + i] = codes
+    del block
+
+    layout = {'shape': shape, 'fields': fields, 'group_labels': group_labels}
+    return shm, layout
+
+
+def _attach_worker(shm_name: str, layout: Dict, settings: Dict):
+    """Pool initializer: map the shared block and build array views over it"""
+    global _worker_shm, _worker_workforce, _worker_settings
+    # Spawned workers share the parent's resource tracker, so the parent's
+    # unlink remains the only cleanup needed
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    block = np.ndarray(layout['shape'], dtype=np.float64, buffer=_worker_shm.buf)
+    fields = layout['fields']
+    columns = {field: block[i] for i, field in enumerate(fields)}
+    ctc = block[len(fields)]
+    groups = {}
+    for i, dimension in enumerate(GROUP_COLUMNS):
+        labels = np.array(layout['group_labels'][dimension], dtype=object)
+        groups[dimension] = labels[block[len(fields) + 1 + i].astype(np.int64)]
+    _worker_workforce = Workforce.from_arrays(columns, ctc, groups)
+    _worker_settings = settings
+
+
+def _run_point(rules: List[Dict]) -> Dict:
+    """Worker task: aggregate outcome for one grid point"""
+    result = run_scenario(_worker_workforce, rules, _worker_settings)
+    return {'affected': result['affected'], 'totals': result['totals'], 'by_band': result['by_band']}
+
+
+class SweepJob:
+    """Progress, results and cancellation flag for one sweep"""
+
+    def __init__(self, points: List[Dict], created_by: str = '', directory: str = SWEEP_JOB_DIR):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.directory = directory
+        self.points = points
+        self.results: List[Optional[Dict]] = [None] * len(points)
+        self.status = 'queued'
+        self.completed = 0
+        self.error = None
+        self.created_by = created_by
+        self.created_at = datetime.now().isoformat()
+        self.finished_at = None
+        self._cancel = threading.Event()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f'{self.job_id}.json')
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        # A cancel request from another web worker arrives as a flag file
+        if not self._cancel.is_set() and os.path.exists(cancel_flag_path(self.directory, self.job_id)):
+            self._cancel.set()
+        return self._cancel.is_set()
+
+    def save(self):
+        """Write the job's state for polling from any worker"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, self.path)
+
+    def to_dict(self, include_results: bool = True) -> Dict:
+        data = {
+            'job_id': self.job_id,
+            'status': self.status,
+            'completed': self.completed,
+            'total': len(self.points),
+            'progress': round(self.completed / len(self.points) * 100, 1) if self.points else 100.0,
+            'error': self.error,
+            'created_by': self.created_by,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+        if include_results:
+            data['results'] = [
+                {'labels': point['labels'], **result}
+                for point, result in zip(self.points, self.results) if result is not None
+            ]
+        return data
+
+
+def cancel_flag_path(directory: str, job_id: str) -> str:
+    return os.path.join(directory, f'{job_id}.cancel')
+
+
+class SweepRunner:
+    """Starts sweeps in the background; job state is shared with other workers through directory"""
+
+    def __init__(self, max_workers: Optional[int] = None, directory: str = SWEEP_JOB_DIR):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.directory = directory
+        # Sweeps running (or recently run) in this process
+        self.jobs: Dict[str, SweepJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self, workforce: Workforce, points: List[Dict], settings: Optional[Dict] = None,
+              created_by: str = '') -> SweepJob:
+        job = SweepJob(points, created_by, self.directory)
+        job.save()
+        with self._lock:
+            self.jobs[job.job_id] = job
+            finished = [j for j in self.jobs.values() if j.status not in ('queued', 'running')]
+            for old in finished[:max(0, len(self.jobs) - SWEEP_JOB_LIMIT)]:
+                del self.jobs[old.job_id]
+        self._prune()
+        thread = threading.Thread(target=self._run, args=(job, workforce, settings or {}), daemon=True)
+        thread.start()
+        return job
+
+    def status(self, job_id: str, include_results: bool = True) -> Optional[Dict]:
+        """A sweep's progress (and results), whichever worker runs it; None when unknown"""
+        if not JOB_ID_PATTERN.match(job_id or ''):
+            return None
+        job = self.jobs.get(job_id)
+        if job:
+            return job.to_dict(include_results)
+        try:
+            with open(os.path.join(self.directory, f'{job_id}.json'), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not include_results:
+            data.pop('results', None)
+        return data
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        """Ask a sweep to stop; the worker running it picks up the flag"""
+        data = self.status(job_id, include_results=False)
+        if data is None:
+            return None
+        job = self.jobs.get(job_id)
+        if job:
+            job.cancel()
+        elif data['status'] in ('queued', 'running'):
+            open(cancel_flag_path(self.directory, job_id), 'a').close()
+        return data
+
+    def _prune(self):
+        """Delete the oldest finished jobs on disk beyond SWEEP_JOB_LIMIT"""
+        finished = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get('status') not in ('queued', 'running'):
+                finished.append((entry.stat().st_mtime_ns, data.get('job_id', entry.name[:-5])))
+        for _, job_id in sorted(finished)[:-SWEEP_JOB_LIMIT]:
+            for path in (os.path.join(self.directory, f'{job_id}.json'), cancel_flag_path(self.directory, job_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _run(self, job: SweepJob, workforce: Workforce, settings: Dict):
+        job.status = 'running'
+        job.save()
+        saved_at = time.monotonic()
+        shm, layout = share_workforce(workforce)
+        try:
+            workers = min(self.max_workers, len(job.points)) or 1
+            # spawn keeps workers independent of the (threaded) web server process
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                                     initializer=_attach_worker,
+                                     initargs=(shm.name, layout, settings)) as pool:
+                pending = {pool.submit(_run_point, point['rules']): index
+                           for index, point in enumerate(job.points)}
+                while pending:
+                    if job.cancelled:
+                        for future in pending:
+                            future.cancel()
+                        break
+                    done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = pending.pop(future)
+                        job.results[index] = future.result()
+                        job.completed += 1
+                    if done and time.monotonic() - saved_at >= SWEEP_SAVE_INTERVAL:
+                        job.save()
+                        saved_at = time.monotonic()
+            job.status = 'cancelled' if job.cancelled else 'completed'
+            logger.info(f"Sweep {job.job_id} {job.status}: {job.completed}/{len(job.points)} points")
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logger.error(f"Sweep {job.job_id} failed: {str(e)}")
+        finally:
+            job.finished_at = datetime.now().isoformat()
+            shm.close()
+            shm.unlink()
+            try:
+                job.save()
+                if os.path.exists(cancel_flag_path(self.directory, job.job_id)):
+                    os.remove(cancel_flag_path(self.directory, job.job_id))
+            except OSError as e:
+                logger.error(f"Could not save sweep {job.job_id}: {str(e)}")
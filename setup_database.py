@@ -133,6 +133,17 @@ def create_backup():
     backup_path = db.backup_database()
     print(f"✅ Backup created: {backup_path}")
 
+def rebuild_statistics():
+    """Recompute the materialised package statistics (repairs drift)"""
+    from impact_engine import stored_packages
+    from package_stats import latest_sap_rows, rebuild_statistics as rebuild_package_statistics
+    from package_store import create_package_manager, package_database
+    
+    manager = create_package_manager()
+    cells = rebuild_package_statistics(package_database(manager), stored_packages(),
+                                       latest_sap_rows(manager.sap_uploads))
+    print(f"✅ Package statistics rebuilt: {cells} cells")
+
 if __name__ == "__main__":
     import sys
     
@@ -145,8 +156,10 @@ if __name__ == "__main__":
             show_database_info()
         elif command == "backup":
             create_backup()
+        elif command == "rebuild-stats":
+            rebuild_statistics()
         else:
-            print("Unknown command. Use: setup, info, or backup")
+            print("Unknown command. Use: setup, info, backup, or rebuild-stats")
     else:
         print("Randwater Database Management")
         print("=" * 30)
@@ -154,6 +167,7 @@ if __name__ == "__main__":
         print("  python setup_database.py setup   - Initialize database and migrate data")
         print("  python setup_database.py info    - Show database information")
         print("  python setup_database.py backup  - Create manual backup")
+        print("  python setup_database.py rebuild-stats - Recompute package statistics")
         print()
         
         # Default to setup if no database exists
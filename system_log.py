@@ -0,0 +1,221 @@
+"""
+Rotating JSONL system log
+System log entries (SAP uploads, data clears, config recalculations, ...)
+are appended, one JSON line each, to the newest segment in system_logs/.
+Segments are named by the id of their first entry and rotate at
+SEGMENT_BYTES; beyond MAX_SEGMENTS the oldest is deleted, so the log is
+size-bounded while keeping far more than the last 100 events.
+
+Each process keeps the newest TAIL_SIZE entries in memory and catches up on
+other workers' appends by reading only the bytes written since it last
+looked. Older entries are streamed a segment at a time, newest first.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are serialised within the process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_LOG_DIR = 'system_logs'
+LEGACY_SYSTEM_LOG_FILE = 'system_logs.json'
+
+# Start a new segment once the live one reaches this size
+SEGMENT_BYTES = 1024 * 1024
+# Segments kept before the oldest is deleted
+MAX_SEGMENTS = 50
+# Newest entries held in memory for /api/system-logs
+TAIL_SIZE = 100
+
+SEGMENT_PATTERN = re.compile(r'^system-(\d{9})\.jsonl$')
+
+
+class SystemLog:
+    """Append-only system log in rotating JSONL segments with an in-memory tail"""
+
+    def __init__(self, directory: str = SYSTEM_LOG_DIR, segment_bytes: int = SEGMENT_BYTES,
+                 max_segments: int = MAX_SEGMENTS, tail_size: int = TAIL_SIZE,
+                 legacy_file: str = LEGACY_SYSTEM_LOG_FILE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.legacy_file = legacy_file
+        self._lock = threading.Lock()
+        self._tail = deque(maxlen=tail_size)
+        # (segment, byte offset) read into the tail so far
+        self._position: Optional[Tuple[int, int]] = None
+        self._seeded = False
+
+    def _path(self, first_id: int) -> str:
+        return os.path.join(self.directory, f'system-{first_id:09d}.jsonl')
+
+    def segments(self) -> List[int]:
+        """First entry id of each segment, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(match.group(1)) for match in map(SEGMENT_PATTERN.match, os.listdir(self.directory))
+                      if match)
+
+    @contextmanager
+    def _append_lock(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Writing
+    def append(self, entry: Dict) -> Dict:
+        """Append an entry, numbered after the last one; returns it with its id"""
+        self._seed()
+        os.makedirs(self.directory, exist_ok=True)
+        with self._append_lock():
+            segments = self.segments()
+            line = b''
+            if segments:
+                last_id, complete = self._last_id(segments[-1])
+                if not complete:
+                    line = b'\n'  # close off a torn final write
+            else:
+                last_id = 0
+            entry = dict(entry, id=last_id + 1)
+
+            if not segments or os.path.getsize(self._path(segments[-1])) >= self.segment_bytes:
+                segments.append(entry['id'])
+                line = b''
+                for first_id in segments[:-self.max_segments]:
+                    os.remove(self._path(first_id))
+            with open(self._path(segments[-1]), 'ab') as f:
+                f.write(line + json.dumps(entry, default=str).encode('utf-8') + b'\n')
+        return entry
+
+    def _last_id(self, first_id: int) -> Tuple[int, bool]:
+        """Id of the segment's last complete line, and whether the file ends on a newline"""
+        with open(self._path(first_id), 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            data, start = b'', end
+            while start > 0:
+                start = max(0, start - 4096)
+                f.seek(start)
+                data = f.read(end - start)
+                lines = data[:data.rfind(b'\n') + 1].splitlines()
+                # The first line of a partial read may be cut; it only counts once the start is reached
+                for line in reversed(lines if start == 0 else lines[1:]):
+                    try:
+                        return int(json.loads(line)['id']), data.endswith(b'\n')
+                    except (ValueError, KeyError, TypeError):
+                        continue
+            return first_id - 1, data.endswith(b'\n') or not data
+
+    def _seed(self):
+        """Import the legacy system_logs.json into an empty log, once"""
+        if self._seeded:
+            return
+        if self.segments() or not os.path.exists(self.legacy_file):
+            self._seeded = True
+            return
+        try:
+            with open(self.legacy_file, 'r') as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not import system log {self.legacy_file}: {str(e)}")
+            legacy = []
+        entries = [entry for entry in legacy if isinstance(entry, dict)] if isinstance(legacy, list) else []
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._append_lock():
+            # Another worker may have seeded the log meanwhile
+            if entries and not self.segments():
+                # The old file's ids repeat once it was truncated, so entries are renumbered
+                with open(self._path(1), 'ab') as f:
+                    for number, entry in enumerate(entries, 1):
+                        f.write(json.dumps(dict(entry, id=number), default=str).encode('utf-8') + b'\n')
+                logger.info(f"Imported {len(entries)} system log entries from {self.legacy_file}")
+        self._seeded = True
+
+    # Reading
+    def _read(self, first_id: int, start: int = 0) -> Tuple[List[Dict], int]:
+        """Entries from a byte offset to the segment's last complete line, and the offset reached"""
+        with open(self._path(first_id), 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        entries = []
+        for line in data.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping unreadable line in system log segment {first_id}")
+        return entries, start + len(data)
+
+    def _sync(self):
+        """Bring the tail up to date with the segments on disk"""
+        segments = self.segments()
+        if self._position is not None:
+            first_id, offset = self._position
+            if not segments or first_id > segments[-1] or (first_id in segments
+                                                            and offset > os.path.getsize(self._path(first_id))):
+                self._position = None  # the log was removed or replaced
+
+        if self._position is None:
+            # Load the newest segments until the tail is full
+            self._tail.clear()
+            loaded = []
+            for first_id in reversed(segments):
+                entries, end = self._read(first_id)
+                if self._position is None:
+                    self._position = (first_id, end)
+                loaded[:0] = entries
+                if len(loaded) >= self._tail.maxlen:
+                    break
+            self._tail.extend(loaded)
+            return
+
+        first_id, offset = self._position
+        for number in segments:
+            if number < first_id:
+                continue
+            entries, end = self._read(number, offset if number == first_id else 0)
+            self._tail.extend(entries)
+            self._position = (number, end)
+
+    def recent(self) -> List[Dict]:
+        """The newest entries, newest first"""
+        self._seed()
+        with self._lock:
+            try:
+                self._sync()
+            except FileNotFoundError:
+                # A segment was rotated away mid-read; start over from disk
+                self._position = None
+                self._sync()
+            return list(reversed(self._tail))
+
+    def history(self, before_id: Optional[int] = None) -> Iterator[Dict]:
+        """Entries newest first, read a segment at a time; before_id skips that entry and newer ones"""
+        self._seed()
+        for first_id in reversed(self.segments()):
+            if before_id is not None and first_id >= before_id:
+                continue
+            try:
+                entries, _ = self._read(first_id)
+            except FileNotFoundError:
+                return  # older segments have been rotated away
+            for entry in reversed(entries):
+                if before_id is None or entry.get('id', 0) < before_id:
+                    yield entry
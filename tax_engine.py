@@ -0,0 +1,194 @@
+"""
+PAYE tax engine for the Rand Water calculators
+Compiles SARS bracket tables once per settings version and resolves the
+applicable bracket with a binary search
+"""
+
+import json
+import logging
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# SARS 2024/2025 brackets as (lower limit, base tax, marginal rate)
+DEFAULT_TAX_BRACKETS = [
+    (0, 0, 0.18),
+    (237100, 42678, 0.26),
+    (370500, 77362, 0.31),
+    (512800, 121475, 0.36),
+    (673000, 179147, 0.39),
+    (857900, 251258, 0.41),
+    (1817000, 644489, 0.45),
+]
+
+
+class TaxTable:
+    """Compiled bracket table held as parallel threshold/base/rate lists"""
+
+    __slots__ = ('thresholds', 'bases', 'rates', '_arrays')
+
+    def __init__(self, thresholds: List[float], bases: List[float], rates: List[float]):
+        self.thresholds = thresholds
+        self.bases = bases
+        self.rates = rates
+        self._arrays = None
+
+    def bracket_index(self, income: float) -> int:
+        """Return the index of the bracket that applies to an annual income"""
+        return max(0, bisect_right(self.thresholds, income) - 1)
+
+    def tax(self, income: float) -> float:
+        """Annual tax on taxable income before rebates and credits"""
+        if income <= 0:
+            return 0
+        i = self.bracket_index(income)
+        return self.bases[i] + (income - self.thresholds[i]) * self.rates[i]
+
+    def marginal_rate(self, income: float) -> float:
+        """Marginal rate for the bracket an annual income falls in"""
+        return self.rates[self.bracket_index(income)]
+
+    def as_arrays(self):
+        """Threshold, base and rate columns as NumPy arrays (built once per table)"""
+        if self._arrays is None:
+            import numpy as np
+            self._arrays = (np.asarray(self.thresholds, dtype=np.float64),
+                            np.asarray(self.bases, dtype=np.float64),
+                            np.asarray(self.rates, dtype=np.float64))
+        return self._arrays
+
+    def tax_array(self, incomes):
+        """Vectorised annual tax for an array of taxable incomes"""
+        import numpy as np
+        thresholds, bases, rates = self.as_arrays()
+        incomes = np.asarray(incomes, dtype=np.float64)
+        idx = np.searchsorted(thresholds, incomes, side='right') - 1
+        np.clip(idx, 0, len(thresholds) - 1, out=idx)
+        tax = bases[idx] + (incomes - thresholds[idx]) * rates[idx]
+        return np.where(incomes > 0, tax, 0.0)
+
+
+def _normalise_rate(rate: float) -> float:
+    """Accept rates as fractions (0.18) or percentages (18)"""
+    rate = float(rate)
+    return rate / 100 if rate > 1 else rate
+
+
+def compile_tax_table(raw_brackets) -> TaxTable:
+    """
+    Compile a bracket definition into a TaxTable.
+
+    Accepts the admin dashboard format (JSON string or list of
+    {'threshold', 'rate'} upper limits with percentage rates) and the
+    tax_settings.json format (list of {'min', 'max', 'rate', 'cumulative'}).
+    Falls back to DEFAULT_TAX_BRACKETS when nothing usable is supplied.
+    """
+    brackets = raw_brackets
+    if isinstance(brackets, str):
+        try:
+            brackets = json.loads(brackets or '[]')
+        except ValueError as e:
+            logger.warning(f"Invalid tax bracket JSON, using SARS defaults: {str(e)}")
+            brackets = []
+
+    thresholds, bases, rates = [], [], []
+    try:
+        if brackets and 'threshold' in brackets[0]:
+            # Upper-limit format: each bracket starts where the previous one ended
+            lower = 0.0
+            base = 0.0
+            for bracket in brackets:
+                rate = _normalise_rate(bracket['rate'])
+                thresholds.append(lower)
+                bases.append(base)
+                rates.append(rate)
+                upper = float(bracket['threshold'])
+                base += (upper - lower) * rate
+                lower = upper
+        elif brackets:
+            # Min/max format: use the previous bracket's max as the lower limit so
+            # published base amounts line up with SARS' "above R237 100" wording
+            previous_max = None
+            base = 0.0
+            for bracket in brackets:
+                rate = _normalise_rate(bracket['rate'])
+                lower = float(previous_max if previous_max is not None else bracket.get('min', 0))
+                if previous_max is not None:
+                    base += (lower - thresholds[-1]) * rates[-1]
+                if 'cumulative' in bracket:
+                    base = float(bracket['cumulative'])
+                thresholds.append(lower)
+                bases.append(base)
+                rates.append(rate)
+                previous_max = float(bracket.get('max', float('inf')))
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Could not compile tax brackets, using SARS defaults: {str(e)}")
+        thresholds = []
+
+    if not thresholds:
+        thresholds = [float(lower) for lower, _, _ in DEFAULT_TAX_BRACKETS]
+        bases = [float(base) for _, base, _ in DEFAULT_TAX_BRACKETS]
+        rates = [rate for _, _, rate in DEFAULT_TAX_BRACKETS]
+
+    return TaxTable(thresholds, bases, rates)
+
+
+# Compiled tables keyed by bracket definition; a settings change yields a new key
+_table_cache: Dict[object, TaxTable] = {}
+_TABLE_CACHE_LIMIT = 32
+
+
+def _cache_key(raw_brackets) -> object:
+    """Hashable key identifying one version of a bracket definition"""
+    if raw_brackets is None or isinstance(raw_brackets, str):
+        return raw_brackets
+    try:
+        return tuple(tuple(sorted(bracket.items())) for bracket in raw_brackets)
+    except (AttributeError, TypeError):
+        return json.dumps(raw_brackets, sort_keys=True, default=str)
+
+
+def get_tax_table(settings: Optional[Dict]) -> TaxTable:
+    """Return the compiled bracket table for a settings dict"""
+    raw_brackets = (settings or {}).get('tax_brackets')
+    key = _cache_key(raw_brackets)
+    table = _table_cache.get(key)
+    if table is None:
+        table = compile_tax_table(raw_brackets)
+        if len(_table_cache) >= _TABLE_CACHE_LIMIT:
+            _table_cache.clear()
+        _table_cache[key] = table
+    return table
+
+
+def calculate_tax(income: float, settings: Optional[Dict]) -> float:
+    """Calculate annual tax using SARS brackets (before rebates and credits)"""
+    return get_tax_table(settings).tax(income)
+
+
+def calculate_rebate(age: float, settings: Optional[Dict]) -> float:
+    """Annual primary, secondary (65+) and tertiary (75+) rebates"""
+    settings = settings or {}
+    rebate = settings.get('rebate_primary', 17235)
+    if age >= 65:
+        rebate += settings.get('rebate_secondary', 9444)
+    if age >= 75:
+        rebate += settings.get('rebate_tertiary', 3145)
+    return rebate
+
+
+def rebate_array(ages, settings: Optional[Dict]):
+    """Vectorised calculate_rebate for an array of ages"""
+    import numpy as np
+    settings = settings or {}
+    ages = np.asarray(ages, dtype=np.float64)
+    return (settings.get('rebate_primary', 17235)
+            + np.where(ages >= 65, settings.get('rebate_secondary', 9444), 0)
+            + np.where(ages >= 75, settings.get('rebate_tertiary', 3145), 0))
+
+
+def bracket_summary(income: float, settings: Optional[Dict]) -> Tuple[float, float]:
+    """Return (annual tax, marginal rate) for an annual taxable income"""
+    table = get_tax_table(settings)
+    return table.tax(income), table.marginal_rate(income)
@@ -0,0 +1,189 @@
+"""
+Tax rules repository for the Rand Water calculators
+Holds effective-dated tax years in memory and reloads them only when the
+settings file's mtime or content hash changes
+
+The settings file is either a single flat rule set (the original format) or:
+
+    {
+        "tax_years": [
+            {"tax_year": "2024/2025", "effective_from": "2024-03-01", "tax_brackets": [...], ...},
+            {"tax_year": "2025/2026", "effective_from": "2025-03-01", ...}
+        ]
+    }
+
+Top-level keys outside "tax_years" apply to every year; each year only needs
+to list the values that differ from the defaults.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from bisect import bisect_right
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+from tax_engine import get_tax_table
+
+logger = logging.getLogger(__name__)
+
+# SARS 2024/2025 rules used for any value the settings file does not supply
+DEFAULT_TAX_RULES = {
+    "tax_brackets": [
+        {"min": 0, "max": 237100, "rate": 0.18, "cumulative": 0},
+        {"min": 237101, "max": 370500, "rate": 0.26, "cumulative": 42678},
+        {"min": 370501, "max": 512800, "rate": 0.31, "cumulative": 77362},
+        {"min": 512801, "max": 673000, "rate": 0.36, "cumulative": 121475},
+        {"min": 673001, "max": 857900, "rate": 0.39, "cumulative": 179147},
+        {"min": 857901, "max": 1817000, "rate": 0.41, "cumulative": 251258},
+        {"min": 1817001, "max": float('inf'), "rate": 0.45, "cumulative": 644489}
+    ],
+    "rebate_primary": 17235,
+    "rebate_secondary": 9444,
+    "rebate_tertiary": 3145,
+    "medical_main": 364,
+    "medical_first": 364,
+    "medical_additional": 246,
+    "medical_credits_limit": 332,
+    "uif_ceiling": 177.12
+}
+
+QUARTER_START_MONTHS = {'Q1': 1, 'Q2': 4, 'Q3': 7, 'Q4': 10}
+
+
+def parse_period(period) -> date:
+    """Resolve a payroll period (date, datetime, 'YYYY-MM-DD' or 'YYYY-MM') to a date"""
+    if period is None or period == '':
+        return date.today()
+    if isinstance(period, datetime):
+        return period.date()
+    if isinstance(period, date):
+        return period
+    text = str(period).strip()[:10]
+    for fmt in ('%Y-%m-%d', '%Y/%m/%d', '%Y-%m', '%Y/%m'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised payroll period: {period}")
+
+
+def upload_period_date(financial_year, period) -> date:
+    """Payroll date for a SAP upload's financial year and period (Q1-Q4 or Annual)"""
+    year = int(financial_year or date.today().year)
+    month = QUARTER_START_MONTHS.get(str(period or '').upper())
+    if month:
+        return date(year, month, 1)
+    # Annual uploads cover the SARS year of assessment ending in February
+    return date(year - 1, 3, 1)
+
+
+class TaxRulesRepository:
+    """Effective-dated tax rule sets loaded from a JSON settings file"""
+
+    def __init__(self, path: str, defaults: Optional[Dict] = None):
+        self.path = path
+        self.defaults = defaults or DEFAULT_TAX_RULES
+        self._lock = threading.Lock()
+        self._stat = None
+        self._digest = None
+        # (effective dates, rule sets) swapped as one tuple so readers never see a mix
+        self._rules: Tuple[List[date], List[Dict]] = ([], [])
+        self._loaded = False
+
+    @property
+    def version(self) -> str:
+        """Content hash of the loaded settings ('defaults' when no file exists)"""
+        self._refresh()
+        return self._digest or 'defaults'
+
+    def _build_years(self, raw) -> Tuple[List[date], List[Dict]]:
+        """Merge each tax year over the defaults and sort by effective date"""
+        if not isinstance(raw, dict):
+            raise ValueError("Tax settings must be a JSON object")
+
+        shared = dict(self.defaults)
+        shared.update({k: v for k, v in raw.items() if k != 'tax_years'})
+        entries = raw.get('tax_years') or [{}]
+
+        years = []
+        for entry in entries:
+            settings = dict(shared)
+            settings.update(entry)
+            effective_from = settings.get('effective_from')
+            start = parse_period(effective_from) if effective_from else date.min
+            years.append((start, settings))
+        years.sort(key=lambda item: item[0])
+
+        # Compile bracket tables now so calculations never pay for it
+        for _, settings in years:
+            get_tax_table(settings)
+        return [start for start, _ in years], [settings for _, settings in years]
+
+    def _refresh(self):
+        """Reload the settings file if its mtime/size and content hash changed"""
+        try:
+            st = os.stat(self.path)
+            stat_key = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stat_key = None
+
+        if self._loaded and stat_key == self._stat:
+            return
+
+        with self._lock:
+            if self._loaded and stat_key == self._stat:
+                return
+
+            if stat_key is None:
+                if self._digest is not None or not self._loaded:
+                    logger.warning(f"Tax settings file {self.path} not found, using SARS defaults")
+                self._rules = self._build_years({})
+                self._digest = None
+            else:
+                try:
+                    with open(self.path, 'rb') as f:
+                        content = f.read()
+                    digest = hashlib.sha256(content).hexdigest()
+                    if digest != self._digest or not self._loaded:
+                        self._rules = self._build_years(json.loads(content))
+                        self._digest = digest
+                        logger.info(f"Loaded {len(self._rules[1])} tax year(s) from {self.path}")
+                except (OSError, ValueError, TypeError) as e:
+                    logger.error(f"Could not load tax settings from {self.path}: {str(e)}")
+                    if not self._loaded:
+                        self._rules = self._build_years({})
+
+            self._stat = stat_key
+            self._loaded = True
+
+    def get(self, period=None) -> Dict:
+        """
+        Rule set effective for a payroll period (today when omitted).
+
+        The returned dict is shared between callers and must not be modified.
+        """
+        self._refresh()
+        starts, years = self._rules
+        index = bisect_right(starts, parse_period(period)) - 1
+        return years[max(index, 0)]
+
+    def preview(self, raw, period=None) -> Dict:
+        """Rule set that proposed settings file contents would give for a period, without loading them"""
+        starts, years = self._build_years(raw)
+        index = bisect_right(starts, parse_period(period)) - 1
+        return years[max(index, 0)]
+
+    def tax_years(self) -> List[Dict]:
+        """Summary of the loaded tax years in effective-date order"""
+        self._refresh()
+        starts, years = self._rules
+        return [
+            {
+                'tax_year': settings.get('tax_year', ''),
+                'effective_from': start.isoformat() if start != date.min else None
+            }
+            for start, settings in zip(starts, years)
+        ]
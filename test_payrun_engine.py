@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Test the cumulative pay-run engine's period selection
+"""
+
+from payrun_engine import PayRunEngine, period_uploads
+
+EMPLOYEE = {'EMPLOYEECODE': '1001', 'TPE': 28000, 'CASH': 2000, 'AGE': 40}
+
+
+def upload(upload_id, period):
+    return {'id': upload_id, 'financial_year': '2025', 'period': period, 'filename': f'{period}.xlsx',
+            'upload_date': f'2025-0{upload_id}-01', 'employee_data': [dict(EMPLOYEE)]}
+
+
+def test_annual_upload_ignored_when_quarters_exist(tmp_path):
+    uploads = [upload(1, 'Q1'), upload(2, 'Q2'), upload(3, 'Q3'), upload(4, 'Q4'), upload(5, 'ANNUAL')]
+    assert [period for period, _ in period_uploads(uploads, '2025')] == ['Q1', 'Q2', 'Q3', 'Q4']
+
+    engine = PayRunEngine(str(tmp_path))
+    result = engine.run(uploads, '2025')
+    assert [period['period'] for period in result['periods']] == ['Q1', 'Q2', 'Q3', 'Q4']
+
+    history = engine.employee_history(uploads, '2025', '1001')
+    assert history[-1]['months_ytd'] == 12
+
+
+def test_annual_upload_alone():
+    uploads = [upload(5, 'ANNUAL')]
+    assert [period for period, _ in period_uploads(uploads, '2025')] == ['ANNUAL']
+
+
+def test_duplicate_employee_rows_merged(tmp_path):
+    split = [dict(EMPLOYEE, TPE=30000, CASH=30000), dict(EMPLOYEE, TPE=30000, CASH=30000)]
+    duplicated = [dict(upload(1, 'Q1'), employee_data=split), dict(upload(2, 'Q2'), employee_data=split)]
+    merged = [dict(EMPLOYEE, TPE=60000, CASH=60000)]
+    single = [dict(upload(1, 'Q1'), employee_data=merged), dict(upload(2, 'Q2'), employee_data=merged)]
+
+    result = PayRunEngine(str(tmp_path / 'duplicated')).run(duplicated, '2025')
+    expected = PayRunEngine(str(tmp_path / 'single')).run(single, '2025')
+    assert [period['employees'] for period in result['periods']] == [1, 1]
+
+    history = PayRunEngine(str(tmp_path / 'duplicated')).employee_history(duplicated, '2025', '1001')
+    expected_history = PayRunEngine(str(tmp_path / 'single')).employee_history(single, '2025', '1001')
+    for entry, expected_entry in zip(history, expected_history):
+        entry.pop('processed_at'), expected_entry.pop('processed_at')
+        assert entry == expected_entry
+    assert history[-1]['months_ytd'] == 6
+    assert history[-1]['paye'] > 0